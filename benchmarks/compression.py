@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# compression.py: compare the CPU time and compression ratio of the
+# available result file codecs.
+#
+# usage: python benchmarks/compression.py [result files...]
+#
+# Result files can be compressed with any of the supported codecs.
+# Without arguments, a synthetic baseline result is used.
+
+import json
+import os
+import random
+import sys
+
+from centinel import compression
+
+# (codec, level, threads), None level is the codec's default
+SETTINGS = [("bzip2", 9, 1), ("bzip2", 1, 1),
+            ("gzip", 6, 1), ("gzip", 6, 4),
+            ("xz", 6, 1), ("xz", 6, 4),
+            ("zstd", 3, 1), ("zstd", 3, 4), ("zstd", 10, 1),
+            ("lz4", 0, 1)]
+
+
+def synthetic_result(urls):
+    random.seed(0)
+    http = {}
+    for i in range(urls):
+        url = "http://www.site%d.example/" % i
+        http[url] = {"request": {"method": "GET", "host": url[7:-1],
+                                 "path": "/", "ssl": False},
+                     "response": {"status": random.choice([200, 301, 403]),
+                                  "reason": "OK",
+                                  "headers": {"Server": "nginx",
+                                              "Content-Type": "text/html"},
+                                  "body": "<html>%s</html>" % ("x" * (i % 500)),
+                                  "body_sha256": "%064x" % random.getrandbits(256)}}
+    return json.dumps({"baseline": {"http_request": http}}, indent=2)
+
+
+def cpu_time():
+    # user + system time of this process and its threads
+    times = os.times()
+    return times[0] + times[1]
+
+
+def timed(function, *args, **kwargs):
+    start = cpu_time()
+    output = function(*args, **kwargs)
+    return output, cpu_time() - start
+
+
+def main():
+    if len(sys.argv) > 1:
+        data = "".join(compression.read_file(path) for path in sys.argv[1:])
+    else:
+        data = synthetic_result(20000)
+
+    available = compression.available()
+    print "%d bytes uncompressed" % len(data)
+    print "%-8s %6s %8s %10s %14s %16s" % ("codec", "level", "threads",
+                                           "ratio", "compress (s)",
+                                           "decompress (s)")
+    for codec, level, threads in SETTINGS:
+        if codec not in available:
+            print "%-8s not available" % codec
+            continue
+        compressed, compress_time = timed(compression.compress, data,
+                                          codec, level, threads)
+        output, decompress_time = timed(compression.decompress, compressed)
+        assert output == data
+        print "%-8s %6s %8d %10.2f %14.3f %16.3f" % (
+            codec, level, threads, float(len(data)) / len(compressed),
+            compress_time, decompress_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# headless_crawl.py: compare full page loads in the headless browser
+# with fast mode, which blocks images, media, fonts and plugins and
+# only waits for the DOM.
+#
+# usage: python benchmarks/headless_crawl.py [workers] url...
+#
+# Needs the bundled firefox, Xvfb and network access.
+
+import sys
+import time
+
+from centinel.primitives.headless_browser import HeadlessBrowser
+
+
+def crawl(urls, workers, fast):
+    contents = ["url"] + urls
+    browser = HeadlessBrowser(workers=workers, fast=fast)
+    start = time.time()
+    results = browser.run(input_files={"benchmark": contents})
+    return results, time.time() - start
+
+
+def summarize(results, fast):
+    entries = 0
+    blocked = 0
+    errors = 0
+    for result in results.values():
+        if "error" in result:
+            errors += 1
+            continue
+        if fast:
+            blocked += len(result["blocked"] or [])
+            result = result["entries"]
+        entries += len(result)
+    return entries, blocked, errors
+
+
+def main():
+    args = sys.argv[1:]
+    workers = 1
+    if args and args[0].isdigit():
+        workers = int(args.pop(0))
+    if not args:
+        print "usage: python benchmarks/headless_crawl.py [workers] url..."
+        sys.exit(1)
+
+    print "%d urls, %d workers" % (len(args), workers)
+    print "%-6s %10s %12s %10s %10s %8s" % ("mode", "total (s)", "per url (s)",
+                                            "entries", "blocked", "errors")
+    for fast in [False, True]:
+        results, elapsed = crawl(args, workers, fast)
+        entries, blocked, errors = summarize(results, fast)
+        print "%-6s %10.1f %12.2f %10d %10d %8d" % (
+            "fast" if fast else "full", elapsed, elapsed / len(args),
+            entries, blocked, errors)
+
+
+if __name__ == "__main__":
+    main()
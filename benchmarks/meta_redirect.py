@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# meta_redirect.py: compare the regular expression meta refresh
+# scanner in centinel.primitives.http with the full BeautifulSoup
+# parse it replaces.
+#
+# usage: python benchmarks/meta_redirect.py [html files...]
+#
+# Without arguments, synthetic documents of a few sizes are used.
+
+import sys
+import timeit
+
+from centinel.primitives import http
+
+HEAD = ('<html><head><title>Example</title>'
+        '<meta http-equiv="content-type" content="text/html; charset=utf-8">'
+        '<link rel="stylesheet" href="/style.css">%s</head><body>')
+PARAGRAPH = '<div class="c"><p>Some <a href="/x">text</a> here.</p></div>\n'
+REFRESH = '<meta http-equiv="refresh" content="0; url=http://blocked.example/">'
+
+
+def synthetic_documents():
+    documents = []
+    for size in [2 * 1024, 64 * 1024, 1024 * 1024]:
+        for redirect in [False, True]:
+            head = HEAD % (REFRESH if redirect else "")
+            body = PARAGRAPH * (size / len(PARAGRAPH))
+            name = "%dKB%s" % (size / 1024, " refresh" if redirect else "")
+            documents.append((name, head + body + "</body></html>"))
+    return documents
+
+
+def soup_meta_redirect(content):
+    refresh_content = http._soup_meta_refresh(content)
+    if refresh_content is None:
+        return None
+    return http._refresh_url(refresh_content)
+
+
+def bench(function, document):
+    timer = timeit.Timer(lambda: function(document))
+    number = 1
+    while timer.timeit(number) < 0.2:
+        number *= 10
+    return min(timer.repeat(3, number)) / number
+
+
+def main():
+    if len(sys.argv) > 1:
+        documents = []
+        for path in sys.argv[1:]:
+            with open(path) as file_p:
+                documents.append((path, file_p.read()))
+    else:
+        documents = synthetic_documents()
+
+    print "%-30s %12s %12s %8s" % ("document", "soup (ms)", "scan (ms)", "speedup")
+    for name, document in documents:
+        assert soup_meta_redirect(document) == http.meta_redirect(document)
+        soup_time = bench(soup_meta_redirect, document)
+        scan_time = bench(http.meta_redirect, document)
+        print "%-30s %12.3f %12.3f %7.0fx" % (name, soup_time * 1000,
+                                              scan_time * 1000,
+                                              soup_time / scan_time)
+
+
+if __name__ == "__main__":
+    main()
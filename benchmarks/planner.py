@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# planner.py: time compiling baseline input lists into plans, and
+# loading the compiled plans from the cache.
+#
+# usage: python benchmarks/planner.py [input files...]
+#
+# Without arguments, synthetic lists of a few sizes are used.
+
+import shutil
+import sys
+import tempfile
+import time
+
+from centinel import planner
+
+
+def synthetic_list(rows):
+    lines = ["# description: synthetic list", "url,category"]
+    for i in range(rows):
+        scheme = "https" if i % 3 == 0 else "http"
+        # every domain shows up twice, with different paths
+        lines.append("%s://www.site%d.example/page%d,MISC" % (scheme, i / 2, i))
+    return lines
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+
+def main():
+    if len(sys.argv) > 1:
+        lists = []
+        for path in sys.argv[1:]:
+            with open(path) as file_p:
+                lists.append((path, file_p.read().splitlines()))
+    else:
+        lists = [("%d rows" % rows, synthetic_list(rows))
+                 for rows in [1000, 10000, 50000]]
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        print "%-30s %12s %12s %12s" % ("list", "build (s)", "first (s)",
+                                        "cached (s)")
+        for name, lines in lists:
+            build_time = timed(planner.build_plan, name, lines)
+            first_time = timed(planner.load_plan, name, lines,
+                               cache_dir=cache_dir)
+            cached_time = timed(planner.load_plan, name, lines,
+                                cache_dir=cache_dir)
+            print "%-30s %12.3f %12.3f %12.3f" % (name, build_time,
+                                                  first_time, cached_time)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ import requests
 import time
 import uuid
 
+from centinel import compression
+from centinel.content_cache import ContentCache
 import centinel.utils as utils
 
 
@@ -169,7 +171,32 @@ class User:
             json.dump(client_sched, file_p, indent=2,
                       separators=(',', ': '))
 
-    def download_experiment(self, name):
+    def save_file(self, path, content, digest=None, cache=None):
+        """
+        Write a downloaded file to path. With a content cache, the
+        file is stored there and linked to path.
+
+        :param digest: the hash the server listed for the file
+        :param cache: optional centinel.content_cache.ContentCache
+        """
+        if (cache is not None and digest is not None and
+                cache.add(digest, content)):
+            cache.materialize(digest, path)
+            return
+        # path may be a link into the cache, never write through it
+        if os.path.lexists(path):
+            os.remove(path)
+        with open(path, "w") as file_p:
+            file_p.write(content)
+
+    def download_experiment(self, name, digest=None, cache=None):
+        path = os.path.join(self.config['dirs']['experiments_dir'],
+                            "%s" % name)
+        if cache is not None and digest is not None and \
+                cache.materialize(digest, path):
+            logging.info("Using cached experiment - %s", name)
+            return
+
         logging.info("Downloading experiment - %s", name)
 
         url = "%s/%s/%s" % (self.config['server']['server_url'],
@@ -183,12 +210,15 @@ class User:
             logging.exception("Error trying to download experiments: %s" % exp)
             raise exp
 
-        name = "%s" % name
-        with open(os.path.join(self.config['dirs']['experiments_dir'], name),
-                  "w") as exp_fh:
-            exp_fh.write(req.content)
+        self.save_file(path, req.content, digest, cache)
+
+    def download_input_file(self, name, digest=None, cache=None):
+        path = os.path.join(self.config['dirs']['data_dir'], "%s" % name)
+        if cache is not None and digest is not None and \
+                cache.materialize(digest, path):
+            logging.info("Using cached input data file - %s", name)
+            return
 
-    def download_input_file(self, name):
         logging.info("Downloading input data file - %s", name)
 
         url = "%s/%s/%s" % (self.config['server']['server_url'],
@@ -202,10 +232,7 @@ class User:
             logging.exception("Error trying to download experiments: %s" % exp)
             raise exp
 
-        name = "%s" % name
-        with open(os.path.join(self.config['dirs']['data_dir'], name),
-                  "w") as exp_fh:
-            exp_fh.write(req.content)
+        self.save_file(path, req.content, digest, cache)
 
     def register(self, username, password):
         logging.info("Registering new user %s" % (username))
@@ -302,14 +329,16 @@ def sync(config):
         logging.exception("Unable to create user: %s" % str(exp))
         return
 
-    # send all results (.bz2)
-    result_files = glob.glob(os.path.join(config['dirs']['results_dir'],
-                                          '[!_]*.bz2'))
+    # send all results (.bz2, or whatever compression is configured)
+    result_files = []
+    for extension in compression.EXTENSIONS:
+        result_files.extend(glob.glob(os.path.join(config['dirs']['results_dir'],
+                                                   '[!_]*.%s' % extension)))
 
     # only upload pcaps if it is allowed
     if config['results']['upload_pcaps'] is False:
         for pcap_file in glob.glob(os.path.join(config['dirs']['results_dir'],
-                                                '[!_]*.pcap.bz2')):
+                                                '[!_]*.pcap.*')):
             if pcap_file in result_files:
                 result_files.remove(pcap_file)
 
@@ -330,6 +359,11 @@ def sync(config):
             logging.error("Interaction with server took too long. Preempting")
             return
 
+    # files already downloaded for another home on this machine
+    cache = None
+    if config['dirs'].get('content_cache'):
+        cache = ContentCache(config['dirs']['content_cache'])
+
     # determine how to sync the experiment files
     # Note: we are not checking anything that starts with _
     client_exps = utils.hash_folder(config['dirs']['experiments_dir'],
@@ -361,7 +395,8 @@ def sync(config):
     for exp_file in dload_exps:
         try:
             if exp_file != "scheduler.info":
-                user.download_experiment(exp_file)
+                user.download_experiment(exp_file, server_exps[exp_file],
+                                         cache)
             else:
                 try:
                     user.sync_scheduler()
@@ -397,7 +432,8 @@ def sync(config):
     # get the files that have changed or we don't have
     for input_file in dload_inputs:
         try:
-            user.download_input_file(input_file)
+            user.download_input_file(input_file, server_inputs[input_file],
+                                     cache)
         except Exception, e:
             logging.exception("Unable to download input file %s", str(e))
         if time.time() - start > config['server']['total_timeout']:
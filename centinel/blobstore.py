@@ -0,0 +1,158 @@
+#
+# blobstore.py: per-run content-addressed store for large result
+# payloads (HTTP bodies, certificates, HAR contents).
+#
+# The same block page, CDN certificate or HAR content shows up for
+# hundreds of URLs in one run. Instead of embedding each copy in the
+# result JSON, primitives put the payload in the store, which keeps
+# one file per unique SHA-256, and put the hash in the result. The
+# store is archived next to the result file when the run is over.
+#
+# The store is opt-in, since results then reference payloads instead of
+# containing them: HTTP "body" becomes "body_blob", TLS "cert"/"chain"
+# become "cert_blob"/"chain_blobs" and HAR "text" becomes "text_blob".
+# To turn it on, set "blob_store": true in the "results" section of
+# config.json.
+
+import hashlib
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+
+from centinel import compression
+
+
+class BlobStore:
+    """Content-addressed store backed by a directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # digests of the blobs on disk
+        self._known = set()
+        # digest -> threading.Event set once the thread writing that
+        # blob is done, see put()
+        self._writing = {}
+        # bytes passed to put(), and bytes actually written
+        self.bytes_in = 0
+        self.bytes_stored = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        else:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Pick up blobs that were written to the directory by someone
+        else: an earlier, interrupted run that is being resumed (see
+        centinel.checkpoint), or worker processes.
+        """
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            # skip temporary files
+            if not os.path.isdir(prefix_dir):
+                continue
+            for digest in os.listdir(prefix_dir):
+                with self._lock:
+                    if digest in self._known:
+                        continue
+                    self._known.add(digest)
+                    self.bytes_stored += os.path.getsize(
+                        os.path.join(prefix_dir, digest))
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        """
+        Store data (a byte string) once and return its SHA-256 hex
+        digest, which is what results should reference.
+        """
+        if type(data) == unicode:
+            data = data.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            self.bytes_in += len(data)
+        # a digest is only known once its blob is on disk. If another
+        # thread is writing the same blob, wait for it: once it is
+        # done the blob is there, or it failed and we try ourselves.
+        while True:
+            with self._lock:
+                if digest in self._known:
+                    return digest
+                writing = self._writing.get(digest)
+                if writing is None:
+                    self._writing[digest] = threading.Event()
+                    break
+            writing.wait()
+
+        try:
+            self._write(digest, data)
+        finally:
+            with self._lock:
+                self._writing.pop(digest).set()
+        return digest
+
+    def _write(self, digest, data):
+        path = self._path(digest)
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        except OSError:
+            # another thread created it
+            pass
+
+        # write to a temporary file first so that a reader never
+        # sees a partially written blob
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as file_p:
+                file_p.write(data)
+            os.rename(temp_path, path)
+        except:
+            # e.g. out of disk space, don't leave half a blob behind
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        with self._lock:
+            # refresh() may have found it already
+            if digest not in self._known:
+                self._known.add(digest)
+                self.bytes_stored += len(data)
+
+    def get(self, digest):
+        with open(self._path(digest), 'rb') as file_p:
+            return file_p.read()
+
+    def __contains__(self, digest):
+        return digest in self._known
+
+    def __len__(self):
+        return len(self._known)
+
+    def stats(self):
+        return {"blobs": len(self._known),
+                "bytes_in": self.bytes_in,
+                "bytes_stored": self.bytes_stored}
+
+    def archive(self, archive_path, codec=None, level=None, threads=1):
+        """
+        Bundle all blobs into a compressed tar archive, with the
+        digest as the file name of each member.
+
+        :param codec: compression codec, see centinel.compression
+        """
+        with compression.open_writer(archive_path, codec, level,
+                                     threads) as writer:
+            with tarfile.open(fileobj=writer, mode="w|") as tar_file:
+                for digest in sorted(self._known):
+                    tar_file.add(self._path(digest), arcname=digest)
+        logging.debug("Archived %d blobs to %s" % (len(self._known),
+                                                   archive_path))
+
+    def delete(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,177 @@
+#
+# checkpoint.py: periodically saves the results an experiment has
+# collected so far, so that a run that gets killed (cron overlap,
+# VPN going down, SIGTERM) can pick up where it left off.
+#
+# Experiments register the dicts their batch primitives write
+# results into with track(). A background thread (and the client's
+# signal handler) snapshots those dicts to a JSON file in the
+# results directory. The next run of the same schedule entry loads
+# the file and uses completed() to skip targets that were measured
+# within the schedule window.
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from centinel.connectivity import is_skipped
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint:
+    """Per-experiment checkpoint file"""
+
+    def __init__(self, path, window=None, interval=60):
+        """
+        :param path: checkpoint file
+        :param window: results older than this many seconds are not
+                       reused (usually the schedule frequency), None
+                       reuses everything
+        :param interval: seconds between periodic flushes
+        """
+        self.path = path
+        self.window = window
+        self.interval = interval
+        # blob store directory the checkpointed results refer to
+        self.blob_dir = None
+        # set by the experiment once it got through all its targets
+        self.finished = False
+        # RLock, the signal handler may interrupt a flush
+        self._lock = threading.RLock()
+        self._tracked = {}
+        # phase -> {key: [time measured, result]}
+        self._done = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._load()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file_p:
+                state = json.load(file_p)
+        except Exception as exp:
+            logging.warning("Failed to load checkpoint %s: %s" % (self.path,
+                                                                  exp))
+            return
+        if state.get("version") != CHECKPOINT_VERSION:
+            return
+
+        self.blob_dir = state.get("blob_dir")
+        oldest = None
+        if self.window is not None:
+            oldest = time.time() - self.window
+        for phase, entries in state.get("phases", {}).items():
+            self._done[phase] = {}
+            for key, (measured, result) in entries.items():
+                if oldest is not None and measured < oldest:
+                    continue
+                self._done[phase][key] = [measured, result]
+
+    def completed(self, phase):
+        """
+        Returns {key: result} for the targets of a phase that have
+        been measured within the window.
+        """
+        with self._lock:
+            return dict((key, entry[1]) for key, entry
+                        in self._done.get(phase, {}).items())
+
+    def track(self, phase, results):
+        """
+        Checkpoint the results of a phase as they come in. results is
+        the dict the batch primitive stores its results in, each entry
+        must be complete once it is set.
+        """
+        with self._lock:
+            self._tracked[phase] = results
+
+    def update(self, phase, results):
+        """
+        Checkpoint a finished set of results for a phase, for
+        primitives that fill in their entries bit by bit.
+        """
+        with self._lock:
+            self._record(phase, results)
+
+    def _record(self, phase, results):
+        now = time.time()
+        done = self._done.setdefault(phase, {})
+        # copy first, primitive threads may still be adding results
+        for key, result in dict(results).items():
+            # errors are about the whole batch, not one target, and
+            # skipped targets still have to be measured
+            if key == "error" or is_skipped(result):
+                continue
+            if key not in done or done[key][1] is not result:
+                done[key] = [now, result]
+
+    def snapshot(self):
+        """
+        Returns a copy of the checkpoint that is not backed by a file,
+        for worker processes to look up completed targets in.
+        """
+        copy = Checkpoint(None, self.window, self.interval)
+        with self._lock:
+            for phase, results in self._tracked.items():
+                self._record(phase, results)
+            for phase, entries in self._done.items():
+                copy._done[phase] = dict(entries)
+        copy.blob_dir = self.blob_dir
+        return copy
+
+    def has_results(self):
+        with self._lock:
+            return (len(self._tracked) > 0 or
+                    any(len(entries) > 0 for entries in self._done.values()))
+
+    def finish(self):
+        self.finished = True
+
+    def flush(self):
+        """
+        Write everything measured so far to the checkpoint file.
+        """
+        with self._lock:
+            for phase, results in self._tracked.items():
+                self._record(phase, results)
+            state = {"version": CHECKPOINT_VERSION,
+                     "blob_dir": self.blob_dir,
+                     "phases": self._done}
+            directory = os.path.dirname(self.path)
+            # write to a temporary file first so that being killed
+            # halfway through never leaves a broken checkpoint
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as file_p:
+                    json.dump(state, file_p)
+                os.rename(temp_path, self.path)
+            except Exception as exp:
+                logging.warning("Failed to write checkpoint: %s" % exp)
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        """Start flushing periodically in the background."""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,10 +1,10 @@
-import bz2
 import glob
 import imp
 import json
 import logging
 import logging.config
 import os
+import shutil
 import signal
 import sys
 import tarfile
@@ -13,6 +13,12 @@ from datetime import datetime
 
 import centinel
 from centinel.backend import get_meta
+from centinel.blobstore import BlobStore
+from centinel.checkpoint import Checkpoint
+from centinel import compression
+from centinel import concurrency
+from centinel import connectivity
+from centinel.deadline import Deadline
 from centinel.primitives.tcpdump import Tcpdump
 from experiment import ExperimentList
 from centinel.vpn.cli import get_external_ip
@@ -20,9 +26,15 @@ from centinel.vpn.cli import get_external_ip
 loaded_modules = set()
 # we need a global reference to stop it if we receive an interrupt.
 tds = []
+# same for checkpoints, so that we can save partial results
+checkpoints = []
 
 def signal_handler(signal, frame):
         logging.warn('Interrupt signal received.')
+        if len(checkpoints) > 0:
+            logging.warn('Saving checkpoints...')
+            for checkpoint in checkpoints:
+                checkpoint.flush()
         if len(tds) > 0:
             logging.warn('Stopping TCP dump...')
             for td in tds:
@@ -34,11 +46,18 @@ def signal_handler(signal, frame):
 signal.signal(signal.SIGTERM, signal_handler)
 
 class Client:
-    def __init__(self, config, vpn_provider=None):
+    def __init__(self, config, vpn_provider=None, tunnel=None):
+        """
+        :param tunnel: the VPN tunnel (centinel.vpn.openvpn.OpenVPN)
+                       the experiments measure through, if any. The
+                       run stops when it drops.
+        """
         self.config = config
         self.experiments = self.load_experiments()
         self._meta = None
         self.vpn_provider = vpn_provider
+        self.tunnel = tunnel
+        self.deadline = Deadline()
 
     def setup_logging(self):
 
@@ -57,8 +76,22 @@ class Client:
 
         logging.debug("Finished setting up logging.")
 
+    def compression_args(self):
+        """
+        Returns (codec, level, threads) as configured, see
+        centinel.compression.
+        """
+        results_config = self.config['results']
+        return (results_config.get('compression', compression.DEFAULT_CODEC),
+                results_config.get('compression_level'),
+                results_config.get('compression_threads', 1))
+
+    def compression_extension(self):
+        return compression.get_codec(self.compression_args()[0]).extension
+
     def get_result_file(self, name, start_time):
-        result_file = "%s-%s.json.bz2" % (name, start_time)
+        result_file = "%s-%s.json.%s" % (name, start_time,
+                                         self.compression_extension())
         return os.path.join(self.config['dirs']['results_dir'], result_file)
 
     def get_input_file(self, experiment_name):
@@ -159,6 +192,13 @@ class Client:
 
         logging.info('Centinel started.')
 
+        # the whole run, including the experiments' primitives, has to
+        # fit into the budget
+        run_budget = self.config.get('experiments', {}).get('run_budget')
+        self.deadline = Deadline(run_budget)
+        if run_budget is not None:
+            logging.info("Run budget is %d seconds." % run_budget)
+
         if not os.path.exists(self.config['dirs']['results_dir']):
             logging.warn("Creating results directory in "
                          "%s" % (self.config['dirs']['results_dir']))
@@ -184,6 +224,16 @@ class Client:
 
         logging.debug("Processing the experiment schedule.")
         for name in sched_info:
+            if self.tunnel is not None and self.tunnel.is_down():
+                # the rest keeps its last run time, so it runs on the
+                # next visit
+                logging.warn("VPN tunnel is down, not running the "
+                             "remaining experiments.")
+                break
+            if self.deadline.expired():
+                logging.warn("Run budget is used up, not running the "
+                             "remaining experiments.")
+                break
 
             # check if we should preempt on the experiment (if the
             # time to run next is greater than the current time) and
@@ -201,13 +251,20 @@ class Client:
 
             # backward compatibility with older-style scheduler
             if 'python_exps' not in sched_info[name]:
-                self.run_exp(name=name)
+                self.run_exp(name=name,
+                             checkpoint_window=sched_info[name]['frequency'])
             else:
                 exps = sched_info[name]['python_exps'].items()
                 for python_exp, exp_config in exps:
                     logging.debug("Running %s." % python_exp)
-                    self.run_exp(name=python_exp, exp_config=exp_config, schedule_name=name)
+                    self.run_exp(name=python_exp, exp_config=exp_config, schedule_name=name,
+                                 checkpoint_window=sched_info[name]['frequency'])
                     logging.debug("Finished running %s." % python_exp)
+            if ((self.tunnel is not None and self.tunnel.is_down()) or
+                    self.deadline.expired()):
+                # it may not have finished, run it again (from its
+                # checkpoint) next time
+                continue
             sched_info[name]['last_run'] = time.time()
 
         logging.debug("Updating timeout values in scheduler.")
@@ -221,7 +278,14 @@ class Client:
         logging.info("Finished running experiments. "
                      "Look in %s for results." % (self.config['dirs']['results_dir']))
 
-    def run_exp(self, name, exp_config=None, schedule_name=None):
+    def run_exp(self, name, exp_config=None, schedule_name=None,
+                checkpoint_window=None):
+        """
+        :param checkpoint_window: results of an interrupted earlier run
+                                  that are at most this many seconds
+                                  old are reused (usually the schedule
+                                  frequency)
+        """
         if name[-3:] == ".py":
             name = name[:-3]
         if name not in self.experiments:
@@ -293,6 +357,15 @@ class Client:
                                     'data_dir': self.config['dirs']['data_dir']}
 
                 exp_class.global_constants = global_constants
+                # schedule params (see __init__) can still override these
+                experiments_config = self.config.get('experiments', {})
+                exp_class.max_threads = experiments_config.get(
+                    'max_threads', concurrency.MAX_THREADS)
+                exp_class.max_handshakes = experiments_config.get(
+                    'max_handshakes', concurrency.MAX_HANDSHAKES)
+                exp_class.canaries = connectivity.canaries(
+                    experiments_config.get('canaries'),
+                    self.config.get('server', {}).get('server_url'))
 
                 exp = exp_class(input_files)
             except Exception as exception:
@@ -301,6 +374,39 @@ class Client:
                 return
 
             exp.global_constants = global_constants
+            exp.tunnel = self.tunnel
+            exp.deadline = self.deadline
+
+            checkpoint = None
+            checkpoint_interval = self.config['results'].get('checkpoint_interval', 60)
+            if checkpoint_interval:
+                checkpoint_path = os.path.join(self.config['dirs']['results_dir'],
+                                               "_checkpoint-%s-%s.json" % (results["meta"]["schedule_name"],
+                                                                           name))
+                checkpoint = Checkpoint(checkpoint_path, window=checkpoint_window,
+                                        interval=checkpoint_interval)
+                if checkpoint.has_results():
+                    logging.info("Resuming %s from checkpoint." % name)
+                    results["meta"]["resumed_checkpoint"] = True
+            exp.checkpoint = checkpoint
+
+            blob_store = None
+            if self.config['results'].get('blob_store', False):
+                blob_dir = os.path.join(self.config['dirs']['results_dir'],
+                                        "_blobs-%s-%s" % (name,
+                                                          start_time.strftime("%Y-%m-%dT%H%M%S.%f")))
+                # checkpointed results refer to the blobs of the run
+                # they come from
+                if (checkpoint is not None and checkpoint.blob_dir is not None and
+                        os.path.isdir(checkpoint.blob_dir)):
+                    blob_dir = checkpoint.blob_dir
+                try:
+                    blob_store = BlobStore(blob_dir)
+                except Exception as exp:
+                    logging.exception("Failed to create blob store: %s" % exp)
+            exp.blob_store = blob_store
+            if checkpoint is not None and blob_store is not None:
+                checkpoint.blob_dir = blob_store.directory
 
             run_tcpdump = True
 
@@ -324,7 +430,7 @@ class Client:
 
             try:
                 if run_tcpdump:
-                    td = Tcpdump()
+                    td = Tcpdump(config=self.config)
                     tds.append(td)
                     td.start()
                     tcpdump_started = True
@@ -334,6 +440,10 @@ class Client:
             except Exception as exp:
                 logging.exception("Failed to run tcpdump: %s" % (exp,))
 
+            if checkpoint is not None:
+                checkpoints.append(checkpoint)
+                checkpoint.start()
+
             try:
                 # run the experiment
                 exp.run()
@@ -343,27 +453,43 @@ class Client:
             except KeyboardInterrupt:
                 logging.warn("Keyboard interrupt received, stopping experiment...")
 
+            # keep the checkpoint around if the experiment did not get
+            # through all of its inputs, the next run continues from it
+            keep_checkpoint = False
+            if checkpoint is not None:
+                checkpoint.stop()
+                checkpoints.remove(checkpoint)
+                if checkpoint.finished or not checkpoint.has_results():
+                    checkpoint.delete()
+                else:
+                    checkpoint.flush()
+                    keep_checkpoint = True
+                    logging.info("%s did not finish, the next run will "
+                                 "resume from its checkpoint." % name)
+
 
             # save any external results that the experiment has generated
             # they could be anything that doesn't belong in the json file
             # (e.g. pcap files)
-            # these should all be compressed with bzip2
+            # these are all compressed with the configured codec
             # the experiment is responsible for giving these a name and
             # keeping a list of files in the json results
             results_dir = self.config['dirs']['results_dir']
+            codec, level, threads = self.compression_args()
+            extension = self.compression_extension()
             if exp.external_results is not None:
                 logging.debug("Writing external files for %s" % name)
                 for fname, fcontents in exp.external_results.items():
                     external_file_name = ("external_%s-%s-%s"
-                                          ".bz2" % (name,
-                                                    start_time.strftime("%Y-%m-%dT%H%M%S.%f"),
-                                                    fname))
+                                          ".%s" % (name,
+                                                   start_time.strftime("%Y-%m-%dT%H%M%S.%f"),
+                                                   fname, extension))
                     external_file_path = os.path.join(results_dir,
                                                       external_file_name)
                     try:
-                        with open(external_file_path, 'w:bz2') as file_p:
-                            data = bz2.compress(fcontents)
-                            file_p.write(data)
+                        with compression.open_writer(external_file_path, codec,
+                                                     level, threads) as file_p:
+                            file_p.write(fcontents)
                             logging.debug("External file "
                                           "%s written successfully" % fname)
                     except Exception as exp:
@@ -371,6 +497,30 @@ class Client:
                                           "%s" % exp)
                 logging.debug("Finished writing external files for %s" % name)
 
+            # ship the blobs referenced by the results as a separate
+            # archive next to the result file
+            if blob_store is not None:
+                if len(blob_store) > 0:
+                    blob_file_name = ("blobs_%s-%s"
+                                      ".tar.%s" % (name,
+                                                   start_time.strftime("%Y-%m-%dT%H%M%S.%f"),
+                                                   extension))
+                    try:
+                        blob_store.archive(os.path.join(results_dir,
+                                                        blob_file_name),
+                                           codec, level, threads)
+                        results["meta"]["blob_archive"] = blob_file_name
+                        results["meta"]["blob_stats"] = blob_store.stats()
+                        logging.info("Saved %d blobs to "
+                                     "%s." % (len(blob_store), blob_file_name))
+                    except Exception as exp:
+                        logging.exception("Failed to write blob "
+                                          "archive: %s" % exp)
+                        results["blob_exception"] = str(exp)
+                # the checkpointed results still need the blobs
+                if not keep_checkpoint:
+                    blob_store.delete()
+
             if tcpdump_started:
                 logging.info("Waiting for tcpdump to process packets...")
                 # 5 seconds should be enough. this hasn't been tested on
@@ -378,23 +528,25 @@ class Client:
                 time.sleep(5)
                 td.stop()
                 logging.info("tcpdump stopped.")
-                bz2_successful = False
+                compression_successful = False
                 try:
                     pcap_file_name = ("pcap_%s-%s.pcap"
-                                      ".bz2" % (name, start_time.strftime("%Y-%m-%dT%H%M%S.%f")))
+                                      ".%s" % (name, start_time.strftime("%Y-%m-%dT%H%M%S.%f"),
+                                               extension))
                     pcap_file_path = os.path.join(results_dir,
                                                   pcap_file_name)
 
-                    with open(pcap_file_path, 'w:bz2') as file_p:
-                        data = bz2.compress(td.pcap())
-                        file_p.write(data)
-                        logging.info("Saved pcap to "
-                                     "%s." % pcap_file_path)
-                        bz2_successful = True
+                    # straight from the capture file, without reading
+                    # all of it into memory
+                    compression.compress_file(td.filename, pcap_file_path,
+                                              codec, level, threads)
+                    logging.info("Saved pcap to "
+                                 "%s." % pcap_file_path)
+                    compression_successful = True
                 except Exception as exception:
                     logging.exception("Failed to compress and write "
                                       "pcap file: %s" % exception)
-                if not bz2_successful:
+                if not compression_successful:
                     logging.info("Writing pcap file uncompressed")
                     try:
                         pcap_file_name = ("pcap_%s-%s"
@@ -402,18 +554,15 @@ class Client:
                         pcap_file_path = os.path.join(results_dir,
                                                       pcap_file_name)
 
-                        with open(pcap_file_path, 'w') as file_p:
-                            data = td.pcap()
-                            file_p.write(data)
-                            logging.info("Saved pcap to "
-                                         "%s." % pcap_file_path)
+                        shutil.copyfile(td.filename, pcap_file_path)
+                        logging.info("Saved pcap to "
+                                     "%s." % pcap_file_path)
                     except Exception as exception:
                         logging.exception("Failed to write "
                                           "pcap file: %s" % exception)
                 # delete pcap data to free up some memory
                 logging.debug("Removing pcap data from memory")
                 td.delete()
-                del data
                 del td
 
             # close input file handle(s)
@@ -449,7 +598,8 @@ class Client:
                 # compressed before sending.
                 result_file_path = self\
                     .get_result_file(name, start_time.strftime("%Y-%m-%dT%H%M%S.%f"))
-                result_file = bz2.BZ2File(result_file_path, "w")
+                result_file = compression.open_writer(result_file_path, codec,
+                                                      level, threads)
                 json.dump(results, result_file, indent=2, separators=(',', ': '),
                     # ignore encoding errors, these will be dealt with on the server
                     ensure_ascii=False)
@@ -465,8 +615,12 @@ class Client:
 
     def consolidate_results(self):
         # bundle and compress result files
-        result_files = [path for path in glob.glob(
-            os.path.join(self.config['dirs']['results_dir'], '*.json.bz2'))]
+        result_files = []
+        for extension in compression.EXTENSIONS:
+            result_files.extend(glob.glob(
+                os.path.join(self.config['dirs']['results_dir'],
+                             '*.json.%s' % extension)))
+        codec, level, threads = self.compression_args()
 
         if len(result_files) >= self.config['results']['files_per_archive']:
             logging.info("Compressing and archiving results.")
@@ -474,20 +628,27 @@ class Client:
             files_archived = 0
             archive_count = 0
             tar_file = None
+            archive_writer = None
             files_per_archive = self.config['results']['files_per_archive']
             results_dir = self.config['dirs']['results_dir']
             for path in result_files:
                 if (files_archived % files_per_archive) == 0:
                     archive_count += 1
-                    archive_filename = "results-%s_%d.tar.bz2" % (
-                        datetime.now().strftime("%Y-%m-%dT%H%M%S.%f"), archive_count)
+                    archive_filename = "results-%s_%d.tar.%s" % (
+                        datetime.now().strftime("%Y-%m-%dT%H%M%S.%f"), archive_count,
+                        self.compression_extension())
                     archive_file_path = os.path.join(results_dir,
                                                      archive_filename)
                     logging.info("Creating new archive"
                                  " %s" % archive_file_path)
                     if tar_file:
                         tar_file.close()
-                    tar_file = tarfile.open(archive_file_path, "w:bz2")
+                        archive_writer.close()
+                    # tar stream into the configured compressor
+                    archive_writer = compression.open_writer(archive_file_path,
+                                                             codec, level,
+                                                             threads)
+                    tar_file = tarfile.open(fileobj=archive_writer, mode="w|")
 
                 tar_file.add(path, arcname=os.path.basename(path))
                 os.remove(path)
@@ -495,3 +656,4 @@ class Client:
 
             if tar_file:
                 tar_file.close()
+                archive_writer.close()
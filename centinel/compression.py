@@ -0,0 +1,375 @@
+#
+# compression.py: compression backends for result, pcap and archive
+# files.
+#
+# bzip2 compresses well but is one of the slowest codecs on the
+# Raspberry Pi class hardware clients run on. The codec is picked in
+# the results section of the config (compression, compression_level,
+# compression_threads). bzip2, gzip are always there, xz needs lzma
+# (or backports.lzma on python 2), zstd needs zstandard and lz4 needs
+# lz4. Readers detect the format from the magic bytes at the start of
+# the file, so they don't need to know how a file was written.
+#
+# With more than one thread, codecs whose format allows it compress
+# the data in independent blocks in parallel and write them out as
+# consecutive streams (gzip members, xz streams). zstd uses its own
+# worker threads. bzip2 and lz4 always write a single stream since
+# python 2 can only read the first stream of a bzip2 file.
+
+import bz2
+import logging
+import shutil
+import zlib
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# codec used when none is configured, or the configured one is missing
+DEFAULT_CODEC = "bzip2"
+
+# uncompressed bytes per block when compressing with several threads
+BLOCK_SIZE = 1024 * 1024
+
+# bytes read at a time when compressing or decompressing files
+CHUNK_SIZE = 64 * 1024
+
+
+class _GzipCompressor:
+    """zlib compressor that writes the gzip format"""
+
+    def __init__(self, level):
+        # 16 + MAX_WBITS makes zlib add the gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _GzipDecompressor:
+    """zlib decompressor that reads gzip files with several members"""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        output = []
+        while data:
+            output.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data
+            if data:
+                # the next member starts here
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return "".join(output)
+
+
+class _LZ4Compressor:
+    """lz4 frame compressor with the compress()/flush() interface"""
+
+    def __init__(self, level):
+        self._compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self._started = False
+
+    def compress(self, data):
+        header = ""
+        if not self._started:
+            header = self._compressor.begin()
+            self._started = True
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        if not self._started:
+            return self._compressor.begin() + self._compressor.flush()
+        return self._compressor.flush()
+
+
+class Codec:
+    """A compression format"""
+
+    def __init__(self, name, extension, magic, default_level,
+                 compressor, decompressor, multistream=False,
+                 native_threads=False):
+        """
+        :param name: name used in the config
+        :param extension: file name extension, without the dot
+        :param magic: bytes every file of this format starts with
+        :param default_level: compression level used if none is given
+        :param compressor: function (level, threads) returning an
+                           object with compress(data) and flush()
+        :param decompressor: function returning an object with
+                             decompress(data)
+        :param multistream: whether readers handle several streams
+                            written back to back
+        :param native_threads: whether the compressor has its own
+                               worker threads
+        """
+        self.name = name
+        self.extension = extension
+        self.magic = magic
+        self.default_level = default_level
+        self._compressor = compressor
+        self._decompressor = decompressor
+        self.multistream = multistream
+        self.native_threads = native_threads
+
+    def compressor(self, level=None, threads=1):
+        if level is None:
+            level = self.default_level
+        return self._compressor(level, threads)
+
+    def decompressor(self):
+        return self._decompressor()
+
+    def compress(self, data, level=None):
+        compressor = self.compressor(level)
+        return compressor.compress(data) + compressor.flush()
+
+
+def _bzip2_decompressor():
+    return bz2.BZ2Decompressor()
+
+
+def _xz_compressor(level, threads):
+    return lzma.LZMACompressor(preset=level)
+
+
+def _xz_decompressor():
+    return _MultiStreamDecompressor(lzma.LZMADecompressor)
+
+
+def _zstd_compressor(level, threads):
+    if threads > 1:
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+    else:
+        compressor = zstandard.ZstdCompressor(level=level)
+    return compressor.compressobj()
+
+
+def _zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _lz4_decompressor():
+    return lz4_frame.LZ4FrameDecompressor()
+
+
+class _MultiStreamDecompressor:
+    """Starts a new decompressor whenever a stream ends"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._decompressor = factory()
+
+    def decompress(self, data):
+        output = []
+        while data:
+            if self._decompressor.eof:
+                # the next stream starts here
+                self._decompressor = self._factory()
+            output.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            data = self._decompressor.unused_data
+        return "".join(output)
+
+
+CODECS = [Codec("bzip2", "bz2", "BZh", 9,
+                lambda level, threads: bz2.BZ2Compressor(level),
+                _bzip2_decompressor),
+          Codec("gzip", "gz", "\x1f\x8b", 6,
+                lambda level, threads: _GzipCompressor(level),
+                _GzipDecompressor, multistream=True)]
+if lzma is not None:
+    CODECS.append(Codec("xz", "xz", "\xfd7zXZ\x00", 6,
+                        _xz_compressor, _xz_decompressor, multistream=True))
+if zstandard is not None:
+    CODECS.append(Codec("zstd", "zst", "\x28\xb5\x2f\xfd", 3,
+                        _zstd_compressor, _zstd_decompressor,
+                        native_threads=True))
+if lz4_frame is not None:
+    CODECS.append(Codec("lz4", "lz4", "\x04\x22\x4d\x18", 0,
+                        lambda level, threads: _LZ4Compressor(level),
+                        _lz4_decompressor))
+
+# every extension we might have written, whether or not the codec is
+# available right now (used to find result files)
+EXTENSIONS = ["bz2", "gz", "xz", "zst", "lz4"]
+
+
+def available():
+    """Returns the names of the codecs that can be used."""
+    return [codec.name for codec in CODECS]
+
+
+def get_codec(name=None):
+    """
+    Returns the codec with the given name, or the default codec if the
+    name is None or the codec is not available.
+    """
+    if name is None:
+        name = DEFAULT_CODEC
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    logging.warning("Compression codec %s is not available, "
+                    "using %s." % (name, DEFAULT_CODEC))
+    return get_codec(DEFAULT_CODEC)
+
+
+def detect(data):
+    """
+    Returns the codec data (or the start of it) was compressed with,
+    or None.
+    """
+    for codec in CODECS:
+        if data.startswith(codec.magic):
+            return codec
+    return None
+
+
+class Writer:
+    """
+    File-like object that compresses what is written to it into
+    another file object.
+    """
+
+    def __init__(self, file_p, codec, level=None, threads=1):
+        self._file = file_p
+        self._codec = codec
+        self._level = level
+        self._pool = None
+        if threads > 1 and codec.multistream:
+            self._pool = ThreadPool(threads)
+            self._threads = threads
+            self._buffer = []
+            self._buffered = 0
+            self._pending = []
+        else:
+            self._compressor = codec.compressor(level, threads)
+
+    def _compress_block(self, data):
+        return self._codec.compress(data, self._level)
+
+    def _write_blocks(self, flush=False):
+        # write out finished blocks in order, and wait for some if
+        # too many are in flight
+        while self._pending and (flush or self._pending[0].ready() or
+                                 len(self._pending) > 2 * self._threads):
+            self._file.write(self._pending.pop(0).get())
+
+    def write(self, data):
+        if type(data) is unicode:
+            data = data.encode("utf-8")
+        if self._pool is None:
+            self._file.write(self._compressor.compress(data))
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered < BLOCK_SIZE:
+            return
+        data = "".join(self._buffer)
+        # large writes are split up too, so they use every thread
+        offset = 0
+        while len(data) - offset >= BLOCK_SIZE:
+            block = data[offset:offset + BLOCK_SIZE]
+            offset += BLOCK_SIZE
+            self._pending.append(self._pool.apply_async(self._compress_block,
+                                                        (block,)))
+            self._write_blocks()
+        self._buffer = [data[offset:]]
+        self._buffered = len(data) - offset
+
+    def close(self):
+        if self._pool is None:
+            self._file.write(self._compressor.flush())
+        else:
+            if self._buffered > 0 or not self._pending:
+                block = "".join(self._buffer)
+                self._pending.append(self._pool.apply_async(self._compress_block,
+                                                            (block,)))
+            self._write_blocks(flush=True)
+            self._pool.close()
+            self._pool.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_writer(path, codec=None, level=None, threads=1):
+    """
+    Open path for writing compressed data, see Writer.
+
+    :param codec: codec name
+    """
+    return Writer(open(path, "wb"), get_codec(codec), level, threads)
+
+
+def compress(data, codec=None, level=None, threads=1):
+    output = StringIO()
+    writer = Writer(output, get_codec(codec), level, threads)
+    # keep the buffer, Writer.close() closes its file
+    output.close = lambda: None
+    writer.write(data)
+    writer.close()
+    return output.getvalue()
+
+
+def compress_file(source_path, path, codec=None, level=None, threads=1):
+    """
+    Compress the file at source_path into path without reading all
+    of it into memory.
+    """
+    with open(source_path, "rb") as source:
+        with open_writer(path, codec, level, threads) as writer:
+            shutil.copyfileobj(source, writer, CHUNK_SIZE)
+
+
+def decompress(data):
+    """
+    Decompress data in any of the available formats.
+    """
+    codec = detect(data)
+    if codec is None:
+        raise ValueError("Unknown compression format")
+    return codec.decompressor().decompress(data)
+
+
+def read_file(path):
+    """
+    Returns the decompressed contents of the file at path.
+    """
+    output = []
+    with open(path, "rb") as file_p:
+        data = file_p.read(CHUNK_SIZE)
+        codec = detect(data)
+        if codec is None:
+            raise ValueError("Unknown compression format: %s" % path)
+        decompressor = codec.decompressor()
+        while data:
+            output.append(decompressor.decompress(data))
+            data = file_p.read(CHUNK_SIZE)
+    return "".join(output)
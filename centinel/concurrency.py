@@ -0,0 +1,228 @@
+#
+# concurrency.py: adapt the number of targets a batch primitive
+# measures at once to what the link can take.
+#
+# A fixed number of threads and a fixed delay between them is too slow
+# on a datacenter VM and too much for a congested VPN, where the
+# excess shows up as timeouts. The ConcurrencyController sets the
+# number of targets in flight the way TCP sets its window (AIMD):
+#
+# - while nothing has timed out yet, every success adds one (slow
+#   start, the limit doubles with every round of targets)
+# - after that, every round of successes adds one (additive increase)
+# - the limit only grows while response times stay within
+#   LATENCY_FACTOR of the best seen so far
+# - a timeout halves the limit (multiplicative decrease). Targets that
+#   were already in flight when the limit was cut do not cut it again,
+#   they are part of the same congestion event.
+#
+# The delay between dispatches shrinks and grows with the limit. The
+# limits a batch went through are kept in stats() for the results.
+#
+# Every target in flight holds a socket, so the limit never goes past
+# the number of file descriptors the process may open (ulimit -n).
+
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from centinel.connectivity import is_network_failure
+
+INITIAL_LIMIT = 20
+# default ceilings, high enough for a datacenter link: the limit only
+# gets there while the link keeps up. The TLS engine needs no thread
+# per handshake and goes higher. Both are capped by descriptor_limit().
+MAX_THREADS = 500
+MAX_HANDSHAKES = 1000
+# file descriptors kept for everything but the targets in flight (log
+# files, pcaps, resolver threads, pipes to the shard processes)
+FD_HEADROOM = 100
+# multiplicative decrease on timeouts
+DECREASE = 0.5
+# response times (moving average) more than this many times the best
+# so far stop the limit from growing
+LATENCY_FACTOR = 2.0
+# weight of a new response time in the moving average
+LATENCY_WEIGHT = 0.2
+
+
+def descriptor_limit():
+    """
+    Returns how many targets can be in flight before the process runs
+    out of file descriptors (the soft RLIMIT_NOFILE less FD_HEADROOM),
+    or None if there is no such limit.
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(soft - FD_HEADROOM, 1)
+
+
+class ConcurrencyController:
+    """AIMD limit on the number of targets in flight"""
+
+    def __init__(self, initial=INITIAL_LIMIT, minimum=1, maximum=MAX_THREADS,
+                 decrease=DECREASE, latency_factor=LATENCY_FACTOR):
+        """
+        :param initial: targets in flight to start with
+        :param minimum: lowest the limit goes
+        :param maximum: highest the limit goes (e.g. max_threads),
+                        capped by descriptor_limit()
+        :param decrease: factor to cut the limit by on timeouts
+        :param latency_factor: see LATENCY_FACTOR
+        """
+        fd_limit = descriptor_limit()
+        if fd_limit is not None:
+            maximum = min(maximum, fd_limit)
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.initial = min(max(initial, self.minimum), self.maximum)
+        self.limit = float(self.initial)
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.slow_start = True
+        self.latency = None
+        self.best_latency = None
+        self.last_decrease = 0
+        self.lowest = self.initial
+        self.highest = self.initial
+        self.decreases = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Wait until another target can be dispatched. Returns False if
+        that did not happen within timeout seconds.
+        """
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = None
+                if end is not None:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, started, error=None):
+        """
+        Record the outcome of a target and make room for the next.
+
+        :param started: time.time() the target was dispatched at
+        :param error: the failure message of the target, None if it
+                      succeeded
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._record(started, error)
+            self._condition.notify_all()
+
+    def record(self, started, error=None):
+        """
+        Like release(), for callers that keep track of the targets in
+        flight themselves (e.g. an event loop comparing them to limit).
+        """
+        with self._condition:
+            self._record(started, error)
+            self._condition.notify_all()
+
+    def back_off(self, in_flight):
+        """
+        Starting another target failed for local reasons (e.g. out of
+        file descriptors) with in_flight targets in flight. The limit
+        and the ceiling drop to that: unlike a timeout this says nothing
+        about the link, but more targets won't fit either.
+        """
+        with self._condition:
+            self.slow_start = False
+            self.maximum = max(min(self.maximum, in_flight), self.minimum)
+            if self.limit > self.maximum:
+                self.limit = float(self.maximum)
+                self.last_decrease = time.time()
+                self.decreases += 1
+            self.lowest = min(self.lowest, int(self.limit))
+
+    def _record(self, started, error):
+        now = time.time()
+        if error is not None and is_network_failure(error):
+            if started >= self.last_decrease and self.limit > self.minimum:
+                self.slow_start = False
+                self.limit = max(self.limit * self.decrease, self.minimum)
+                self.last_decrease = now
+                self.decreases += 1
+        else:
+            self._sample(now - started)
+            if self.healthy():
+                if self.slow_start:
+                    self.limit += 1
+                else:
+                    self.limit += 1.0 / self.limit
+                self.limit = min(self.limit, self.maximum)
+        self.lowest = min(self.lowest, int(self.limit))
+        self.highest = max(self.highest, int(self.limit))
+
+    def _sample(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_WEIGHT * (latency - self.latency)
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+
+    def healthy(self):
+        if self.latency is None:
+            return True
+        return self.latency <= self.latency_factor * max(self.best_latency,
+                                                         0.001)
+
+    def watch(self, function, error_of):
+        """
+        Wrap a primitive so that it releases its slot with its outcome
+        when it is done. acquire() has to be called before starting it.
+
+        :param error_of: returns the failure message from the result
+                         of function, or None
+        """
+        def watched(*args, **kwargs):
+            started = time.time()
+            error = None
+            try:
+                result = function(*args, **kwargs)
+                error = error_of(result)
+                return result
+            except Exception as exp:
+                error = str(exp)
+                raise
+            finally:
+                self.release(started, error)
+        return watched
+
+    def pace(self, delay_time):
+        """
+        The delay before the next dispatch: delay_time at the initial
+        limit, shorter as the limit grows.
+        """
+        return delay_time * self.initial / self.limit
+
+    def stats(self):
+        """
+        The limits the controller went through, for the results.
+        """
+        return {"initial": self.initial,
+                "final": int(self.limit),
+                "lowest": self.lowest,
+                "highest": self.highest,
+                "maximum": self.maximum,
+                "decreases": self.decreases}
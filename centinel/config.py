@@ -4,6 +4,7 @@ import logging
 import os
 
 import centinel
+from centinel import concurrency
 
 
 class Configuration:
@@ -44,7 +45,22 @@ class Configuration:
         results = {'delete_after_sync': True,
                    'files_per_archive': 10,
                    'record_pcaps': True,
-                   'upload_pcaps': True}
+                   'upload_pcaps': True,
+                   # store large payloads once per run by hash
+                   # instead of inline in the results. This changes
+                   # the result format (e.g. "body_blob" instead of
+                   # "body", see centinel.blobstore), so it is off
+                   # unless the server side reads the blob archives
+                   'blob_store': False,
+                   # seconds between saves of partial results so that
+                   # interrupted runs can be resumed, 0 disables this
+                   'checkpoint_interval': 60,
+                   # codec for result, pcap and archive files, see
+                   # centinel.compression (None level is the codec's
+                   # default)
+                   'compression': 'bzip2',
+                   'compression_level': None,
+                   'compression_threads': 1}
         self.params['results'] = results
 
         # logging
@@ -56,7 +72,22 @@ class Configuration:
                                            '%(levelname)s: %(message)s'
 
         # experiments
-        experiments = {'tcpdump_params': ["-i", "any"]}
+        experiments = {'tcpdump_params': ["-i", "any"],
+                       # seconds a run may take (e.g. a bit less than the
+                       # cron interval), None for no limit. Targets left
+                       # when it is over are measured by the next run,
+                       # see centinel.deadline
+                       'run_budget': None,
+                       # ceilings for the targets a test has in flight
+                       # at once (per process), the actual number adapts
+                       # to the link below them, see centinel.concurrency
+                       'max_threads': concurrency.MAX_THREADS,
+                       'max_handshakes': concurrency.MAX_HANDSHAKES,
+                       # "host[:port]" of hosts to check connectivity with
+                       # when targets keep failing, None for the defaults.
+                       # The centinel server is always added. See
+                       # centinel.connectivity
+                       'canaries': None}
         self.params['experiments'] = experiments
 
         # server
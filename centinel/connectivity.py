@@ -0,0 +1,259 @@
+#
+# connectivity.py: notice when the network goes away in the middle of
+# a batch of measurements.
+#
+# When the link or the VPN tunnel dies mid-run, every remaining target
+# of a batch primitive waits out its full timeout. The batch primitives
+# report the outcome of each target to a ConnectivityMonitor, and ask
+# it before starting the next one. After a run of network-level
+# failures (timeouts, unreachable networks) dispatch pauses while the
+# monitor connects to a few well-known canary hosts. If one answers,
+# the failures were about the targets (which is what we measure) and
+# the batch carries on. If none answers within max_pause seconds, the
+# monitor gives up and the remaining targets are marked as skipped
+# instead of measured. Skipped targets are not checkpointed, so a
+# resumed run measures them.
+#
+# One monitor is meant to be shared by all batches of a run, once it
+# has given up, later batches skip their targets right away. Targets
+# left once the run is out of time (see centinel.deadline) are skipped
+# the same way.
+
+import logging
+import socket
+import threading
+import time
+from urlparse import urlparse
+
+# network-level failures in a row that make the monitor check the
+# canaries
+FAILURE_THRESHOLD = 20
+# hosts that are reachable from (almost) anywhere, any one answering
+# means we are online. HTTPS, as many networks block DNS to outside
+# resolvers. The config can replace them (experiments.canaries) and the
+# centinel server is added, see canaries().
+CANARIES = [("1.1.1.1", 443), ("8.8.8.8", 443), ("9.9.9.9", 443)]
+CANARY_TIMEOUT = 3
+# how long to keep checking the canaries before giving up
+MAX_PAUSE = 60
+PAUSE_INTERVAL = 5
+
+SKIPPED = "connectivity lost"
+# skip reason for targets left when the run's deadline has passed, see
+# centinel.deadline
+OUT_OF_TIME = "out of time"
+
+# failure messages (lower case) that point at the network rather than
+# the target
+NETWORK_ERRORS = ["timed out", "network is unreachable", "no route to host",
+                  "host is down", "temporary failure in name resolution"]
+
+
+def is_network_failure(error):
+    error = str(error).lower()
+    for message in NETWORK_ERRORS:
+        if message in error:
+            return True
+    return False
+
+
+def canaries(configured=None, server_url=None):
+    """
+    The (host, port) pairs to check connectivity with.
+
+    :param configured: canaries from the config as "host[:port]"
+                       strings (port 443 if left out), CANARIES if None
+    :param server_url: URL of the centinel server, added as a canary
+    """
+    if configured is None:
+        result = list(CANARIES)
+    else:
+        result = []
+        for canary in configured:
+            host, _, port = canary.rpartition(":")
+            if not host:
+                host, port = port, 443
+            result.append((host, int(port)))
+    if server_url:
+        url = urlparse(server_url)
+        port = url.port
+        if port is None:
+            port = 80 if url.scheme == "http" else 443
+        if url.hostname and (url.hostname, port) not in result:
+            result.append((url.hostname, port))
+    return result
+
+
+def skipped(reason=SKIPPED, **fields):
+    """
+    The result for a target that was skipped, fields are added to it.
+    """
+    result = dict(fields)
+    result["skipped"] = reason
+    return result
+
+
+def skip_reason(monitor, deadline=None):
+    """
+    Called by the batch primitives before dispatching each target.
+    Returns why the target should be skipped, or None to measure it.
+    """
+    if deadline is not None and deadline.expired():
+        return OUT_OF_TIME
+    if not monitor.proceed(deadline):
+        if deadline is not None and deadline.expired():
+            return OUT_OF_TIME
+        return SKIPPED
+    return None
+
+
+def is_skipped(result):
+    """
+    True if result (a target's result, or a list of them) is for a
+    skipped target.
+    """
+    if type(result) is list:
+        return len(result) > 0 and all(is_skipped(entry) for entry in result)
+    return type(result) is dict and "skipped" in result
+
+
+def count_skipped(results):
+    """
+    The number of skipped targets in the results of a batch.
+    """
+    return len([key for key, result in results.items()
+                if key != "error" and is_skipped(result)])
+
+
+class ConnectivityMonitor:
+    """Tells batch primitives whether to go on dispatching targets"""
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, canaries=CANARIES,
+                 timeout=CANARY_TIMEOUT, max_pause=MAX_PAUSE, tunnel=None):
+        """
+        :param threshold: network-level failures in a row that pause
+                          dispatch
+        :param canaries: (host, port) pairs to check connectivity with
+        :param timeout: connect timeout for the canaries
+        :param max_pause: seconds to wait for connectivity to come back
+        :param tunnel: VPN tunnel (centinel.vpn.openvpn.OpenVPN) the
+                       measurements go through, if any. While it is
+                       down, we are offline.
+        """
+        self.threshold = threshold
+        self.canaries = canaries
+        self.timeout = timeout
+        self.max_pause = max_pause
+        self.tunnel = tunnel
+        self.failures = 0
+        self.aborted = False
+        self._lock = threading.Lock()
+        self._pause_lock = threading.Lock()
+
+    def record(self, error=None):
+        """
+        Record the outcome of a target.
+
+        :param error: the failure message of the target, None if it
+                      succeeded
+        """
+        with self._lock:
+            if error is not None and is_network_failure(error):
+                self.failures += 1
+            else:
+                self.failures = 0
+
+    def watch(self, function, error_of):
+        """
+        Wrap a primitive so that the outcome of each call is recorded.
+
+        :param error_of: returns the failure message from the result
+                         of function, or None
+        """
+        def watched(*args, **kwargs):
+            result = function(*args, **kwargs)
+            try:
+                self.record(error_of(result))
+            except Exception as exp:
+                logging.debug("Failed to record the outcome of a "
+                              "target: %s" % exp)
+            return result
+        return watched
+
+    def tripped(self):
+        if self.tunnel is not None and self.tunnel.is_down():
+            return True
+        return self.failures >= self.threshold
+
+    def online(self):
+        """
+        Check the canaries. Returns True if one of them answers.
+        """
+        if self.tunnel is not None and self.tunnel.is_down():
+            return False
+        for host, port in self.canaries:
+            try:
+                socket.create_connection((host, port), self.timeout).close()
+                return True
+            except (socket.error, socket.timeout):
+                continue
+        return False
+
+    def proceed(self, deadline=None):
+        """
+        Called before dispatching each target. Pauses while checking
+        connectivity after a run of failures. Returns False if the
+        target should be skipped.
+
+        :param deadline: centinel.deadline.Deadline the pause must not
+                         go past
+        """
+        if self.aborted:
+            return False
+        if not self.tripped():
+            return True
+        # one dispatcher checks, the others wait for its verdict
+        with self._pause_lock:
+            if self.aborted:
+                return False
+            if not self.tripped():
+                return True
+            logging.warning("%d network failures in a row, pausing to "
+                            "check connectivity..." % self.failures)
+            max_pause = self.max_pause
+            if deadline is not None:
+                max_pause = deadline.cap(max_pause)
+            end = time.time() + max_pause
+            while True:
+                if self.online():
+                    logging.info("Connectivity is fine, resuming.")
+                    with self._lock:
+                        self.failures = 0
+                    return True
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                time.sleep(min(PAUSE_INTERVAL, remaining))
+            if deadline is not None and deadline.expired():
+                # out of time, not necessarily offline
+                return False
+            logging.error("Connectivity lost, skipping the remaining "
+                          "targets.")
+            self.aborted = True
+            return False
+
+    def finish(self, results):
+        """
+        Note the skipped targets in the batch error of results.
+        """
+        reasons = {}
+        for key, result in results.items():
+            if key != "error" and is_skipped(result):
+                if type(result) is list:
+                    result = result[0]
+                reason = result["skipped"]
+                reasons[reason] = reasons.get(reason, 0) + 1
+        if len(reasons) > 0 and "error" not in results:
+            results["error"] = "Skipped %s." % ", ".join(
+                "%d targets (%s)" % (count, reason)
+                for reason, count in sorted(reasons.items()))
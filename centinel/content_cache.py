@@ -0,0 +1,101 @@
+#
+# content_cache.py: machine-wide store for the experiment and input
+# files handed out by the server.
+#
+# The VPN walker keeps a centinel home per vantage point, and every
+# home syncs the same experiment files and input lists. The server
+# lists each file with the MD5 of its contents (see
+# utils.hash_folder), so sync looks the hash up in the cache first and
+# only downloads files it has never seen. Files are stored once, under
+# their hash, and each home gets a hard link to them.
+#
+# Linked files are shared between homes, so they must never be written
+# in place. Materializing replaces the directory entry instead.
+
+from base64 import urlsafe_b64encode
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+
+def content_hash(data):
+    """The hash the server uses for a file, see utils.hash_folder"""
+    return urlsafe_b64encode(hashlib.md5(data).digest())
+
+
+class ContentCache:
+    """Content-addressed file cache backed by a directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def __contains__(self, digest):
+        return os.path.isfile(self._path(digest))
+
+    def add(self, digest, data):
+        """
+        Store data under digest. Returns False (and stores nothing)
+        if data does not match the digest.
+        """
+        if content_hash(data) != digest:
+            logging.warning("Not caching file, its contents do not "
+                            "match hash %s" % digest)
+            return False
+        if digest in self:
+            return True
+        # write to a temporary file first so that nobody sees a
+        # partial file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as file_p:
+            file_p.write(data)
+        os.rename(temp_path, self._path(digest))
+        return True
+
+    def materialize(self, digest, path):
+        """
+        Put the file with the given digest at path, as a hard link if
+        possible. Returns False if the cache doesn't have it.
+        """
+        if digest not in self:
+            return False
+        directory = os.path.dirname(path)
+        temp_path = os.path.join(directory, ".%s.tmp" % os.path.basename(path))
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(self._path(digest), temp_path)
+        except OSError:
+            # e.g. on another file system
+            shutil.copyfile(self._path(digest), temp_path)
+        # replaces the old file (or link) without touching its contents
+        os.rename(temp_path, path)
+        return True
+
+    def prune(self):
+        """
+        Remove files that no home links to any more. Returns the
+        number of files removed.
+        """
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".tmp-") or not os.path.isfile(path):
+                continue
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+                removed += 1
+        if removed:
+            logging.info("Removed %d unused files from the content "
+                         "cache" % removed)
+        return removed
@@ -0,0 +1,59 @@
+#
+# deadline.py: time budget for a whole client run.
+#
+# The client creates one Deadline per run (see the run_budget setting)
+# and hands it to the experiments, which pass it on to the batch
+# primitives. Every wait is capped by the time that is left: batches
+# stop dispatching targets once it has run out (the rest are marked
+# skipped and measured by the next run, see centinel.checkpoint) and
+# the final wait for the worker threads is bounded by one overall
+# timeout instead of one timeout per thread.
+
+import time
+
+
+class Deadline:
+    """Point in time by which a run has to be done"""
+
+    def __init__(self, seconds=None):
+        """
+        :param seconds: the budget, None for no limit
+        """
+        self.expires = None
+        if seconds is not None:
+            self.expires = time.time() + seconds
+
+    def remaining(self):
+        """
+        Seconds left, None if there is no limit.
+        """
+        if self.expires is None:
+            return None
+        return max(self.expires - time.time(), 0)
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    def cap(self, timeout):
+        """
+        Returns timeout, or the time left if that is shorter.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return min(timeout, remaining)
+
+
+def join_all(threads, timeout, deadline=None):
+    """
+    Wait for threads to finish, at most timeout seconds in total and
+    not past deadline.
+
+    :return: the number of threads still running
+    """
+    if deadline is None:
+        deadline = Deadline()
+    end = time.time() + deadline.cap(timeout)
+    for thread in threads:
+        thread.join(max(end - time.time(), 0))
+    return len([thread for thread in threads if thread.is_alive()])
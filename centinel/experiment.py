@@ -1,3 +1,18 @@
+import logging
+
+from centinel import concurrency
+from centinel import connectivity
+
+# seconds to wait for a dropped VPN tunnel to come back before giving
+# up on the rest of the measurements
+TUNNEL_GRACE = 30
+
+
+class TunnelDown(Exception):
+    """The VPN tunnel the experiment measures through dropped"""
+    pass
+
+
 class ExperimentList(type):
     experiments = {}
 
@@ -28,9 +43,55 @@ class Experiment:
     # these files will be compressed when being stored
     external_results = None
 
+    # content-addressed store for large payloads (HTTP bodies,
+    # certificates, HAR contents). The client sets this up for each
+    # run and archives it next to the results. Primitives that take
+    # a blob_store parameter reference payloads by hash instead of
+    # embedding them in the results.
+    blob_store = None
+
+    # centinel.checkpoint.Checkpoint for this run, set by the client.
+    # Experiments that support resuming track their results there
+    # and skip what it has already, and call finish() once they got
+    # through all their inputs.
+    checkpoint = None
+
+    # the VPN tunnel (centinel.vpn.openvpn.OpenVPN) the experiment
+    # measures through when run by the VPN walker, set by the client.
+    # Long experiments call check_tunnel() between their steps.
+    tunnel = None
+
+    # centinel.deadline.Deadline of the client run, set by the client.
+    # Experiments hand it to the batch primitives, which skip the
+    # targets left once it has passed.
+    deadline = None
+
+    # ceilings for the number of targets a batch primitive has in
+    # flight (per process), set by the client from the config. The
+    # number in flight adapts below them, see centinel.concurrency.
+    max_threads = concurrency.MAX_THREADS
+    max_handshakes = concurrency.MAX_HANDSHAKES
+
+    # (host, port) pairs the batch primitives check connectivity with,
+    # set by the client from the config, see centinel.connectivity
+    canaries = connectivity.CANARIES
+
     # an experiment can have external parameters
     # that are usually set by the scheduler.
     params = {}
 
     def run(self):
         raise NotImplementedError
+
+    def check_tunnel(self, grace=TUNNEL_GRACE):
+        """
+        Raise TunnelDown if the VPN tunnel dropped and does not come
+        back within grace seconds. Measuring without it would only
+        record the outage.
+        """
+        if self.tunnel is None or not self.tunnel.is_down():
+            return
+        logging.warning("VPN tunnel is down, waiting up to %d seconds "
+                        "for it to come back..." % grace)
+        if not self.tunnel.wait_connected(grace):
+            raise TunnelDown("VPN tunnel dropped")
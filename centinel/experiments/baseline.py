@@ -11,18 +11,29 @@
 # files. In case of CSV input, the first column is
 # assumed to be the URL and the rest of the columns
 # are included in the results as metadata.
+#
+# Targets that show up in more than one input file are
+# only measured once per run, and their results are
+# copied into the result of each file that lists them.
+#
+# The number of targets each test measures at once adapts
+# to the link (see centinel.concurrency), the limits each
+# test went through are stored in the results.
 
 
-import csv
 import logging
+import multiprocessing
 import os
+import signal
 import time
-import urlparse
 from random import shuffle
 
 import centinel.primitives.http as http
 import centinel.primitives.traceroute as traceroute
-from centinel.experiment import Experiment
+from centinel import connectivity
+from centinel import planner
+from centinel.concurrency import ConcurrencyController
+from centinel.experiment import Experiment, TunnelDown
 from centinel.primitives import dnslib
 
 try:
@@ -33,6 +44,12 @@ except ImportError:
 
 from centinel.primitives import tls
 
+try:
+    from centinel.primitives import probe
+except ImportError:
+    # older clients don't have the combined probe
+    probe = None
+
 
 class BaselineExperiment(Experiment):
     name = "baseline"
@@ -40,12 +57,27 @@ class BaselineExperiment(Experiment):
     # this can be overridden by the main thread
     input_files = ['country.csv', 'world.csv']
     tls_for_all = True
+    # measure TCP connect, TLS and HTTP over a single connection
+    # per URL instead of running three separate phases
+    combined_probe = False
+    # how much of each HTTP response body to keep, see
+    # centinel.primitives.http_helper.BodyCapture. None keeps
+    # everything.
+    http_body_policy = None
+    # number of worker processes to split the targets between, each
+    # running its own threads. 1 runs everything in this process.
+    processes = 1
 
     def __init__(self, input_files):
         self.input_files = input_files
         self.results = []
         self.exclude_nameservers = []
         self.traceroute_methods = []
+        # see planner.priorities()
+        self.priorities = {}
+        # test -> the concurrency stats of each of its batches, see
+        # record_concurrency()
+        self.concurrency = {}
 
         if self.params is not None:
             # process parameters
@@ -55,6 +87,23 @@ class BaselineExperiment(Experiment):
                 self.exclude_nameservers = self.params['exclude_nameservers']
             if "tls_for_all" in self.params:
                 self.tls_for_all = self.params['tls_for_all']
+            if "combined_probe" in self.params:
+                self.combined_probe = self.params['combined_probe']
+            if "http_body_policy" in self.params:
+                self.http_body_policy = self.params['http_body_policy']
+            if "processes" in self.params:
+                self.processes = self.params['processes']
+            # the ceilings from the config (see Experiment) can be
+            # overridden per schedule
+            if "max_threads" in self.params:
+                self.max_threads = self.params['max_threads']
+            if "max_handshakes" in self.params:
+                self.max_handshakes = self.params['max_handshakes']
+
+        if self.combined_probe and probe is None:
+            logging.warning("Combined probe is not available, "
+                            "falling back to separate tests.")
+            self.combined_probe = False
 
         if os.geteuid() != 0:
             logging.info("Centinel is not running as root, "
@@ -64,218 +113,301 @@ class BaselineExperiment(Experiment):
                 self.traceroute_methods = ["udp"]
 
     def run(self):
+        # parse all input files first, the lists overlap a lot (most
+        # of the world list is usually in the country list too), so
+        # we measure the union of their targets once and hand the
+        # results back out to each file afterwards.
+        plans = []
         for input_file in self.input_files.items():
-            logging.info("Testing input file %s..." % (input_file[0]))
+            logging.info("Parsing input file %s..." % (input_file[0]))
+            plans.append(self.parse_file(input_file))
+
+        combined = planner.merge_plans(plans)
+        # if the run is short on time, the most important targets of
+        # each test are measured first
+        self.priorities = planner.priorities(plans)
+        dedup = planner.dedup_stats(plans, combined)
+        requested = sum(dedup["requested"].values())
+        measured = sum(dedup["measured"].values())
+        logging.info("Measuring %d unique targets for %d targets in "
+                     "%d input files." % (measured, requested, len(plans)))
+
+        run_start_time = time.time()
+        measurements = {}
+        self.concurrency = {}
+        tunnel_down = False
+        try:
+            if self.processes > 1:
+                self.measure_sharded(combined, measurements)
+            else:
+                self.measure(combined, measurements)
+            skipped = sum(connectivity.count_skipped(results)
+                          for results in measurements.values())
+            if skipped > 0:
+                # the checkpoint has everything else, the next run
+                # measures the skipped targets
+                logging.warn("Skipped %d targets, the next run will "
+                             "measure them." % skipped)
+            elif self.checkpoint is not None:
+                self.checkpoint.finish()
+        except KeyboardInterrupt:
+            logging.warn("Experiment interrupted, storing partial results...")
+        except TunnelDown:
+            logging.warn("VPN tunnel dropped, storing partial results...")
+            tunnel_down = True
+        elapsed = time.time() - run_start_time
+
+        for plan in plans:
             # Initialize the results for this input file.
             # This can be anything from file name to version
             # to any useful information.
-            result = {"file_name": input_file[0]}
-
-            try:
-                self.run_file(input_file, result)
-            except KeyboardInterrupt:
-                logging.warn("Experiment interrupted, storing partial results...")
-
+            result = {"file_name": plan["file_name"]}
+            planner.fan_out(plan, measurements, result)
+            self.add_metadata(plan, result)
+            result["dedup"] = dedup
+            result["concurrency"] = self.concurrency
+            result["total_time"] = elapsed
+            if tunnel_down:
+                result["tunnel_down"] = True
             self.results.append(result)
 
-    def run_file(self, input_file, result):
-        file_name, file_contents = input_file
+        logging.info("Testing took a total of %d seconds." % elapsed)
 
-        run_start_time = time.time()
+    def parse_file(self, input_file):
+        """
+        Parse an input file into the lists of targets to measure, see
+        centinel.planner.build_plan().
 
-        tcp_connect_inputs = []
-        http_inputs = []
-        tls_inputs = []
-        dns_inputs = []
-        traceroute_inputs = []
-        url_metadata_results = {}
-        file_metadata = {}
-        file_comments = []
-        index_row = None
-
-        # first parse the input and create data structures
-        csvreader = csv.reader(file_contents, delimiter=',', quotechar='"')
-        for row in csvreader:
-            """
-            First few lines are expected to be comments in key: value
-            format. The first line after that could be our column header
-            row, starting with "url", and the rest are data rows.
-            This is a sample input file we're trying to parse:
-
-            # comment: Global List,,,,,
-            # date: 03-17-2015,,,,,
-            # version: 1,,,,,
-            # description: This is the global list. Last updated in 2012.,,,,
-            url,country,category,description,rationale,provider
-            http://8thstreetlatinas.com,glo,PORN,,,PRIV
-            http://abpr2.railfan.net,glo,MISC,Pictures of trains,,PRIV
-
-            """
-
-            # parse file comments, if it looks like "key : value",
-            # parse it as a key-value pair. otherwise, just
-            # store it as a raw comment.
-            if row[0][0] == '#':
-                row = row[0][1:].strip()
-                if len(row.split(':')) > 1:
-                    key, value = row.split(':', 1)
-                    key = key.strip()
-                    value = value.strip()
-                    file_metadata[key] = value
+        :param input_file: (file name, file contents) tuple
+        """
+        file_name, file_contents = input_file
+        cache_dir = None
+        data_dir = getattr(self, "global_constants", {}).get("data_dir")
+        if data_dir is not None:
+            # underscore files are left alone by the data dir sync
+            cache_dir = os.path.join(data_dir, "_plan_cache")
+        return planner.load_plan(file_name, file_contents,
+                                 tls_for_all=self.tls_for_all,
+                                 cache_dir=cache_dir)
+
+    def resume(self, phase, inputs, results, test=None, live=True):
+        """
+        Copy the results the checkpoint has for a phase into results,
+        start checkpointing results as they come in, and return the
+        inputs that still have to be measured.
+
+        :param phase: name of the phase (key in the result)
+        :param inputs: the targets of the phase
+        :param results: the dict the phase stores its results in
+        :param test: the planner test the targets belong to, if it is
+                     not the same as phase
+        :param live: checkpoint results as they come in, otherwise the
+                     caller has to hand them to the checkpoint when
+                     the phase is done
+        """
+        if self.checkpoint is None:
+            return inputs
+        if test is None:
+            test = phase.split(".")[0]
+
+        completed = self.checkpoint.completed(phase)
+        remaining = inputs
+        if len(completed) > 0:
+            remaining = []
+            for target in inputs:
+                key = planner.target_key(test, target)
+                if key in completed:
+                    results[key] = completed[key]
                 else:
-                    file_comments.append(row)
-                continue
-
-            # detect the header row and store it
-            # it is usually the first row and starts with "url,"
-            if row[0].strip().lower() == "url":
-                index_row = row
-                continue
+                    remaining.append(target)
+            logging.info("Checkpoint has results for %d of %d %s "
+                         "targets." % (len(inputs) - len(remaining),
+                                       len(inputs), phase))
+        if live:
+            self.checkpoint.track(phase, results)
+        return remaining
+
+    def measure(self, plan, result):
+        """
+        Run the tests for all targets in a plan and store the results
+        in result, one dict per test.
+        """
+        # copies, the lists are shuffled and filtered below
+        tcp_connect_inputs = list(plan["tcp_connect"])
+        http_inputs = list(plan["http"])
+        tls_inputs = list(plan["tls"])
+        dns_inputs = list(plan["dns"])
+        traceroute_inputs = list(plan["traceroute"])
+        probe_keys = plan["probe_keys"]
+        # shared by all batches, once connectivity is lost for good the
+        # remaining targets are skipped
+        monitor = connectivity.ConnectivityMonitor(canaries=self.canaries,
+                                                   tunnel=self.tunnel)
 
-            url = row[0].strip()
-            if url is None:
-                continue
-
-            meta = row[1:]
-            http_ssl = False
-            ssl_port = 443
-            port = 80
-
-            # parse the URL to extract netlocation, HTTP path, domain name,
-            # and HTTP method (SSL or plain)
-            try:
-                urlparse_object = urlparse.urlparse(url)
-                http_netloc = urlparse_object.netloc
-
-                # if netloc is not urlparse-able, add // to the start
-                # of URL
-                if http_netloc == '':
-                    urlparse_object = urlparse.urlparse('//%s' % url)
-                    http_netloc = urlparse_object.netloc
-
-                domain_name = http_netloc.split(':')[0]
-
-                http_path = urlparse_object.path
-                if http_path == '':
-                    http_path = '/'
-
-                # we assume scheme is either empty, or "http", or "https"
-                # other schemes (e.g. "ftp") are out of the scope of this
-                # measuremnt
-                if urlparse_object.scheme == "https":
-                    http_ssl = True
-                    if len(http_netloc.split(':')) == 2:
-                        ssl_port = http_netloc.split(':')[1]
-
-                if len(http_netloc.split(':')) == 2:
-                    port = int(http_netloc.split(':')[1])
-
-            except Exception as exp:
-                logging.exception("%s: failed to parse URL: %s" % (url, exp))
-                http_netloc = url
-                http_ssl = False
-                port = 80
-                ssl_port = 443
-                http_path = '/'
-                domain_name = url
-
-            # TCP connect
-            if http_ssl:
-                if (domain_name, ssl_port) not in tcp_connect_inputs:
-                    tcp_connect_inputs.append((domain_name, ssl_port))
-            else:
-                if (domain_name, port) not in tcp_connect_inputs:
-                    tcp_connect_inputs.append((domain_name, port))
-
-
-            # HTTP GET
-            http_inputs.append({"host": http_netloc,
-                                "path": http_path,
-                                "ssl": http_ssl,
-                                "url": url})
-
-            # TLS certificate
-            # this will only work if the URL starts with https://, or
-            # if tls_for_all config parameter is set
-            if self.tls_for_all or http_ssl:
-                key = "%s:%s" % (domain_name, ssl_port)
-                if key not in tls_inputs:
-                    tls_inputs.append(key)
-
-            # DNS Lookup
-            if domain_name not in dns_inputs:
-                dns_inputs.append(domain_name)
-
-            # Traceroute
-            if domain_name not in traceroute_inputs:
-                traceroute_inputs.append(domain_name)
+        # the actual tests are run concurrently here
 
-            # Meta-data
-            url_metadata_results[url] = meta
+        if self.combined_probe:
+            self.check_tunnel()
+            shuffle(http_inputs)
+            http_inputs = planner.prioritize("http", http_inputs,
+                                             self.priorities)
+            start = time.time()
+            logging.info("Running combined TCP/TLS/HTTP probes...")
+            probe_results = {}
+            result["tcp_connect"] = {}
+            result["tls"] = {}
+            result["http"] = {}
+            # sharded runs checkpoint the HTTP results of the probes
+            http_inputs = self.resume("http", http_inputs, result["http"],
+                                      live=False)
+            http_inputs = self.resume("probe", http_inputs, probe_results,
+                                      "http")
+            controller = ConcurrencyController(maximum=self.max_threads)
+            probe.probe_batch(http_inputs, results=probe_results,
+                              max_threads=self.max_threads,
+                              blob_store=self.blob_store,
+                              body_policy=self.http_body_policy,
+                              monitor=monitor, deadline=self.deadline,
+                              controller=controller)
+            self.record_concurrency("probe", controller)
+            for url, probe_result in probe_results.items():
+                if url not in probe_keys:
+                    continue
+                if connectivity.is_skipped(probe_result):
+                    result["http"][url] = probe_result
+                    continue
+                tcp_key, tls_key = probe_keys[url]
+                result["http"][url] = probe_result["http"]
+                if tcp_key not in result["tcp_connect"]:
+                    result["tcp_connect"][tcp_key] = probe_result["tcp_connect"]
+                if (tls_key is not None and "tls" in probe_result and
+                        tls_key not in result["tls"]):
+                    result["tls"][tls_key] = probe_result["tls"]
+            if "error" in probe_results:
+                result["http"]["error"] = probe_results["error"]
+
+            # only measure what the probes did not cover
+            tcp_connect_inputs = [(host, port) for host, port in tcp_connect_inputs
+                                  if "%s:%s" % (host, port) not in result["tcp_connect"]]
+            tls_inputs = [key for key in tls_inputs
+                          if key not in result["tls"]]
 
-        # the actual tests are run concurrently here
+            elapsed = time.time() - start
+            logging.info("Combined probes took "
+                         "%d seconds for %d URLs." % (elapsed,
+                                                      len(http_inputs)))
 
         if tcp_connect is not None:
+            self.check_tunnel()
             shuffle(tcp_connect_inputs)
+            tcp_connect_inputs = planner.prioritize("tcp_connect",
+                                                    tcp_connect_inputs,
+                                                    self.priorities)
             start = time.time()
             logging.info("Running TCP connect tests...")
-            result["tcp_connect"] = {}
-            tcp_connect.tcp_connect_batch(tcp_connect_inputs, results=result["tcp_connect"])
+            if "tcp_connect" not in result:
+                result["tcp_connect"] = {}
+            tcp_connect_inputs = self.resume("tcp_connect", tcp_connect_inputs,
+                                             result["tcp_connect"])
+            controller = ConcurrencyController(maximum=self.max_threads)
+            tcp_connect.tcp_connect_batch(tcp_connect_inputs, results=result["tcp_connect"],
+                                          max_threads=self.max_threads,
+                                          monitor=monitor, deadline=self.deadline,
+                                          controller=controller)
+            self.record_concurrency("tcp_connect", controller)
             elapsed = time.time() - start
             logging.info("Running TCP requests took "
                          "%d seconds for %d hosts and ports." % (elapsed,
                                                       len(tcp_connect_inputs)))
 
-        shuffle(http_inputs)
-        start = time.time()
-        logging.info("Running HTTP GET requests...")
-        result["http"] = {}
+        if not self.combined_probe:
+            self.check_tunnel()
+            shuffle(http_inputs)
+            http_inputs = planner.prioritize("http", http_inputs,
+                                             self.priorities)
+            start = time.time()
+            logging.info("Running HTTP GET requests...")
+            result["http"] = {}
+            http_inputs = self.resume("http", http_inputs, result["http"])
 
-        try:
-            http.get_requests_batch(http_inputs, results=result["http"])
-        # backward-compatibility with verions that don't support this
-        except TypeError:
-            result["http"] = http.get_requests_batch(http_inputs)
+            controller = ConcurrencyController(maximum=self.max_threads)
+            try:
+                http.get_requests_batch(http_inputs, results=result["http"],
+                                        max_threads=self.max_threads,
+                                        blob_store=self.blob_store,
+                                        body_policy=self.http_body_policy,
+                                        monitor=monitor,
+                                        deadline=self.deadline,
+                                        controller=controller)
+            # backward-compatibility with verions that don't support this
+            except TypeError:
+                result["http"] = http.get_requests_batch(http_inputs)
+            self.record_concurrency("http", controller)
 
-        elapsed = time.time() - start
-        logging.info("HTTP GET requests took "
-                     "%d seconds for %d URLs." % (elapsed,
-                                                  len(http_inputs)))
+            elapsed = time.time() - start
+            logging.info("HTTP GET requests took "
+                         "%d seconds for %d URLs." % (elapsed,
+                                                      len(http_inputs)))
+        self.check_tunnel()
         shuffle(tls_inputs)
+        tls_inputs = planner.prioritize("tls", tls_inputs, self.priorities)
         start = time.time()
         logging.info("Running TLS certificate requests...")
-        result["tls"] = {}
+        if "tls" not in result:
+            result["tls"] = {}
+        tls_inputs = self.resume("tls", tls_inputs, result["tls"])
 
+        controller = ConcurrencyController(maximum=self.max_handshakes)
         try:
-            tls.get_fingerprint_batch(tls_inputs, results=result["tls"])
+            tls.get_fingerprint_batch(tls_inputs, results=result["tls"],
+                                      max_concurrent=self.max_handshakes,
+                                      blob_store=self.blob_store,
+                                      monitor=monitor,
+                                      deadline=self.deadline,
+                                      controller=controller)
         # backward-compatibility with verions that don't support this
         except TypeError:
             result["tls"] = tls.get_fingerprint_batch(tls_inputs)
+        self.record_concurrency("tls", controller)
 
         elapsed = time.time() - start
         logging.info("TLS certificate requests took "
                      "%d seconds for %d domains." % (elapsed,
                                                      len(tls_inputs)))
+        self.check_tunnel()
         shuffle(dns_inputs)
+        dns_inputs = planner.prioritize("dns", dns_inputs, self.priorities)
         start = time.time()
         logging.info("Running DNS requests...")
         result["dns"] = {}
+        # lookup results are filled in one nameserver at a time, so
+        # they are only checkpointed once all lookups are done
+        dns_inputs = self.resume("dns", dns_inputs, result["dns"], live=False)
+        controller = ConcurrencyController(maximum=self.max_threads)
         if len(self.exclude_nameservers) > 0:
             logging.info("Excluding nameservers: %s" % ", ".join(self.exclude_nameservers))
 
             try:
                 dnslib.lookup_domains(dns_inputs, results=result["dns"],
-                                      exclude_nameservers=self.exclude_nameservers)
+                                      exclude_nameservers=self.exclude_nameservers,
+                                      monitor=monitor, deadline=self.deadline,
+                                      controller=controller)
             # backward-compatibility with verions that don't support this
             except TypeError:
                 result["dns"] = dnslib.lookup_domains(dns_inputs,
                         exclude_nameservers=self.exclude_nameservers)
         else:
             try:
-                dnslib.lookup_domains(dns_inputs, results=result["dns"])
+                dnslib.lookup_domains(dns_inputs, results=result["dns"],
+                                      monitor=monitor, deadline=self.deadline,
+                                      controller=controller)
             # backward-compatibility with verions that don't support this
             except TypeError:
                 result["dns"] = dnslib.lookup_domains(dns_inputs)
+        self.record_concurrency("dns", controller)
+
+        if self.checkpoint is not None:
+            self.checkpoint.update("dns", result["dns"])
 
         elapsed = time.time() - start
         logging.info("DNS requests took "
@@ -283,21 +415,106 @@ class BaselineExperiment(Experiment):
                                                      len(dns_inputs)))
 
         for method in self.traceroute_methods:
+            self.check_tunnel()
+            if monitor.aborted:
+                # traceroutes are left to the next run with the rest
+                logging.warn("Connectivity lost, skipping %s "
+                             "traceroutes." % method.upper())
+                continue
             shuffle(traceroute_inputs)
+            traceroute_inputs = planner.prioritize("traceroute",
+                                                   traceroute_inputs,
+                                                   self.priorities)
             start = time.time()
             logging.info("Running %s traceroutes..." % (method.upper()))
             result["traceroute.%s" % method] = {}
+            method_inputs = self.resume("traceroute.%s" % method,
+                                        traceroute_inputs,
+                                        result["traceroute.%s" % method])
 
+            controller = ConcurrencyController(maximum=self.max_threads)
             try:
-                traceroute.traceroute_batch(traceroute_inputs, results=result["traceroute.%s" % method], method=method)
+                traceroute.traceroute_batch(method_inputs, results=result["traceroute.%s" % method], method=method,
+                                            max_threads=self.max_threads,
+                                            deadline=self.deadline,
+                                            controller=controller)
             # backward-compatibility with verions that don't support this
             except TypeError:
-                result["traceroute.%s" % method] = traceroute.traceroute_batch(traceroute_inputs, method)
+                result["traceroute.%s" % method] = traceroute.traceroute_batch(method_inputs, method)
+            self.record_concurrency("traceroute.%s" % method, controller)
 
             elapsed = time.time() - start
             logging.info("Traceroutes took %d seconds for %d "
                          "domains." % (elapsed, len(traceroute_inputs)))
 
+    def record_concurrency(self, phase, controller):
+        """
+        Keep the limits a batch went through for the results.
+        """
+        stats = controller.stats()
+        logging.info("%s ran with up to %d targets in flight (%d "
+                     "backoffs), finishing at %d." % (phase, stats["highest"],
+                                                      stats["decreases"],
+                                                      stats["final"]))
+        self.concurrency.setdefault(phase, []).append(stats)
+
+    def measure_sharded(self, plan, result):
+        """
+        Split the plan into shards and measure them in worker
+        processes, merging their results into result as they finish.
+        """
+        shards = planner.shard_plan(plan, self.processes)
+        logging.info("Measuring %d shards in %d processes..." % (len(shards),
+                                                                 self.processes))
+        # the workers are forked, they get the experiment from here.
+        # the checkpoint they see is a copy without a file or a lock
+        # that might be held by the flushing thread
+        global _sharded_experiment
+        checkpoint = self.checkpoint
+        if checkpoint is not None:
+            self.checkpoint = checkpoint.snapshot()
+        _sharded_experiment = self
+        pool = multiprocessing.Pool(self.processes, initializer=_init_worker)
+
+        try:
+            shard_results = pool.imap_unordered(_measure_shard, shards)
+            for finished in range(len(shards)):
+                while True:
+                    try:
+                        # a timeout keeps this interruptible
+                        shard_result, concurrency = shard_results.next(1)
+                        break
+                    except multiprocessing.TimeoutError:
+                        self.check_tunnel()
+                        continue
+                for name, results in shard_result.items():
+                    if name not in result:
+                        result[name] = {}
+                    result[name].update(results)
+                    if checkpoint is not None:
+                        checkpoint.update(name, results)
+                for phase, stats in concurrency.items():
+                    self.concurrency.setdefault(phase, []).extend(stats)
+                logging.info("%d/%d shards done." % (finished + 1, len(shards)))
+            pool.close()
+        except:
+            # whatever went wrong (an interrupt, the tunnel, an error in
+            # a shard), the workers must not outlive it and the pool has
+            # to be closed or terminated before it can be joined
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.checkpoint = checkpoint
+            _sharded_experiment = None
+            # the workers wrote to the blob store directory directly
+            if self.blob_store is not None:
+                self.blob_store.refresh()
+
+    def add_metadata(self, plan, result):
+        url_metadata_results = plan["url_metadata"]
+        index_row = plan["index_row"]
+
         # if we have an index row, we should turn URL metadata
         # into dictionaries
         if index_row is not None:
@@ -314,10 +531,26 @@ class BaselineExperiment(Experiment):
             url_metadata_results = indexed_url_metadata
 
         result["url_metadata"] = url_metadata_results
-        result["file_metadata"] = file_metadata
-        result["file_comments"] = file_comments
+        result["file_metadata"] = plan["file_metadata"]
+        result["file_comments"] = plan["file_comments"]
 
-        run_finish_time = time.time()
-        elapsed = run_finish_time - run_start_time
-        result["total_time"] = elapsed
-        logging.info("Testing took a total of %d seconds." % elapsed)
+
+# set in the parent right before the worker processes are forked
+_sharded_experiment = None
+
+
+def _init_worker():
+    # the parent takes care of interrupts, and must be the only one
+    # to write the checkpoint in the client's signal handler
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _measure_shard(shard):
+    # the parent watches the tunnel, the copy here does not follow it
+    _sharded_experiment.tunnel = None
+    # only this shard's batches
+    _sharded_experiment.concurrency = {}
+    result = {}
+    _sharded_experiment.measure(shard, result)
+    return result, _sharded_experiment.concurrency
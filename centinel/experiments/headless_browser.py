@@ -4,11 +4,37 @@ from centinel.experiment import Experiment
 
 class HeadlessBrowserExperiment(Experiment):
     name = "headless_browser"
+    # number of browsers crawling in parallel, each on its own
+    # virtual display
+    workers = 1
+    # pages a browser loads before it is restarted
+    pages_per_worker = 50
+    # how much of each response body in the HAR files to keep, see
+    # centinel.primitives.http_helper.BodyCapture. None keeps
+    # everything.
+    body_policy = None
+    # block images, media, fonts and plugins and only wait for the DOM
+    # of each page
+    fast_crawl = False
 
     def __init__(self, input_files):
             self.input_files = input_files
             self.results = []
 
+            if self.params is not None:
+                if "workers" in self.params:
+                    self.workers = self.params['workers']
+                if "pages_per_worker" in self.params:
+                    self.pages_per_worker = self.params['pages_per_worker']
+                if "body_policy" in self.params:
+                    self.body_policy = self.params['body_policy']
+                if "fast_crawl" in self.params:
+                    self.fast_crawl = self.params['fast_crawl']
+
     def run(self):
-        hb = HeadlessBrowser()
+        hb = HeadlessBrowser(blob_store=self.blob_store,
+                             workers=self.workers,
+                             pages_per_worker=self.pages_per_worker,
+                             body_policy=self.body_policy,
+                             fast=self.fast_crawl)
         self.results = hb.run(input_files=self.input_files)
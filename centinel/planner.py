@@ -0,0 +1,398 @@
+#
+# planner.py: turns baseline input lists into the lists of targets
+# each test has to measure.
+#
+# Input lists can have tens of thousands of rows, so every row is
+# parsed once and targets are deduplicated with ordered sets instead
+# of list lookups. Compiled plans are cached on disk, keyed by the
+# hash of the input file, so an unchanged list is only parsed the
+# first time it is used.
+
+from collections import OrderedDict
+import csv
+import glob
+import hashlib
+import logging
+import marshal
+import os
+import re
+import sys
+import tempfile
+import urlparse
+import zlib
+
+# bump this whenever the format of a plan changes, it invalidates
+# all cached plans
+PLAN_VERSION = 1
+
+# the tests that take a list of targets, in the order they are run
+PLAN_TESTS = ["tcp_connect", "http", "tls", "dns", "traceroute"]
+
+
+def parse_url(url):
+    """
+    Split a URL from an input list into the parts the tests need.
+
+    :return: (netloc, domain name, path, ssl, port, ssl port)
+    """
+    http_ssl = False
+    ssl_port = 443
+    port = 80
+
+    # parse the URL to extract netlocation, HTTP path, domain name,
+    # and HTTP method (SSL or plain)
+    try:
+        urlparse_object = urlparse.urlparse(url)
+        http_netloc = urlparse_object.netloc
+
+        # if netloc is not urlparse-able, add // to the start
+        # of URL
+        if http_netloc == '':
+            urlparse_object = urlparse.urlparse('//%s' % url)
+            http_netloc = urlparse_object.netloc
+
+        domain_name = http_netloc.split(':')[0]
+
+        http_path = urlparse_object.path
+        if http_path == '':
+            http_path = '/'
+
+        # we assume scheme is either empty, or "http", or "https"
+        # other schemes (e.g. "ftp") are out of the scope of this
+        # measuremnt
+        if urlparse_object.scheme == "https":
+            http_ssl = True
+            if len(http_netloc.split(':')) == 2:
+                ssl_port = http_netloc.split(':')[1]
+
+        if len(http_netloc.split(':')) == 2:
+            port = int(http_netloc.split(':')[1])
+
+    except Exception as exp:
+        logging.exception("%s: failed to parse URL: %s" % (url, exp))
+        http_netloc = url
+        http_ssl = False
+        port = 80
+        ssl_port = 443
+        http_path = '/'
+        domain_name = url
+
+    return http_netloc, domain_name, http_path, http_ssl, port, ssl_port
+
+
+def build_plan(file_name, rows, tls_for_all=True):
+    """
+    Parse the rows of an input file into the targets of each test.
+
+    :param file_name: name of the input file
+    :param rows: iterable of lines of the input file
+    :param tls_for_all: fetch certificates for http:// URLs too
+    :return: a plan, i.e. a dict with the targets of each test
+             ("tcp_connect", "http", "tls", "dns", "traceroute")
+             and the metadata of the file
+    """
+    # ordered sets, only the keys are used
+    tcp_connect_inputs = OrderedDict()
+    tls_inputs = OrderedDict()
+    dns_inputs = OrderedDict()
+    http_inputs = []
+    url_metadata_results = {}
+    # (tcp_connect key, tls key) covered by the combined probe
+    # for each URL
+    probe_keys = {}
+    file_metadata = {}
+    file_comments = []
+    index_row = None
+
+    csvreader = csv.reader(rows, delimiter=',', quotechar='"')
+    for row in csvreader:
+        """
+        First few lines are expected to be comments in key: value
+        format. The first line after that could be our column header
+        row, starting with "url", and the rest are data rows.
+        This is a sample input file we're trying to parse:
+
+        # comment: Global List,,,,,
+        # date: 03-17-2015,,,,,
+        # version: 1,,,,,
+        # description: This is the global list. Last updated in 2012.,,,,
+        url,country,category,description,rationale,provider
+        http://8thstreetlatinas.com,glo,PORN,,,PRIV
+        http://abpr2.railfan.net,glo,MISC,Pictures of trains,,PRIV
+
+        """
+        if not row or not row[0]:
+            continue
+
+        # parse file comments, if it looks like "key : value",
+        # parse it as a key-value pair. otherwise, just
+        # store it as a raw comment.
+        if row[0][0] == '#':
+            row = row[0][1:].strip()
+            if len(row.split(':')) > 1:
+                key, value = row.split(':', 1)
+                key = key.strip()
+                value = value.strip()
+                file_metadata[key] = value
+            else:
+                file_comments.append(row)
+            continue
+
+        # detect the header row and store it
+        # it is usually the first row and starts with "url,"
+        if row[0].strip().lower() == "url":
+            index_row = row
+            continue
+
+        url = row[0].strip()
+        meta = row[1:]
+
+        if url in url_metadata_results:
+            # repeated row, the targets are in already
+            url_metadata_results[url] = meta
+            continue
+
+        http_netloc, domain_name, http_path, http_ssl, port, ssl_port = \
+            parse_url(url)
+
+        # TCP connect
+        if http_ssl:
+            tcp_connect_inputs[(domain_name, ssl_port)] = None
+            probe_keys[url] = ("%s:%s" % (domain_name, ssl_port),
+                               "%s:%s" % (domain_name, ssl_port))
+        else:
+            tcp_connect_inputs[(domain_name, port)] = None
+            probe_keys[url] = ("%s:%s" % (domain_name, port), None)
+
+        # HTTP GET
+        http_inputs.append({"host": http_netloc,
+                            "path": http_path,
+                            "ssl": http_ssl,
+                            "url": url})
+
+        # TLS certificate
+        # this will only work if the URL starts with https://, or
+        # if tls_for_all config parameter is set
+        if tls_for_all or http_ssl:
+            tls_inputs["%s:%s" % (domain_name, ssl_port)] = None
+
+        # DNS Lookup and traceroute
+        dns_inputs[domain_name] = None
+
+        # Meta-data
+        url_metadata_results[url] = meta
+
+    return {"file_name": file_name,
+            "tcp_connect": list(tcp_connect_inputs),
+            "http": http_inputs,
+            "tls": list(tls_inputs),
+            "dns": list(dns_inputs),
+            "traceroute": list(dns_inputs),
+            "probe_keys": probe_keys,
+            "url_metadata": url_metadata_results,
+            "file_metadata": file_metadata,
+            "file_comments": file_comments,
+            "index_row": index_row}
+
+
+def _cache_prefix(cache_dir, file_name):
+    safe_name = re.sub(r"[^\w.-]", "_", os.path.basename(file_name))
+    return os.path.join(cache_dir, safe_name)
+
+
+def _load_cached_plan(path):
+    with open(path, 'rb') as cache_file:
+        return marshal.load(cache_file)
+
+
+def _store_plan(path, plan):
+    cache_dir = os.path.dirname(path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first so that a crash never leaves
+    # a half written plan behind
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'wb') as cache_file:
+        marshal.dump(plan, cache_file)
+    os.rename(temp_path, path)
+
+
+def load_plan(file_name, file_contents, tls_for_all=True, cache_dir=None):
+    """
+    Returns the plan for an input file, from the cache if the file
+    has not changed since it was last compiled.
+
+    :param file_name: name of the input file
+    :param file_contents: open input file, or a list of lines
+    :param tls_for_all: fetch certificates for http:// URLs too
+    :param cache_dir: directory to cache plans in, None disables
+                      caching
+    """
+    if hasattr(file_contents, "read"):
+        data = file_contents.read()
+    else:
+        data = "\n".join(line.rstrip("\r\n") for line in file_contents)
+
+    if cache_dir is None:
+        return build_plan(file_name, data.splitlines(), tls_for_all)
+
+    key = hashlib.sha256()
+    # marshal files are only readable by the same python version
+    key.update("%d:%s:%s:" % (PLAN_VERSION, sys.version, tls_for_all))
+    key.update(data)
+    prefix = _cache_prefix(cache_dir, file_name)
+    path = "%s.%s.plan" % (prefix, key.hexdigest())
+
+    if os.path.exists(path):
+        try:
+            plan = _load_cached_plan(path)
+            logging.debug("Loaded cached plan for %s." % file_name)
+            return plan
+        except Exception as exp:
+            logging.warning("Failed to load cached plan for "
+                            "%s: %s" % (file_name, exp))
+
+    plan = build_plan(file_name, data.splitlines(), tls_for_all)
+    try:
+        # plans of older versions of this list are of no use any more
+        for old_path in glob.glob("%s.*.plan" % prefix):
+            os.remove(old_path)
+        _store_plan(path, plan)
+    except Exception as exp:
+        logging.warning("Failed to cache plan for %s: %s" % (file_name, exp))
+    return plan
+
+
+def target_key(test, target):
+    """
+    Returns the key the result of a test for a target is stored under.
+    """
+    if test == "tcp_connect":
+        return "%s:%s" % target
+    elif test == "http":
+        return target["url"]
+    return target
+
+
+def _plan_keys(plan, test):
+    """
+    Returns the keys the results of a test are stored under for the
+    targets of a plan.
+    """
+    return [target_key(test, target) for target in plan[test]]
+
+
+def priorities(plans):
+    """
+    Rank the targets of each test by importance, for when there is
+    not enough time to measure all of them. Targets that more input
+    files ask for come first, then the targets of earlier input files
+    (the country list comes before the world list).
+
+    :return: {test: {key: rank}}, lower ranks are more important
+    """
+    ranks = {}
+    for test in PLAN_TESTS:
+        counts = {}
+        first = {}
+        for index, plan in enumerate(plans):
+            for key in _plan_keys(plan, test):
+                counts[key] = counts.get(key, 0) + 1
+                first.setdefault(key, index)
+        ranks[test] = dict((key, (-counts[key], first[key]))
+                           for key in counts)
+    return ranks
+
+
+def prioritize(test, targets, ranks):
+    """
+    Sort targets by the ranks from priorities(), targets of the same
+    rank keep their order.
+    """
+    test_ranks = ranks.get(test.split(".")[0], {})
+    last = (0, sys.maxint)
+    return sorted(targets,
+                  key=lambda target: test_ranks.get(target_key(test, target), last))
+
+
+def merge_plans(plans):
+    """
+    Merge the plans of several input files into one, with each target
+    showing up only once.
+    """
+    combined = {"probe_keys": {}}
+    for test in PLAN_TESTS:
+        combined[test] = []
+        seen = set()
+        for plan in plans:
+            for key, target in zip(_plan_keys(plan, test), plan[test]):
+                if key in seen:
+                    continue
+                seen.add(key)
+                combined[test].append(target)
+    for plan in plans:
+        combined["probe_keys"].update(plan["probe_keys"])
+    return combined
+
+
+def dedup_stats(plans, combined):
+    """
+    Number of targets the input files asked for and the number of
+    targets actually measured, per test.
+    """
+    stats = {"input_files": [plan["file_name"] for plan in plans],
+             "requested": {},
+             "measured": {}}
+    for test in PLAN_TESTS:
+        stats["requested"][test] = sum(len(plan[test]) for plan in plans)
+        stats["measured"][test] = len(combined[test])
+    return stats
+
+
+def fan_out(plan, measurements, result):
+    """
+    Copy the results of the targets of one input file from the
+    combined measurements into that file's result.
+    """
+    for name, measured in measurements.items():
+        test = name.split(".")[0]
+        if test not in PLAN_TESTS:
+            continue
+        result[name] = {}
+        for key in _plan_keys(plan, test):
+            if key in measured:
+                result[name][key] = measured[key]
+        # errors are about the whole batch
+        if "error" in measured:
+            result[name]["error"] = measured["error"]
+
+
+def _target_domain(test, target):
+    if test == "tcp_connect":
+        return target[0]
+    elif test == "http":
+        return target["host"].split(":")[0]
+    elif test == "tls":
+        return target.rsplit(":", 1)[0]
+    return target
+
+
+def shard_plan(plan, shards):
+    """
+    Split a plan into (at most) shards plans. All targets of a domain
+    go to the same shard, so that e.g. the combined probe of a URL and
+    the TCP connect test of its host are done by the same worker.
+    """
+    plans = []
+    for i in range(shards):
+        plans.append({"probe_keys": plan["probe_keys"]})
+        for test in PLAN_TESTS:
+            plans[i][test] = []
+    for test in PLAN_TESTS:
+        for target in plan[test]:
+            domain = _target_domain(test, target)
+            # crc32 instead of hash(), it is the same in every process
+            index = (zlib.crc32(domain) & 0xffffffff) % shards
+            plans[index][test].append(target)
+    return [shard for shard in plans
+            if any(len(shard[test]) > 0 for test in PLAN_TESTS)]
@@ -8,6 +8,11 @@ import socket
 import threading
 import time
 
+from centinel.concurrency import ConcurrencyController
+from centinel.connectivity import (ConnectivityMonitor, OUT_OF_TIME,
+                                   skip_reason, skipped)
+from centinel.deadline import Deadline, join_all
+
 
 def get_ips(host, nameserver=None, record="A"):
     nameservers = []
@@ -25,10 +30,12 @@ def lookup_domain(domain, nameservers=[], rtype="A",
 
 
 def lookup_domains(domains, results={}, nameservers=[], exclude_nameservers=[],
-                   rtype="A", timeout=2):
+                   rtype="A", timeout=2, monitor=None, deadline=None,
+                   controller=None):
     dns_exp = DNSQuery(domains=domains, results=results, nameservers=nameservers, 
                        rtype=rtype, exclude_nameservers=exclude_nameservers, 
-                       timeout=timeout)
+                       timeout=timeout, monitor=monitor, deadline=deadline,
+                       controller=controller)
     return dns_exp.lookup_domains()
 
 
@@ -41,15 +48,32 @@ class DNSQuery:
     """Class to store state for all of the DNS queries"""
 
     def __init__(self, domains=[], results={}, nameservers=[], exclude_nameservers=[],
-                 rtype="A", timeout=10, max_threads=100):
+                 rtype="A", timeout=10, max_threads=100, monitor=None,
+                 deadline=None, controller=None):
         """Constructor for the DNS query class
 
         Params:
         nameserver- the nameserver to use, defaults to the local resolver
         rtype- the record type to lookup (as text), by default A
         timeout- how long to wait for a response, by default 10 seconds
+        monitor- centinel.connectivity.ConnectivityMonitor shared with
+                 the other batches of the run, if any
+        deadline- centinel.deadline.Deadline of the run, lookups left
+                  when it passes are skipped
+        controller- centinel.concurrency.ConcurrencyController that sets
+                    the number of lookups in flight, one capped at
+                    max_threads is used if None
 
         """
+        if monitor is None:
+            monitor = ConnectivityMonitor()
+        self.monitor = monitor
+        if deadline is None:
+            deadline = Deadline()
+        self.deadline = deadline
+        if controller is None:
+            controller = ConcurrencyController(maximum=max_threads)
+        self.controller = controller
         self.domains = domains
         self.results = results
         self.rtype = rtype
@@ -112,21 +136,25 @@ class DNSQuery:
         thread_wait_timeout = 200
         ind = 1
         total_item_count = len(self.domains)
+        lookup = self.controller.watch(
+            self.monitor.watch(self.lookup_domain, _lookup_failure),
+            _lookup_failure)
         for domain in self.domains:
             for nameserver in self.nameservers:
-                wait_time = 0
-                while threading.active_count() > self.max_threads:
-                    time.sleep(1)
-                    wait_time += 1
-                    if wait_time > thread_wait_timeout:
+                reason = skip_reason(self.monitor, self.deadline)
+                if (reason is None and not self.controller.acquire(
+                        self.deadline.cap(thread_wait_timeout))):
+                    if not self.deadline.expired():
+                        self.results["error"] = "Threads took too long to finish."
                         thread_error = True
                         break
-
-                if thread_error:
-                    self.results["error"] = "Threads took too long to finish."
-                    break
+                    reason = OUT_OF_TIME
+                if reason is not None:
+                    self.results.setdefault(domain, []).append(
+                        skipped(reason, domain=domain, nameserver=nameserver))
+                    continue
                 log_prefix = "%d/%d: " % (ind, total_item_count)
-                thread = threading.Thread(target=self.lookup_domain,
+                thread = threading.Thread(target=lookup,
                                           args=(domain, nameserver,
                                                 log_prefix))
                 thread.setDaemon(1)
@@ -136,8 +164,8 @@ class DNSQuery:
                 break
             ind += 1
 
-        for thread in self.threads:
-            thread.join(self.timeout * 3)
+        join_all(self.threads, self.timeout * 3, self.deadline)
+        self.monitor.finish(self.results)
         return self.results
 
     def lookup_domain(self, domain, nameserver=None, log_prefix=''):
@@ -245,6 +273,13 @@ class DNSQuery:
         return results
 
 
+def _lookup_failure(result):
+    # no answer at all from the nameserver
+    if "response1" in result and result["response1"] is None:
+        return "timed out"
+    return None
+
+
 def parse_out_ips(message):
     """Given a message, parse out the ips in the answer"""
 
@@ -1,10 +1,8 @@
 __author__ = 'rishabn'
 
 import time
-import signal
-import errno
-import os
-from functools import wraps
+
+from foctor_deadline import TimeoutError as LocalTimeoutError, check_deadline, timeout
 
 from selenium.common.exceptions import StaleElementReferenceException, ElementNotSelectableException, \
     NoSuchElementException, ElementNotVisibleException, TimeoutException
@@ -362,28 +360,7 @@ def fill_all_password(driver, password, clicks):
     return ret_rec, clicks
 
 
-def local_timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise LocalTimeoutError(error_message)
-
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
-        return wraps(func)(wrapper)
-    return decorator
-
-
-class LocalTimeoutError(Exception):
-    pass
-
-
-@local_timeout(60)
+@timeout(60, on_timeout=lambda error: None)
 def find_element_by_record(driver, record):
     incomplete = 0
     if any(c.isalpha() for c in record['id']):
@@ -403,6 +380,7 @@ def find_element_by_record(driver, record):
             return None
         for e in elements:
             try:
+                check_deadline()
                 r = get_record(e, record['tag'])
                 if (r['text'].split("\n")[0] == record['text']) and (r['name'].split("\n")[0] == record['name']):
                     return e
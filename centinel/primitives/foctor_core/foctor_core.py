@@ -1,11 +1,11 @@
 __author__ = 'rishabn'
 
-import signal
-import errno
 import sys
 import logging
 
+from foctor_deadline import TimeoutError, check_deadline, timeout, wait_for_driver
 from foctor_misc import *
+from foctor_profile import clone_profile
 from foctor_search import *
 from foctor_authentication import *
 
@@ -22,11 +22,18 @@ from selenium.webdriver.common.by import By
 from httplib import CannotSendRequest
 from selenium.common.exceptions import StaleElementReferenceException
 
-from functools import wraps
 from pyvirtualdisplay import Display
 
+# seconds to wait for a call that timed out to let go of the driver
+# before closing it
+ABANDONED_GRACE = 10
+
 
 def teardown_driver(driver_, display_, display_mode):
+    # a call that timed out may still be talking to the driver
+    if not wait_for_driver(driver_, ABANDONED_GRACE):
+        logging.warning("Closing the driver while a call that timed out "
+                        "is still running")
     driver_.close()
     if display_mode == 0:
         display_.stop()
@@ -42,25 +49,15 @@ def timing(f):
     return wrap
 
 
-class TimeoutError(Exception):
-    pass
-
-
-def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_message)
-
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
-        return wraps(func)(wrapper)
-    return decorator
+def timed_out(name):
+    """
+    on_timeout handler for the functions below that report timeouts
+    as "Timed-out"
+    """
+    def handler(error):
+        logging.warning("%s() timed out" % name)
+        return "Timed-out"
+    return handler
 
 
 def read_site_list(site_list_file, start_index, end_index, login_mode=False):
@@ -78,13 +75,14 @@ def read_site_list(site_list_file, start_index, end_index, login_mode=False):
     return sites
 
 
-@timeout(10)
+@timeout(10, on_timeout=timed_out("save_screenshot"))
 def save_screenshot(driver, filename, path):
     make_folder(path)
     ss_path = path + str(filename) + ".png"
     done = False
     while done is False:
         try:
+            check_deadline()
             driver.save_screenshot(ss_path)
             done = True
         except CannotSendRequest:
@@ -96,7 +94,7 @@ def save_screenshot(driver, filename, path):
     return "No Error"
 
 
-@timeout(10)
+@timeout(10, on_timeout=timed_out("save_html"))
 def save_html(driver, filename, path):
     make_folder(path)
     html_path = path + str(filename) + ".html"
@@ -104,6 +102,7 @@ def save_html(driver, filename, path):
     done = False
     while done is False:
         try:
+            check_deadline()
             f.write(driver.page_source.encode("UTF-8"))
             done = True
         except CannotSendRequest:
@@ -111,12 +110,13 @@ def save_html(driver, filename, path):
             time.sleep(1)
         except (TimeoutError, TimeoutException):
             logging.warning("save_html() timed out")
+            f.close()
             return "Timed-out"
     f.close()
     return "No Error"
 
 
-@timeout(60)
+@timeout(60, on_timeout=lambda error: "Timed-out")
 def wait_for_ready_state(driver, time_, state):
     time.sleep(1)
     try:
@@ -126,7 +126,14 @@ def wait_for_ready_state(driver, time_, state):
 
 
 def setup_profile(tor=False, port="9000", firebug=True, netexport=True, noscript=False, capture_path="", cache_enabled=True):
-    profile = webdriver.FirefoxProfile()
+    extensions = []
+    if firebug is True:
+        extensions.append("./extensions/firebug-2.0.8.xpi")
+    if netexport is True:
+        extensions.append("./extensions/netExport-0.9b7.xpi")
+    if noscript is True:
+        extensions.append("./extensions/noscript-2.6.9.3.xpi")
+    profile = clone_profile(extensions)
     profile.set_preference("app.update.enabled", False)
     if tor is True:
         profile.set_preference('network.proxy.type', 1)
@@ -139,7 +146,6 @@ def setup_profile(tor=False, port="9000", firebug=True, netexport=True, noscript
         profile.set_preference("network.http.use-cache", False)
         profile.set_preference("browser.cache.disk_cache_ssl", False)
     if firebug is True:
-        profile.add_extension("./extensions/firebug-2.0.8.xpi")
         profile.set_preference("extensions.firebug.currentVersion", "2.0.8")
         profile.set_preference("extensions.firebug.allPagesActivation", "on")
         profile.set_preference("extensions.firebug.defaultPanelName", "net")
@@ -149,12 +155,10 @@ def setup_profile(tor=False, port="9000", firebug=True, netexport=True, noscript
         profile.set_preference("extensions.firebug.showFirstRunPage", False)
         profile.set_preference("extensions.firebug.net.defaultPersist", True)
     if netexport is True:
-        profile.add_extension('./extensions/netExport-0.9b7.xpi')
         profile.set_preference("extensions.firebug.netexport.alwaysEnableAutoExport", True)
         make_folder(capture_path+"/har/")
         profile.set_preference("extensions.firebug.netexport.defaultLogDir", capture_path+"/har/")
     if noscript is True:
-        profile.add_extension('./extensions/noscript-2.6.9.3.xpi')
         profile.set_preference('noscript.firstRunRedirection', False)
         profile.set_preference("capability.policy.maonoscript.javascript.enabled", "allAccess")
         profile.set_preference("capability.policy.maonoscript.sites", "about:chrome:resource:")
@@ -401,7 +405,7 @@ def do_crawl(sites, driver, display, capture_path="", tor=False, tor_call="", se
             logging.debug(str_status)
             continue
         if callback is not None:
-            callback(index=s[0], url=s[1], **kwargs)
+            callback(index=s[0], url=s[1], driver=driver, **kwargs)
     return driver, display
 
 
@@ -429,7 +433,7 @@ def switch_tab(driver):
             logging.warning("Failed to switch tab, switch back to previous tab")
 
 
-@timeout(60)
+@timeout(60, on_timeout=str)
 def load_page(driver, url, cookies=0):
     try:
         if cookies == 0:
@@ -0,0 +1,176 @@
+__author__ = 'rishabn'
+
+# Timeouts for browser automation that work in any thread.
+#
+# SIGALRM only reaches the main thread and there is a single alarm per
+# process, so timeouts built on it can't be used by several browsers
+# crawling in parallel. Here, the decorated function runs in a helper
+# thread while the calling thread waits for it until the deadline.
+# The deadline is also kept per thread, so loops inside the function
+# can give up with check_deadline() instead of retrying forever, and
+# nested timeouts never extend the deadline of the outer one.
+#
+# A thread can't be killed, so a call that is stuck in the driver
+# keeps running after the deadline. It ends once the driver call
+# returns or fails (e.g. when the driver is quit after a timeout).
+# WebDriver is not thread-safe, so such a call is remembered for its
+# driver (the first argument, or the driver keyword argument): the
+# next timed call on that driver waits for it to finish first, and
+# times out itself if it doesn't within its own deadline. Code that
+# uses the driver directly after a timeout calls wait_for_driver(), or
+# restarts the driver.
+
+import errno
+import os
+import threading
+import time
+from functools import wraps
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Deadline:
+    """Point in time by which a call has to be done"""
+
+    def __init__(self, seconds, error_message=os.strerror(errno.ETIME)):
+        self.expires = time.time() + seconds
+        self.error_message = error_message
+
+    def remaining(self):
+        return max(self.expires - time.time(), 0)
+
+    def expired(self):
+        return time.time() >= self.expires
+
+    def check(self):
+        if self.expired():
+            raise TimeoutError(self.error_message)
+
+
+_local = threading.local()
+
+# id of a driver -> helper threads of calls on it that timed out (a
+# call and the timed calls nested in it time out together). A thread
+# keeps its driver alive, so the id is not reused while it runs.
+_abandoned = {}
+_abandoned_lock = threading.Lock()
+
+
+def current_deadline():
+    """
+    Returns the deadline of the current thread, or None.
+    """
+    return getattr(_local, "deadline", None)
+
+
+def check_deadline():
+    """
+    Raise TimeoutError if the deadline of the current thread has
+    passed.
+    """
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
+
+
+def _driver_of(args, kwargs):
+    if "driver" in kwargs:
+        return kwargs["driver"]
+    if len(args) > 0:
+        return args[0]
+    return None
+
+
+def _abandon(driver, thread):
+    if driver is None:
+        return
+    with _abandoned_lock:
+        _abandoned.setdefault(id(driver), []).append(thread)
+
+
+def wait_for_driver(driver, seconds=None):
+    """
+    Wait for the calls on driver that timed out to finish, the driver
+    must not get new commands before.
+
+    :return: False if one is still running after seconds
+    """
+    with _abandoned_lock:
+        threads = list(_abandoned.get(id(driver), []))
+    if seconds is not None:
+        end = time.time() + seconds
+    for thread in threads:
+        if thread is threading.current_thread():
+            # the abandoned call itself, going on with the driver
+            continue
+        while thread.is_alive():
+            # join() without a timeout can't be interrupted with
+            # Ctrl-C on python 2, so wait in short steps
+            wait = 1
+            if seconds is not None:
+                wait = min(end - time.time(), 1)
+                if wait <= 0:
+                    return False
+            thread.join(wait)
+    with _abandoned_lock:
+        running = [thread for thread in _abandoned.get(id(driver), [])
+                   if thread.is_alive()]
+        if len(running) > 0:
+            _abandoned[id(driver)] = running
+        elif id(driver) in _abandoned:
+            del _abandoned[id(driver)]
+    return True
+
+
+def timeout(seconds=10, error_message=os.strerror(errno.ETIME), on_timeout=None):
+    """
+    Decorator that gives up on a call after seconds.
+
+    :param on_timeout: function called with the TimeoutError when the
+                       deadline passes, its return value is returned
+                       instead of raising the error
+    """
+    def decorator(func):
+        def run(deadline, outcome, done, args, kwargs):
+            _local.deadline = deadline
+            try:
+                outcome.append((True, func(*args, **kwargs)))
+            except BaseException as exp:
+                outcome.append((False, exp))
+            finally:
+                done.set()
+
+        def wrapper(*args, **kwargs):
+            deadline = Deadline(seconds, error_message)
+            outer = current_deadline()
+            if outer is not None and outer.expires < deadline.expires:
+                deadline.expires = outer.expires
+
+            outcome = []
+            driver = _driver_of(args, kwargs)
+            if wait_for_driver(driver, deadline.remaining()):
+                done = threading.Event()
+                thread = threading.Thread(target=run, args=(deadline, outcome,
+                                                            done, args, kwargs))
+                thread.setDaemon(True)
+                thread.start()
+                # Event.wait() without a timeout can't be interrupted
+                # with Ctrl-C on python 2, so wait in short steps
+                while not done.is_set() and not deadline.expired():
+                    done.wait(min(deadline.remaining(), 1))
+                if not outcome:
+                    _abandon(driver, thread)
+
+            if not outcome:
+                error = TimeoutError(error_message)
+                if on_timeout is not None:
+                    return on_timeout(error)
+                raise error
+            succeeded, value = outcome[0]
+            if not succeeded:
+                raise value
+            return value
+        return wraps(func)(wrapper)
+    return decorator
@@ -0,0 +1,109 @@
+__author__ = 'rishabn'
+
+# Firefox profiles built from a template instead of from scratch.
+#
+# Installing the firebug, netExport and webdriver extensions means
+# unzipping several MB of XPIs into every new profile. Instead, they
+# are installed once into a template directory, keyed by the size and
+# modification time of the XPIs, and every new profile gets hard links
+# to the template's files (copies if the template is on another file
+# system). Preferences are only kept in memory until selenium writes
+# user.js at launch, so they are set on each profile as before.
+#
+# The template is never used by a browser itself, and firefox does not
+# write into installed extensions, so the shared files are not changed
+# by the sessions using them.
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from selenium import webdriver
+from selenium.webdriver.firefox import firefox_profile
+
+# the extension selenium installs into every profile at launch. It is
+# in the template, so selenium does not copy it into the profile again
+# (it still unpacks the XPI to a temporary directory to read its id).
+WEBDRIVER_EXTENSION = os.path.join(os.path.dirname(firefox_profile.__file__),
+                                   firefox_profile.WEBDRIVER_EXT)
+
+_build_lock = threading.Lock()
+
+
+def template_key(extensions):
+    digest = hashlib.sha256()
+    for path in extensions:
+        stat = os.stat(path)
+        digest.update("%s\0%d\0%d\0" % (os.path.abspath(path), stat.st_size,
+                                        int(stat.st_mtime)))
+    return digest.hexdigest()[:16]
+
+
+def template_path(extensions, cache_dir=None):
+    """
+    Returns the template directory with extensions installed, building
+    it if it doesn't exist yet.
+    """
+    extensions = list(extensions) + [WEBDRIVER_EXTENSION]
+    if cache_dir is None:
+        cache_dir = tempfile.gettempdir()
+    path = os.path.join(cache_dir, "foctor-profile-%s" % template_key(extensions))
+
+    with _build_lock:
+        if not os.path.isdir(path):
+            logging.debug("Building firefox profile template %s" % path)
+            profile = webdriver.FirefoxProfile()
+            for extension in extensions:
+                profile.add_extension(extension)
+            try:
+                # atomic, so a half built template is never used
+                os.rename(profile.profile_dir, path)
+            except OSError:
+                # the profile is on another file system: copy it next
+                # to the template first, so the rename is atomic too
+                if not os.path.isdir(path):
+                    copy_dir = tempfile.mkdtemp(dir=cache_dir)
+                    copy = os.path.join(copy_dir, "profile")
+                    try:
+                        shutil.copytree(profile.profile_dir, copy,
+                                        symlinks=True)
+                        os.rename(copy, path)
+                    except OSError:
+                        if not os.path.isdir(path):
+                            raise
+                        # else another process built it first
+                    finally:
+                        shutil.rmtree(copy_dir, ignore_errors=True)
+                shutil.rmtree(profile.profile_dir, ignore_errors=True)
+    return path
+
+
+def link_tree(source, destination):
+    """
+    Recreate the directory tree at source under destination, with
+    hard links to its files.
+    """
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.join(destination, os.path.relpath(root, source))
+        if not os.path.isdir(target_root):
+            os.makedirs(target_root)
+        for name in files:
+            source_file = os.path.join(root, name)
+            target_file = os.path.join(target_root, name)
+            try:
+                os.link(source_file, target_file)
+            except OSError:
+                shutil.copy2(source_file, target_file)
+
+
+def clone_profile(extensions, cache_dir=None):
+    """
+    Returns a new firefox profile with extensions installed, cloned
+    from the template for these extensions.
+    """
+    profile = webdriver.FirefoxProfile()
+    link_tree(template_path(extensions, cache_dir), profile.profile_dir)
+    return profile
@@ -0,0 +1,208 @@
+#
+# har_reader.py: read the entries of a HAR file one at a time.
+#
+# With includeResponseBodies, netexport puts every response body of a
+# page into its HAR file, so pages with large media produce HAR files
+# of tens of MB. Instead of loading the whole document, the reader
+# walks down to log.entries and decodes one entry at a time, so at
+# most one entry is in memory. Everything after the entries (and any
+# other part of the document) is skipped without being kept.
+#
+# Response bodies go through a BodyCapture, so they are hashed in
+# full and cut down to the capture policy's max_size before they are
+# kept.
+
+import base64
+import json
+
+from http_helper import BodyCapture
+
+# bytes read from the file at a time (grows for entries that are
+# larger than this)
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Stream:
+    """Incremental JSON decoding on top of a file object"""
+
+    def __init__(self, file_p):
+        self._file = file_p
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size=CHUNK_SIZE):
+        if self._eof:
+            return False
+        # drop what has been consumed before reading more
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        data = self._file.read(size)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer += data
+        return True
+
+    def peek(self):
+        """
+        Returns the next non-whitespace character without consuming
+        it, or "" at the end of the file.
+        """
+        while True:
+            while (self._pos < len(self._buffer) and
+                   self._buffer[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected %r in HAR file" % char)
+        self._pos += 1
+
+    def value(self):
+        """
+        Decode the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # incomplete, read more (double the read size so that
+                # large values don't take quadratic time)
+                if not self._fill(max(CHUNK_SIZE, len(self._buffer))):
+                    raise
+                continue
+            # a number at the end of the buffer may be cut off
+            if end < len(self._buffer) or self._eof:
+                self._pos = end
+                return value
+            if not self._fill(max(CHUNK_SIZE, len(self._buffer))):
+                self._pos = end
+                return value
+
+    def object_keys(self):
+        """
+        Walk through the keys of the object that starts here. After
+        each key, the caller has to consume its value.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self._pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError("Malformed object in HAR file")
+
+    def array_items(self):
+        """
+        Decode the items of the array that starts here one at a time.
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            char = self.peek()
+            self._pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError("Malformed array in HAR file")
+
+
+def iter_entries(file_p):
+    """
+    Yield the entries (log.entries) of a HAR file one at a time.
+    """
+    stream = _Stream(file_p)
+    for key in stream.object_keys():
+        if key != "log":
+            stream.value()
+            continue
+        for log_key in stream.object_keys():
+            if log_key != "entries":
+                stream.value()
+                continue
+            for entry in stream.array_items():
+                yield entry
+            # nothing after the entries is of interest
+            return
+
+
+def _headers(headers):
+    return dict((header['name'], header['value']) for header in headers)
+
+
+def capture_content(content, body_policy=None, blob_store=None):
+    """
+    Hash and cap the body (text) of a HAR response content dict in
+    place, see http_helper.BodyCapture. With a blob store, the body is
+    stored there and referenced by text_blob.
+    """
+    if 'text' not in content:
+        return content
+    text = content.pop('text')
+    base64_encoded = content.get('encoding') == "base64"
+    if base64_encoded:
+        data = base64.b64decode(text)
+    elif type(text) == unicode:
+        data = text.encode("utf-8")
+    else:
+        data = text
+
+    capture = BodyCapture(body_policy)
+    capture.write(data)
+    data = capture.getvalue()
+    capture.annotate(content)
+
+    if blob_store is not None:
+        content['text_blob'] = blob_store.put(data)
+    elif base64_encoded:
+        content['text'] = base64.b64encode(data)
+    else:
+        # the cap may have cut a character in half
+        content['text'] = data.decode("utf-8", "ignore")
+    return content
+
+
+def read_entries(path, body_policy=None, blob_store=None):
+    """
+    Returns the request/response fields kept from the entries of the
+    HAR file at path.
+
+    :param body_policy: body capture policy, see http_helper.BodyCapture
+    :param blob_store: optional centinel.blobstore.BlobStore to keep
+                       the response bodies in
+    """
+    results = []
+    with open(path, "rb") as file_p:
+        for entry in iter_entries(file_p):
+            request = entry['request']
+            response = entry['response']
+            results.append({
+                'request': {'method': request['method'],
+                            'headers': _headers(request['headers'])},
+                'response': {'status': response['status'],
+                             'reason': response['statusText'],
+                             'headers': _headers(response['headers']),
+                             'redirect': response['redirectURL'],
+                             'body': capture_content(response['content'],
+                                                     body_policy,
+                                                     blob_store)}})
+    return results
@@ -0,0 +1,140 @@
+#
+# har_watcher.py: hand HAR files to the headless browser as soon as
+# netexport has finished writing them.
+#
+# netexport writes one HAR file per page into the directory set in the
+# firefox profile. With pyinotify, the watcher gets an event when a
+# file is closed after writing (or moved into the directory), so a
+# page's HAR is picked up the moment it is complete. Without pyinotify
+# the directory is polled, which is slower but needs nothing extra.
+# Processed files are removed by the caller, so the directory only
+# ever holds files that have not been looked at yet.
+
+import logging
+import os
+import Queue
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# seconds between directory listings when pyinotify is missing
+POLL_INTERVAL = 0.25
+
+# seconds to wait for the HAR of a host after the HAR of another host
+# shows up, e.g. when the page redirected somewhere else
+OTHER_HOST_GRACE = 1
+
+
+if pyinotify is not None:
+    class _HarEventHandler(pyinotify.ProcessEvent):
+        """Puts the path of every finished HAR file on a queue"""
+
+        def my_init(self, queue=None):
+            self._queue = queue
+
+        def process_IN_CLOSE_WRITE(self, event):
+            if event.pathname.endswith(".har"):
+                self._queue.put(event.pathname)
+
+        def process_IN_MOVED_TO(self, event):
+            self.process_IN_CLOSE_WRITE(event)
+
+
+class HarWatcher:
+    """Watches a directory for new HAR files"""
+
+    def __init__(self, path):
+        """
+        :param path: the directory netexport writes HAR files to
+        """
+        self.path = path
+        self._queue = Queue.Queue()
+        self._notifier = None
+        # files that were already there, or handed out when polling
+        self._seen = set()
+
+    def start(self):
+        if pyinotify is not None:
+            watch_manager = pyinotify.WatchManager()
+            handler = _HarEventHandler(queue=self._queue)
+            self._notifier = pyinotify.ThreadedNotifier(watch_manager,
+                                                        handler)
+            self._notifier.setDaemon(True)
+            self._notifier.start()
+            watch_manager.add_watch(self.path, pyinotify.IN_CLOSE_WRITE |
+                                    pyinotify.IN_MOVED_TO)
+        else:
+            logging.debug("pyinotify is not available, polling %s for "
+                          "HAR files" % self.path)
+            self._seen = set(os.listdir(self.path))
+
+    def stop(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _next(self, timeout):
+        """
+        Returns the path of the next finished HAR file, or None if
+        there is none within timeout seconds.
+        """
+        if self._notifier is not None:
+            try:
+                return self._queue.get(timeout=max(timeout, 0))
+            except Queue.Empty:
+                return None
+
+        deadline = time.time() + timeout
+        while True:
+            for file_name in sorted(os.listdir(self.path)):
+                if file_name.endswith(".har") and file_name not in self._seen:
+                    self._seen.add(file_name)
+                    # without close events, give netexport a moment
+                    # to finish writing
+                    time.sleep(1)
+                    return os.path.join(self.path, file_name)
+            if time.time() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+    def wait(self, host, timeout):
+        """
+        Wait for the HAR file of a page on host (netexport puts the
+        host in the file name).
+
+        HAR files of other hosts that show up in the meantime are left
+        over from pages that timed out earlier, or the page redirected
+        to another host. They are removed, and the wait is cut short
+        to OTHER_HOST_GRACE seconds in case of a redirect.
+
+        :return: the path of the HAR file, or None if it did not show
+                 up in time
+        """
+        deadline = time.time() + timeout
+        while True:
+            path = self._next(deadline - time.time())
+            if path is None:
+                return None
+            if host in os.path.basename(path):
+                return path
+            logging.debug("Discarding HAR file %s while waiting for "
+                          "%s" % (path, host))
+            self.remove(path)
+            deadline = min(deadline, time.time() + OTHER_HOST_GRACE)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self._seen.discard(os.path.basename(path))
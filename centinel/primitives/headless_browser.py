@@ -1,39 +1,114 @@
 import shutil
 import csv
-import json
 import logging
 import os
+import Queue
 import sys
+import tempfile
+import threading
 import time
 
 from pyvirtualdisplay import Display
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
+from selenium.webdriver.support.ui import WebDriverWait
 
 import foctor_core.foctor_core as fc
+import foctor_core.foctor_profile as fp
+import har_reader
+from har_watcher import HarWatcher
+
+# seconds to wait for the HAR file of a page
+HAR_TIMEOUT = 15
+
+# seconds to wait for the DOM of a page in fast mode
+DOM_TIMEOUT = 30
+
+# preferences for fast mode: no images, media, fonts or plugins are
+# loaded, and driver.get() returns without waiting for the page to
+# finish loading (we wait for the DOM instead)
+FAST_PREFERENCES = {"permissions.default.image": 2,
+                    "media.autoplay.enabled": False,
+                    "media.ogg.enabled": False,
+                    "media.webm.enabled": False,
+                    "media.mp4.enabled": False,
+                    "media.wave.enabled": False,
+                    "gfx.downloadable_fonts.enabled": False,
+                    "plugin.state.flash": 0,
+                    "plugin.state.java": 0,
+                    "webdriver.load.strategy": "unstable"}
+
+# finds the resources fast mode does not load, firefox doesn't request
+# them at all, so they are not in the HAR file
+BLOCKED_RESOURCES_SCRIPT = """
+var attributes = {"img": "src", "video": "src", "audio": "src",
+                  "source": "src", "embed": "src", "object": "data"};
+var blocked = [];
+for (var tag in attributes) {
+    var elements = document.getElementsByTagName(tag);
+    for (var i = 0; i < elements.length; i++) {
+        var url = elements[i][attributes[tag]];
+        if (url) {
+            blocked.push({"type": tag, "url": url});
+        }
+    }
+}
+return blocked;
+"""
 
 
 class HeadlessBrowser:
-    def __init__(self):
+    def __init__(self, blob_store=None, workers=1, pages_per_worker=50,
+                 body_policy=None, fast=False):
+        """
+        :param blob_store: optional centinel.blobstore.BlobStore, response
+                           contents from the HAR files are stored there
+                           and referenced by hash
+        :param workers: number of browsers crawling input files in
+                        parallel, see BrowserPool. 1 crawls serially
+                        with foctor_core.
+        :param pages_per_worker: pages a pool browser loads before it
+                                 is restarted
+        :param body_policy: capture policy for the response bodies in
+                            the HAR files, see
+                            centinel.primitives.http_helper.BodyCapture
+        :param fast: block heavy resources and only wait for the DOM
+                     of each page, see FAST_PREFERENCES. Results are
+                     then dicts with the HAR "entries" and the
+                     "blocked" resources.
+        """
         self.cur_path = os.path.dirname(os.path.abspath(__file__))
+        self.blob_store = blob_store
+        self.workers = workers
+        self.pages_per_worker = pages_per_worker
+        self.body_policy = body_policy
+        self.fast = fast
         self.display = Display(visible=False)
         self.binary = None
         self.profile = None
         self.driver = None
-        self.parsed = 0
+        self.har_watcher = None
 
     @fc.timing
-    def setup_profile(self, firebug=True, netexport=True):
+    def setup_profile(self, firebug=True, netexport=True, har_path=None):
         """
         Setup the profile for firefox
         :param firebug: whether add firebug extension
         :param netexport: whether add netexport extension
+        :param har_path: directory netexport writes HAR files to,
+                         har/ next to this file by default
         :return: a firefox profile object
         """
-        profile = webdriver.FirefoxProfile()
+        extensions = []
+        if firebug:
+            extensions.append(os.path.join(self.cur_path, 'extensions/firebug-2.0.8.xpi'))
+        if netexport:
+            extensions.append(os.path.join(self.cur_path, 'extensions/netExport-0.9b7.xpi'))
+        # extensions come from a prebuilt template, see foctor_profile
+        profile = fp.clone_profile(extensions)
         profile.set_preference("app.update.enabled", False)
         if firebug:
-            profile.add_extension(os.path.join(self.cur_path, 'extensions/firebug-2.0.8.xpi'))
             profile.set_preference("extensions.firebug.currentVersion", "2.0.8")
             profile.set_preference("extensions.firebug.allPagesActivation", "on")
             profile.set_preference("extensions.firebug.defaultPanelName", "net")
@@ -43,14 +118,17 @@ class HeadlessBrowser:
             profile.set_preference("extensions.firebug.showFirstRunPage", False)
             profile.set_preference("extensions.firebug.net.defaultPersist", True)  # persist all redirection responses
         if netexport:
-            har_path = os.path.join(self.cur_path, "har")
+            if har_path is None:
+                har_path = os.path.join(self.cur_path, "har")
             if not os.path.exists(har_path):
                 os.mkdir(har_path)
-            profile.add_extension(os.path.join(self.cur_path, 'extensions/netExport-0.9b7.xpi'))
             profile.set_preference("extensions.firebug.DBG_NETEXPORT", True)
             profile.set_preference("extensions.firebug.netexport.alwaysEnableAutoExport", True)
             profile.set_preference("extensions.firebug.netexport.defaultLogDir", har_path)
             profile.set_preference("extensions.firebug.netexport.includeResponseBodies", True)
+        if self.fast:
+            for name, value in FAST_PREFERENCES.items():
+                profile.set_preference(name, value)
         return profile
 
     def open_virtual_display(self):
@@ -63,77 +141,55 @@ class HeadlessBrowser:
         """
         Wrap returned http response into a well formatted dict
         :param kwargs: this dict param should contains following keys:
-                           fd: file directory to
                            url: the test url fo the result
-                           files_count: the number of files under har/ directory
+                           watcher (optional): the HarWatcher of the
+                               directory the har file is written to,
+                               self.har_watcher if not given
+                           external (optional): dict to save the result
+                               to instead of returning it
+                           driver (optional): the driver that loaded the
+                               page, needed in fast mode
 
         :return (dict): the results of all
         """
 
-        if 'fd' not in kwargs \
-                or 'url' not in kwargs \
-                or 'files_count' not in kwargs:
+        if 'url' not in kwargs:
             logging.error("Missing arguments in wrap_results function")
             return {}
 
         external = kwargs['external'] if 'external' in kwargs else None
-        fd = kwargs['fd']
+        watcher = kwargs['watcher'] if 'watcher' in kwargs else self.har_watcher
         url = kwargs['url']
-        length = kwargs['files_count']
 
         results = {}
 
-        files = []
-        wait_time = 15
         host = self.divide_url(url)[0]
-        time.sleep(0.5)
-
-        # wait until the har file is generated
-        while len(os.listdir(fd)) <= length + self.parsed:
-            time.sleep(1)
-            wait_time -= 1
-            if wait_time == 0:
-                logging.warning("%s waiting har file result timed out" % url)
-                results['error'] = "wrap har file timeout"
-                if external is not None:
-                    external[url] = results
-                return results
-        time.sleep(1)
-
-        # find all har files under har/ directory
-        for fn in os.listdir(fd):
-            if fn.endswith(".har") and host in fn:
-                path = os.path.join(fd, fn)
-                files.append((fn, os.stat(path).st_mtime))
-
-        # sort all har files and parse the latest one
-        files.sort(key=lambda x: x[1])
-        if len(files) > 0:
-            with open(fd + '/' + files[-1][0]) as f:
-                raw_data = json.load(f)['log']['entries']
-                results = [{} for i in range(0, len(raw_data))]
-                for i in range(0, len(results)):
-
-                    results[i]['request'] = {}
-                    results[i]['request']['method'] = raw_data[i]['request']['method']
-                    headers = {}
-                    for header in raw_data[i]['request']['headers']:
-                        headers[header['name']] = header['value']
-                    results[i]['request']['headers'] = headers
-
-                    results[i]['response'] = {}
-                    results[i]['response']['status'] = raw_data[i]['response']['status']
-                    results[i]['response']['reason'] = raw_data[i]['response']['statusText']
-                    headers = {}
-                    for header in raw_data[i]['response']['headers']:
-                        headers[header['name']] = header['value']
-                    results[i]['response']['headers'] = headers
-                    results[i]['response']['redirect'] = raw_data[i]['response']['redirectURL']
-                    results[i]['response']['body'] = raw_data[i]['response']['content']
-
-            self.parsed += 1  # increment the number of parsed har files
-        else:
-            logging.warning("Cannot find har file for %s" % url)
+
+        blocked = None
+        if self.fast and 'driver' in kwargs:
+            blocked = self.blocked_resources(kwargs['driver'], url)
+
+        # wait until the har file is written
+        har_file = watcher.wait(host, HAR_TIMEOUT)
+        if har_file is None:
+            logging.warning("%s waiting har file result timed out" % url)
+            results['error'] = "wrap har file timeout"
+            if external is not None:
+                external[url] = results
+            return results
+
+        try:
+            results = har_reader.read_entries(har_file, self.body_policy,
+                                              self.blob_store)
+        except (ValueError, KeyError) as exp:
+            logging.warning("Failed to parse har file for %s: %s" % (url, exp))
+            results = {'error': "har file parse error: %s" % exp}
+
+        # parsed, the directory only keeps files not seen yet
+        watcher.remove(har_file)
+
+        if self.fast and 'error' not in results:
+            results = {'entries': results, 'blocked': blocked}
 
         # save test result of this url to the external result object or 
         # return the result
@@ -142,6 +198,21 @@ class HeadlessBrowser:
         else:
             return results
 
+    def blocked_resources(self, driver, url):
+        """
+        Wait until the DOM of the page is ready and list the resources
+        it references that fast mode did not load.
+        """
+        try:
+            WebDriverWait(driver, DOM_TIMEOUT).until(
+                lambda d: d.execute_script('return document.readyState') in ("interactive", "complete"))
+            return driver.execute_script(BLOCKED_RESOURCES_SCRIPT)
+        except TimeoutException:
+            logging.warning("%s waiting for DOM timed out" % url)
+        except Exception as exp:
+            logging.warning("Failed to list blocked resources of %s: %s" % (url, exp))
+        return None
+
     def divide_url(self, url):
         """
         divide url into host and path two parts
@@ -157,7 +228,7 @@ class HeadlessBrowser:
             path = url[len(host):]
         return host, path
 
-    def get(self, host, files_count, path="/", ssl=False, external=None):
+    def get(self, host, path="/", ssl=False, external=None):
         """
         Send get request to a url and wrap the results
         :param host (str): the host name of the url
@@ -172,16 +243,12 @@ class HeadlessBrowser:
         try:
             capture_path = os.getcwd() + '/'
 
-            har_file_path = capture_path + "har/"
-
             # fc.load_page(self.driver, http_url)
             fc.switch_tab(self.driver)
             self.load_page(http_url)
 
             print "driver get: " + http_url
 
-            time.sleep(2)
-
             # if url[-1] == "/":
             #     f_name = url.split('/')[-2]
             # else:
@@ -190,7 +257,7 @@ class HeadlessBrowser:
             # fc.save_html(self.driver, f_name, os.path.join(capture_path, "htmls/"))
             # fc.save_screenshot(self.driver, f_name, os.path.join(capture_path, "screenshots/"))
 
-            result = self.wrap_results(url=http_url, files_count=files_count, fd=har_file_path)
+            result = self.wrap_results(url=http_url, driver=self.driver)
 
             if external is not None:
                 external[http_url] = result
@@ -201,21 +268,16 @@ class HeadlessBrowser:
 
         return result
 
-    def run_file(self, input_file, results):
+    def parse_file(self, input_file):
         """
-        use foctor_core library do get requests
-        :param input_file: the file name of the list of test urls
-                        format: 
+        Read the test urls from an input file
+        :param input_file: (file name, file contents) of the list of
+                        test urls, format:
                             1, www.facebook.com
                             2, www.google.com
                             ...
-        :param results: the object to save the responses from server
+        :return: list of [index, url]
         """
-
-        capture_path = self.cur_path
-
-        display_mode = 0  # 0 is virtural display(Xvfb mode)
-
         site_list = []
         file_name, file_contents = input_file
         result = {"file_name": file_name}
@@ -270,10 +332,28 @@ class HeadlessBrowser:
             site_list.append([index, url])
             index += 1
 
+        return site_list
+
+    def run_file(self, input_file, results):
+        """
+        use foctor_core library do get requests
+        :param input_file: the file name of the list of test urls
+                        format: 
+                            1, www.facebook.com
+                            2, www.google.com
+                            ...
+        :param results: the object to save the responses from server
+        """
+
+        capture_path = self.cur_path
+
+        display_mode = 0  # 0 is virtural display(Xvfb mode)
+
+        site_list = self.parse_file(input_file)
+
         driver, display = fc.do_crawl(sites=site_list, driver=self.driver, display=self.display,
                                       capture_path=capture_path, callback=self.wrap_results,
-                                      external=results, fd=os.path.join(capture_path, "har/"),
-                                      files_count=len(os.listdir(os.path.join(capture_path, "har/"))))
+                                      external=results)
         fc.teardown_driver(driver, display, display_mode)
 
         driver.quit()  # quit driver will also clean up the tmp file under /tmp directory
@@ -296,17 +376,35 @@ class HeadlessBrowser:
 
         results = {}
 
-        self.open_virtual_display()
         if verbose > 0:
             log_file = sys.stdout
         else:
             log_file = None
 
+        if not url and self.workers > 1:
+            # all files go through one pool so the browsers stay warm
+            # between them
+            urls = []
+            for input_file in input_files.items():
+                logging.info("Testing input file %s..." % (input_file[0]))
+                urls.extend(site for index, site in self.parse_file(input_file))
+            pool = BrowserPool(self, self.workers, self.pages_per_worker,
+                               log_file)
+            pool.run(urls, results)
+
+            logging.debug("Deleting har folder")
+            shutil.rmtree(os.path.join(self.cur_path, 'har'), ignore_errors=True)
+            return results
+
+        self.open_virtual_display()
+
         # set up firefox driver 
         self.binary = FirefoxBinary(os.path.join(self.cur_path, 'firefox/firefox'), log_file=log_file)
         self.profile = self.setup_profile()
         self.driver = webdriver.Firefox(firefox_profile=self.profile, firefox_binary=self.binary, timeout=60)
         self.driver.set_page_load_timeout(60)
+        self.har_watcher = HarWatcher(os.path.join(self.cur_path, "har"))
+        self.har_watcher.start()
 
         isfile = False
         if url:
@@ -323,7 +421,182 @@ class HeadlessBrowser:
             logging.info("Quit driver")
             self.driver.quit()
             self.close_virtual_display()
+        self.har_watcher.stop()
 
         logging.debug("Deleting har folder")
         shutil.rmtree(os.path.join(self.cur_path, 'har'))
         return results
+
+
+class BrowserWorker:
+    """
+    A Firefox instance on its own virtual display that writes its HAR
+    files to its own directory, so several of them can crawl at once.
+    """
+
+    # pyvirtualdisplay points DISPLAY in os.environ at the display it
+    # starts (or restores it when stopping), and FirefoxBinary copies
+    # the environment when it is created, so these have to happen
+    # one worker at a time
+    _display_lock = threading.Lock()
+
+    def __init__(self, browser, log_file=None):
+        """
+        :param browser: the HeadlessBrowser this worker crawls for
+        :param log_file: where firefox output goes
+        """
+        self.browser = browser
+        self.log_file = log_file
+        self.display = None
+        self.driver = None
+        self.har_path = None
+        self.watcher = None
+        self.pages = 0
+
+    def start(self):
+        har_root = os.path.join(self.browser.cur_path, "har")
+        if not os.path.exists(har_root):
+            try:
+                os.mkdir(har_root)
+            except OSError:
+                # another worker just created it
+                pass
+        self.har_path = tempfile.mkdtemp(prefix="worker-", dir=har_root)
+        self.watcher = HarWatcher(self.har_path)
+        self.watcher.start()
+        profile = self.browser.setup_profile(True, True, self.har_path)
+
+        with self._display_lock:
+            self.display = Display(visible=False)
+            self.display.start()
+            binary = FirefoxBinary(os.path.join(self.browser.cur_path,
+                                                'firefox/firefox'),
+                                   log_file=self.log_file)
+        self.driver = webdriver.Firefox(firefox_profile=profile,
+                                        firefox_binary=binary, timeout=60)
+        self.driver.set_page_load_timeout(60)
+        self.pages = 0
+
+    def stop(self):
+        if self.driver is not None:
+            try:
+                # also cleans up the profile under /tmp
+                self.driver.quit()
+            except Exception as exp:
+                logging.warning("Failed to quit driver: %s" % exp)
+            self.driver = None
+        if self.display is not None:
+            with self._display_lock:
+                try:
+                    self.display.stop()
+                except Exception as exp:
+                    logging.warning("Failed to stop virtual display: "
+                                    "%s" % exp)
+            self.display = None
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if self.har_path is not None:
+            shutil.rmtree(self.har_path, ignore_errors=True)
+            self.har_path = None
+
+    def fetch(self, url, results):
+        """
+        Load url and save the result parsed from its HAR file to
+        results[url]. Exceptions mean the browser is in a bad state
+        and should be restarted.
+        """
+        if "http" not in url.split("/")[0]:
+            load_url = "http://" + url
+        else:
+            load_url = url
+
+        # a new page in a tab of its own browser does not need the
+        # tab switching and fixed sleeps of the serial crawl
+        self.driver.delete_all_cookies()
+        self.driver.get(load_url)
+        self.pages += 1
+        logging.debug("driver.get(%s) returned successfully" % load_url)
+
+        self.browser.wrap_results(url=url, watcher=self.watcher,
+                                  driver=self.driver, external=results)
+
+
+class BrowserPool:
+    """
+    Crawls a list of urls with several browsers at once. Each worker
+    thread launches its browser right away and keeps taking urls from
+    a shared queue. Browsers are restarted after pages_per_worker
+    pages, since firefox slows down and leaks memory on long crawls,
+    and whenever loading a page fails.
+    """
+
+    def __init__(self, browser, workers, pages_per_worker, log_file=None):
+        self.browser = browser
+        self.workers = workers
+        self.pages_per_worker = pages_per_worker
+        self.log_file = log_file
+
+    def run(self, urls, results):
+        """
+        :param urls: the urls to crawl
+        :param results: dict the result of every url is saved to
+        """
+        queue = Queue.Queue()
+        for url in urls:
+            queue.put(url)
+
+        threads = []
+        for index in range(min(self.workers, len(urls))):
+            thread = threading.Thread(target=self._work,
+                                      args=(index, queue, results))
+            thread.setDaemon(1)
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _start_worker(self, index):
+        worker = BrowserWorker(self.browser, self.log_file)
+        try:
+            worker.start()
+        except Exception as exp:
+            logging.exception("Browser worker %d failed to start: "
+                              "%s" % (index, exp))
+            worker.stop()
+            return None
+        return worker
+
+    def _work(self, index, queue, results):
+        worker = self._start_worker(index)
+        try:
+            while True:
+                try:
+                    url = queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+                if worker is None:
+                    worker = self._start_worker(index)
+                    if worker is None:
+                        results[url] = {"error": "browser failed to start"}
+                        continue
+
+                try:
+                    worker.fetch(url, results)
+                except Exception as exp:
+                    logging.warning("Browser worker %d failed loading %s, "
+                                    "restarting it: %s" % (index, url, exp))
+                    results[url] = {"error": str(exp)}
+                    worker.stop()
+                    worker = None
+                    continue
+
+                if worker.pages >= self.pages_per_worker:
+                    logging.debug("Recycling browser worker %d after %d "
+                                  "pages" % (index, worker.pages))
+                    worker.stop()
+                    worker = None
+        finally:
+            if worker is not None:
+                worker.stop()
@@ -7,36 +7,277 @@ import BeautifulSoup
 import re
 from urlparse import urlparse
 
-from http_helper import ICHTTPConnection
+from http_helper import BodyCapture, ICHTTPConnection, body_content_type
+from centinel.concurrency import ConcurrencyController
+from centinel.connectivity import (ConnectivityMonitor, OUT_OF_TIME,
+                                   skip_reason, skipped)
+from centinel.deadline import Deadline, join_all
 from centinel.utils import user_agent_pool
 
 REDIRECT_LOOP_THRESHOLD = 5
 
+# the meta refresh scanner only tokenizes this much of the document,
+# which is normally way past the end of <head>
+META_SCAN_LIMIT = 64 * 1024
+
+_REFRESH_RE = re.compile("^refresh$", re.I)
+_HEAD_END_RE = re.compile(r"</head\s*>|<body[\s>]", re.I)
+_COMMENT_RE = re.compile(r"<!--.*?-->", re.S)
+_META_TAG_RE = re.compile(r"<meta(?=[\s/>])([^>]*)>", re.I)
+_ATTRIBUTE_RE = re.compile(r"""([^\s"'=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?""")
+_SCRIPT_RE = re.compile(r"<script[\s>]", re.I)
+_HTTP_EQUIV_RE = re.compile(r"http-equiv", re.I)
+
+# returned by the scanner when it can't be sure about the markup
+_AMBIGUOUS = object()
+
+
+def _refresh_url(content):
+    """
+    Returns the URL from the content attribute of a refresh meta tag
+    ("5; url=http://..."), or None.
+    """
+    try:
+        wait, text = content.split(";")
+        text = text.strip()
+        if text.lower().startswith("url="):
+            return text[4:]
+    except:
+        # there are normal meta tag with refresh that are not
+        # redirect and don't have a URL in it
+        pass
+    return None
+
+
+def _scan_meta_refresh(content, limit=META_SCAN_LIMIT):
+    """
+    Look for a refresh meta tag with regular expressions instead of
+    parsing the whole document. Only the head of the document (up to
+    limit bytes) is tokenized.
+
+    :return: the content attribute of the first refresh meta tag, None
+             if there is none, or _AMBIGUOUS if the markup is too odd
+             to be sure (the caller should fall back to a real parser)
+    """
+    head = content[:limit]
+    match = _HEAD_END_RE.search(head)
+    if match is not None:
+        head = head[:match.start()]
+    rest = content[len(head):]
+
+    if "<!--" in head:
+        head = _COMMENT_RE.sub("", head)
+        # unterminated comment
+        if "<!--" in head:
+            return _AMBIGUOUS
+
+    for tag in _META_TAG_RE.finditer(head):
+        attributes = tag.group(1)
+        # a quote that never closes would make us split the tag wrong
+        if attributes.count('"') % 2 or attributes.count("'") % 2:
+            return _AMBIGUOUS
+        http_equiv = None
+        refresh_content = None
+        for attr in _ATTRIBUTE_RE.finditer(attributes):
+            name = attr.group(1).lower()
+            value = attr.group(2)
+            if value is None:
+                value = attr.group(3)
+            if value is None:
+                value = attr.group(4)
+            if name == "http-equiv" and http_equiv is None:
+                http_equiv = value
+            elif name == "content" and refresh_content is None:
+                refresh_content = value
+        if http_equiv is None or not _REFRESH_RE.match(http_equiv):
+            continue
+        # the tag might be part of a string in a script
+        if _SCRIPT_RE.search(head, 0, tag.start()):
+            return _AMBIGUOUS
+        if refresh_content is None:
+            return ""
+        return refresh_content
+
+    # meta tags outside of the head are rare, but a parser would find
+    # them, so let it have a look if there might be one
+    if _HTTP_EQUIV_RE.search(rest):
+        return _AMBIGUOUS
+    return None
+
+
+def _soup_meta_refresh(content):
+    """
+    Returns the content attribute of the first refresh meta tag using
+    BeautifulSoup, or None.
+    """
+    decoded = content.decode("utf-8", errors="replace")
+    soup = BeautifulSoup.BeautifulSoup(decoded)
+    result = soup.find("meta", attrs={"http-equiv": _REFRESH_RE})
+    if result:
+        try:
+            return result["content"]
+        except KeyError:
+            return ""
+    return None
+
+
 def meta_redirect(content):
     """
     Returns redirecting URL if there is a HTML refresh meta tag,
     returns None otherwise
 
+    The document is scanned with regular expressions first and only
+    parsed with BeautifulSoup if the scanner can't decide.
+
     :param content: HTML content
     """
-    decoded = content.decode("utf-8", errors="replace")
-    soup = BeautifulSoup.BeautifulSoup(decoded)
-    result = soup.find("meta", attrs={"http-equiv": re.compile("^refresh$", re.I)})
-    if result:
+    refresh_content = _scan_meta_refresh(content)
+    if refresh_content is _AMBIGUOUS:
+        refresh_content = _soup_meta_refresh(content)
+    if refresh_content is None:
+        return None
+    url = _refresh_url(refresh_content)
+    if url is not None and type(url) is not unicode:
+        url = url.decode("utf-8", errors="replace")
+    return url
+
+
+# media types other than text/* that are text (or structured text)
+_TEXT_TYPES = set(["application/javascript", "application/x-javascript",
+                   "application/ecmascript", "application/json",
+                   "application/xml", "application/xhtml+xml",
+                   "application/rss+xml", "application/atom+xml",
+                   "application/x-www-form-urlencoded"])
+
+# what a decoder says when a body ends in the middle of a character
+_CUT_OFF_REASONS = ("unexpected end of data", "incomplete multibyte sequence")
+
+
+def is_text(content_type):
+    """
+    Returns True if a body of this media type is text. Bodies without a
+    Content-Type are treated as text, like the browsers do.
+    """
+    if content_type is None:
+        return True
+    return (content_type.startswith("text/") or
+            content_type.endswith("+xml") or content_type.endswith("+json") or
+            content_type in _TEXT_TYPES)
+
+
+def _decode(body, charset, truncated=False):
+    """
+    Decode a body, dropping a character cut off at the end of a capped
+    body. Raises UnicodeDecodeError or LookupError.
+    """
+    try:
+        return body.decode(charset)
+    except UnicodeDecodeError as exp:
+        if (truncated and exp.reason in _CUT_OFF_REASONS and
+                exp.end == len(body)):
+            return body[:exp.start].decode(charset)
+        raise
+
+
+def _utf8(body, truncated=False):
+    """
+    Returns the body if it is valid UTF-8 (less a character cut off at
+    the end of a capped body), None otherwise.
+    """
+    try:
+        body.decode('utf-8')
+        return body
+    except UnicodeDecodeError as exp:
+        if (truncated and exp.reason in _CUT_OFF_REASONS and
+                exp.end == len(body)):
+            return body[:exp.start]
+        return None
+
+
+def store_body(response, body, blob_store=None, charset=None,
+               content_type=None, truncated=False):
+    """
+    Store a response body in the response dict.
+
+    If a blob store is given, all bodies go there and the response only
+    references them by hash. Otherwise text goes into the result as
+    UTF-8:
+
+    - bodies that are valid UTF-8 (which includes plain ASCII) are
+      stored as they are, without decoding and re-encoding
+    - others are decoded with the declared charset, or iso-8859-1 (the
+      HTML default) if there is none or it does not fit. The charset
+      they were decoded with is kept as body_charset.
+
+    Only bodies of a non-text content type that are not valid UTF-8 are
+    base64 encoded (body.b64).
+
+    :param response: the response dict
+    :param body: the body as received on the wire
+    :param blob_store: optional centinel.blobstore.BlobStore
+    :param charset: the charset declared by the server, if any
+    :param content_type: the media type declared by the server, if any
+    :param truncated: whether the body was cut off by the capture
+                      size, in which case it may end in the middle of
+                      a character
+    """
+    if type(body) is unicode:
+        body = body.encode('utf-8')
+    if charset is not None:
+        response["body_charset"] = charset
+
+    if blob_store is not None:
+        response["body_blob"] = blob_store.put(body)
+        return
+
+    if charset is None or charset.replace("-", "") in ("utf8", "usascii",
+                                                       "ascii"):
+        utf8 = _utf8(body, truncated)
+        if utf8 is not None:
+            response["body"] = utf8
+            return
+    if not is_text(content_type):
+        response["body.b64"] = base64.b64encode(body)
+        return
+    if charset is not None:
         try:
-            wait, text = result["content"].split(";")
-            text = text.strip()
-            if text.lower().startswith("url="):
-                url = text[4:]
-                return url
-        except:
-            # there are normal meta tag with refresh that are not
-            # redirect and don't have a URL in it
+            response["body"] = _decode(body, charset,
+                                       truncated).encode('utf-8')
+            return
+        except (UnicodeDecodeError, LookupError):
             pass
+    # every byte string is valid iso-8859-1, so this always works
+    response["body"] = body.decode('iso-8859-1').encode('utf-8')
+    response["body_charset"] = 'iso-8859-1'
+
+
+def _response_body(response, blob_store=None):
+    """
+    Returns the body stored in a response dict (inline, base64 or in
+    the blob store), or None if there is no body.
+    """
+    if "body" in response:
+        return response["body"]
+    elif "body.b64" in response:
+        return base64.b64decode(response["body.b64"])
+    elif "body_blob" in response and blob_store is not None:
+        return blob_store.get(response["body_blob"])
     return None
 
 
-def _get_http_request(netloc, path="/", headers=None, ssl=False):
+def _take_body(result, blob_store=None):
+    """
+    Returns the raw body of a result from _get_http_request(), without
+    going through the stored (possibly encoded) copy if we can help it.
+    """
+    body = result.pop("_body", None)
+    if body is None:
+        body = _response_body(result["response"], blob_store)
+    return body
+
+
+def _get_http_request(netloc, path="/", headers=None, ssl=False,
+                      blob_store=None, body_policy=None):
     """
     Actually gets the http. Moved this to it's own private method since
     it is called several times for following redirects
@@ -45,6 +286,8 @@ def _get_http_request(netloc, path="/", headers=None, ssl=False):
     :param path:
     :param headers:
     :param ssl:
+    :param blob_store: optional blob store for the response body
+    :param body_policy: body capture policy, see http_helper.BodyCapture
     :return:
     """
     if ssl:
@@ -67,32 +310,44 @@ def _get_http_request(netloc, path="/", headers=None, ssl=False):
 
     response = {}
 
+    conn = None
     try:
         conn = ICHTTPConnection(host=host, port=port, timeout=10)
 
-        conn.request(path, headers, ssl, timeout=10)
+        conn.request(path, headers, ssl, timeout=10,
+                     body_policy=body_policy)
         response["status"] = conn.status
         response["reason"] = conn.reason
         response["headers"] = conn.headers
-        body = conn.body
-
-        try:
-            response["body"] = body.encode('utf-8')
-        except UnicodeDecodeError:
-            # if utf-8 fails to encode, just use base64
-            response["body.b64"] = body.encode('base64')
+        store_body(response, conn.raw_body, blob_store, conn.charset,
+                   body_content_type(conn.headers), conn.capture.truncated)
+        conn.capture.annotate(response)
 
     except Exception as err:
         response["failure"] = str(err)
 
     result = {"response": response,
               "request": request}
+    if conn is not None and conn.raw_body is not None:
+        # the raw body for the redirect checks, see _take_body()
+        result["_body"] = conn.raw_body
 
     return result
 
 
 def get_request(netloc, path="/", headers=None, ssl=False,
-                external=None, url=None, log_prefix=''):
+                external=None, url=None, log_prefix='', first_response=None,
+                blob_store=None, body_policy=None):
+    """
+    Send an HTTP GET request and follow redirects.
+
+    :param first_response: result of the first request, in the format
+                           _get_http_request() returns, if it was already
+                           done by the caller (e.g. the combined probe).
+                           Only redirects are followed in that case.
+    :param blob_store: optional blob store for response bodies
+    :param body_policy: body capture policy, see http_helper.BodyCapture
+    """
     http_results = {}
 
     # Add User-Agent string if not present in headers
@@ -101,7 +356,10 @@ def get_request(netloc, path="/", headers=None, ssl=False,
     elif type(headers) is dict and "User-Agent" not in headers:
         headers["user-Agent"] = random.choice(user_agent_pool)
 
-    first_response = _get_http_request(netloc, path, headers, ssl)
+    if first_response is None:
+        first_response = _get_http_request(netloc, path, headers, ssl,
+                                           blob_store, body_policy)
+    body = _take_body(first_response, blob_store)
     if "failure" in first_response["response"]:  # If there was an error, just ignore redirects and return
         first_response_information = {"redirect_count": 0,
                                       "redirect_loop": False,
@@ -127,14 +385,11 @@ def get_request(netloc, path="/", headers=None, ssl=False,
     # check meta redirect
     meta_redirect_url = None
     is_meta_redirect = False
-    if "body" in first_response["response"]:
+    if body is not None:
         try:
-            meta_redirect_url = meta_redirect(first_response["response"]["body"])
+            meta_redirect_url = meta_redirect(body)
         except:
             logging.warning("%sError looking for redirects in: %s." % (log_prefix, url))
-    elif "body.b64" in first_response["response"]:
-        body_decoded = base64.b64decode(first_response["response"]["body.b64"])
-        meta_redirect_url = meta_redirect(body_decoded)
 
     if meta_redirect_url is not None:
         is_meta_redirect = True
@@ -178,7 +433,9 @@ def get_request(netloc, path="/", headers=None, ssl=False,
 
             previous_netloc = netloc
 
-            redirect_http_result = _get_http_request(netloc, parsed_url.path, ssl=use_ssl)
+            redirect_http_result = _get_http_request(netloc, parsed_url.path, ssl=use_ssl,
+                                                     blob_store=blob_store,
+                                                     body_policy=body_policy)
 
             # If there is an error in the redirects, break the loop and stop there
             if "failure" in redirect_http_result["response"]:
@@ -195,11 +452,9 @@ def get_request(netloc, path="/", headers=None, ssl=False,
             # check meta redirect
             meta_redirect_url = None
             is_meta_redirect = False
-            if "body" in redirect_http_result["response"]:
-                meta_redirect_url = meta_redirect(redirect_http_result["response"]["body"])
-            elif "body.b64" in redirect_http_result["response"]:
-                body_decoded = base64.b64decode(first_response["response"]["body.b64"])
-                meta_redirect_url = meta_redirect(body_decoded)
+            body = _take_body(redirect_http_result, blob_store)
+            if body is not None:
+                meta_redirect_url = meta_redirect(body)
 
             if meta_redirect_url is not None:
                 is_meta_redirect = True
@@ -234,14 +489,36 @@ def get_request(netloc, path="/", headers=None, ssl=False,
     return http_results
 
 
-def get_requests_batch(input_list, results={}, delay_time=0.5, max_threads=100):
+def first_failure(result):
+    """
+    The failure of the first request of a get_request() result, None
+    if it got a response.
+    """
+    if "redirects" in result:
+        return None
+    return result["response"].get("failure")
+
+
+def get_requests_batch(input_list, results={}, delay_time=0.5, max_threads=100,
+                       blob_store=None, body_policy=None, monitor=None,
+                       deadline=None, controller=None):
     """
     This is a parallel version of the HTTP GET primitive.
 
     :param input_list: the input is a list of either dictionaries containing
                        query information, or just domain names (and NOT URLs).
-    :param delay_time: delay before starting each thread
+    :param delay_time: delay before starting each thread at the
+                       initial concurrency, shorter as it grows
     :param max_threads: maximum number of concurrent threads
+    :param blob_store: optional blob store for response bodies
+    :param body_policy: body capture policy, see http_helper.BodyCapture
+    :param monitor: centinel.connectivity.ConnectivityMonitor shared
+                    with the other batches of the run, if any
+    :param deadline: centinel.deadline.Deadline of the run, targets
+                     left when it passes are skipped
+    :param controller: centinel.concurrency.ConcurrencyController that
+                       sets the number of targets in flight, one capped
+                       at max_threads is used if None
     :return: results in dict format
 
     Note: the input list can look like this:
@@ -255,8 +532,15 @@ def get_requests_batch(input_list, results={}, delay_time=0.5, max_threads=100):
         ...
     ]
     """
+    if monitor is None:
+        monitor = ConnectivityMonitor()
+    if deadline is None:
+        deadline = Deadline()
+    if controller is None:
+        controller = ConcurrencyController(maximum=max_threads)
+    request = controller.watch(monitor.watch(get_request, first_failure),
+                               first_failure)
     threads = []
-    thread_error = False
     thread_wait_timeout = 200
     ind = 1
     total_item_count = len(input_list)
@@ -291,34 +575,35 @@ def get_requests_batch(input_list, results={}, delay_time=0.5, max_threads=100):
             host = row
             url = "%s://%s%s" % (theme, host, path)
 
-        wait_time = 0
-        while threading.active_count() > max_threads:
-            time.sleep(1)
-            wait_time += 1
-            if wait_time > thread_wait_timeout:
-                thread_error = True
+        reason = skip_reason(monitor, deadline)
+        if (reason is None and
+                not controller.acquire(deadline.cap(thread_wait_timeout))):
+            if not deadline.expired():
+                results["error"] = "Threads took too long to finish."
                 break
-
-        if thread_error:
-            results["error"] = "Threads took too long to finish."
-            break
+            reason = OUT_OF_TIME
+        if reason is not None:
+            results[url] = skipped(reason, full_url=url)
+            ind += 1
+            continue
 
         if "User-Agent" not in headers:
             headers["User-Agent"] = user_agent
 
         # add just a little bit of delay before starting the thread
         # to avoid overwhelming the connection.
-        time.sleep(delay_time)
+        time.sleep(controller.pace(delay_time))
         log_prefix = "%d/%d: " % (ind, total_item_count)
-        thread = threading.Thread(target=get_request,
+        thread = threading.Thread(target=request,
                                   args=(host, path, headers, ssl,
-                                        results, url, log_prefix))
+                                        results, url, log_prefix,
+                                        None, blob_store, body_policy))
         ind += 1
         thread.setDaemon(1)
         thread.start()
         threads.append(thread)
 
-    for thread in threads:
-        thread.join(thread_wait_timeout)
+    join_all(threads, thread_wait_timeout, deadline)
 
+    monitor.finish(results)
     return results
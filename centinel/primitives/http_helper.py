@@ -1,13 +1,76 @@
+import hashlib
 import pycurl
 import re
-from StringIO import StringIO
+
+
+class BodyCapture:
+    """
+    Receives a response body in chunks, runs it through SHA-256 and
+    keeps at most max_size bytes of it.
+
+    A body capture policy is a dict with these (optional) keys:
+        max_size: number of bytes of the body to keep (default: all)
+        abort_on_cap: stop the transfer once max_size bytes have been
+                      received (default: False, i.e. keep hashing
+                      until the end of the body)
+    """
+
+    def __init__(self, policy=None):
+        if policy is None:
+            policy = {}
+        self.max_size = policy.get("max_size")
+        self.abort_on_cap = policy.get("abort_on_cap", False)
+        self.sha256 = hashlib.sha256()
+        self.length = 0
+        self.chunks = []
+        self.kept = 0
+        self.aborted = False
+
+    @property
+    def truncated(self):
+        return self.kept < self.length
+
+    def write(self, data):
+        """
+        Returns False once the transfer should be stopped.
+        """
+        self.sha256.update(data)
+        self.length += len(data)
+        if self.max_size is None:
+            self.chunks.append(data)
+            self.kept += len(data)
+            return True
+
+        if self.kept < self.max_size:
+            data = data[:self.max_size - self.kept]
+            self.chunks.append(data)
+            self.kept += len(data)
+        if self.abort_on_cap and self.length > self.max_size:
+            self.aborted = True
+            return False
+        return True
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+    def annotate(self, response):
+        """
+        Add length, hash and truncation info to a response dict.
+        """
+        response["body_length"] = self.length
+        response["body_sha256"] = self.sha256.hexdigest()
+        if self.truncated:
+            response["body_truncated"] = True
+        if self.aborted:
+            response["body_aborted"] = True
 
 
 class ICHTTPConnection:
 
     def __init__(self, host='127.0.0.1', port=None, timeout=10):
         self.headers = {}
-        self.body = None
+        self.raw_body = None
+        self.capture = None
         self.reason = None
         self.status = 0
         self.host = host
@@ -45,12 +108,40 @@ class ICHTTPConnection:
         # Now we can actually record the header name and value.
         self.headers[name] = value
 
-    def request(self, path="/", header=None, ssl=False, timeout=None):
+    @property
+    def charset(self):
+        return body_charset(self.headers)
+
+    @property
+    def body(self):
+        """
+        The body decoded with the charset from the response headers.
+        Only decoded when asked for, results store raw_body as is.
+        """
+        if self.raw_body is None:
+            return None
+        errors = 'strict'
+        if self.capture.truncated:
+            # we may have cut a multi-byte character in half
+            errors = 'replace'
+        return decode_body(self.raw_body, self.headers, errors)
+
+    def _write_function(self, data):
+        if not self.capture.write(data):
+            # returning a different length makes curl abort the
+            # transfer with a write error
+            return 0
+
+    def request(self, path="/", header=None, ssl=False, timeout=None,
+                body_policy=None):
+        """
+        :param body_policy: body capture policy, see BodyCapture
+        """
 
         if timeout is None:
             timeout = self.timeout
 
-        buf = StringIO()
+        self.capture = BodyCapture(body_policy)
         c = pycurl.Curl()
 
         if header:
@@ -61,7 +152,7 @@ class ICHTTPConnection:
 
         c.setopt(pycurl.HEADERFUNCTION, self.header_function)
         c.setopt(pycurl.FOLLOWLOCATION, True)
-        c.setopt(pycurl.WRITEDATA, buf)
+        c.setopt(pycurl.WRITEFUNCTION, self._write_function)
         c.setopt(pycurl.TIMEOUT, timeout)
         c.setopt(pycurl.ENCODING, 'identity')
         c.setopt(pycurl.NOSIGNAL, 1)
@@ -77,22 +168,68 @@ class ICHTTPConnection:
                 self.port = 80
             c.setopt(pycurl.URL,"http://"+self.host + ":" + str(self.port) + path)
 
-        c.perform()
+        try:
+            c.perform()
+        except pycurl.error as exp:
+            # we stopped the transfer on purpose
+            if not (self.capture.aborted and
+                    exp.args[0] == pycurl.E_WRITE_ERROR):
+                c.close()
+                raise
 
         self.status = c.getinfo(pycurl.RESPONSE_CODE)
 
         c.close()
 
-        encoding = None
-        if 'content-type' in self.headers:
-            content_type = self.headers['content-type'].lower()
-            match = re.search('charset=(\S+)', content_type)
-            if match:
-                encoding = match.group(1)
-        if encoding is None:
-            # Default encoding for HTML is iso-8859-1.
-            # Other content types may have different default encoding,
-            # or in case of binary data, may have no encoding at all.
-            encoding = 'iso-8859-1'
-
-        self.body = buf.getvalue().decode(encoding)
+        self.raw_body = self.capture.getvalue()
+
+
+def _content_type_header(headers):
+    for name, value in headers.items():
+        if name.lower() == 'content-type':
+            return value.lower()
+    return None
+
+
+def body_charset(headers):
+    """
+    Returns the charset declared in the Content-Type response header,
+    or None.
+    """
+    value = _content_type_header(headers)
+    if value is None:
+        return None
+    match = re.search('charset=([^\s;]+)', value)
+    if match:
+        return match.group(1).strip('"\'')
+    return None
+
+
+def body_content_type(headers):
+    """
+    Returns the media type from the Content-Type response header
+    (without parameters), or None.
+    """
+    value = _content_type_header(headers)
+    if value is None:
+        return None
+    return value.split(';')[0].strip() or None
+
+
+def decode_body(raw_body, headers, errors='strict'):
+    """
+    Decode a raw response body using the charset given in the
+    response headers.
+
+    :param raw_body: the body as received on the wire
+    :param headers: dict of response headers
+    :param errors: how to handle decoding errors, as in str.decode()
+    """
+    encoding = body_charset(headers)
+    if encoding is None:
+        # Default encoding for HTML is iso-8859-1.
+        # Other content types may have different default encoding,
+        # or in case of binary data, may have no encoding at all.
+        encoding = 'iso-8859-1'
+
+    return raw_body.decode(encoding, errors)
@@ -0,0 +1,314 @@
+#
+# probe.py: combined TCP connect + TLS certificate + HTTP GET test
+# that uses a single connection per target.
+#
+# Running tcp_connect, tls and http separately costs one TCP
+# connection each (and up to two TLS handshakes in tls) for the same
+# https URL. This primitive connects once, times the connect, grabs
+# the certificate chain from the handshake (for https) and sends the
+# HTTP request over the same connection. Results are returned in the
+# same format the individual primitives produce so they can be stored
+# in their usual places.
+
+from datetime import datetime
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+from StringIO import StringIO
+
+import centinel.primitives.http as http
+from centinel.concurrency import ConcurrencyController
+from centinel.connectivity import (ConnectivityMonitor, OUT_OF_TIME,
+                                   skip_reason, skipped)
+from centinel.deadline import Deadline, join_all
+from centinel.primitives import tls
+from centinel.primitives.http_helper import (BodyCapture, body_charset,
+                                             body_content_type)
+from centinel.utils import user_agent_pool
+
+# cap on how much of a response we read from the connection
+MAX_RESPONSE_SIZE = 10 * 1024 * 1024
+
+
+class _BufferSocket:
+    """Lets httplib parse a response we have already read."""
+
+    def __init__(self, data):
+        self._fp = StringIO(data)
+
+    def makefile(self, *args, **kwargs):
+        return self._fp
+
+
+# room left for the status line and headers when the read is capped
+# to the body capture size
+HEADER_ALLOWANCE = 64 * 1024
+
+
+def _read_response(conn, timeout, limit=MAX_RESPONSE_SIZE):
+    """
+    Read from the connection until the server closes it, the
+    timeout expires or we hit limit.
+    """
+    chunks = []
+    received = 0
+    deadline = time.time() + timeout
+    while received < limit:
+        if time.time() > deadline:
+            raise socket.timeout("timed out reading response")
+        data = conn.recv(16384)
+        if not data:
+            break
+        chunks.append(data)
+        received += len(data)
+    return "".join(chunks)
+
+
+def _parse_response(raw_response):
+    response = httplib.HTTPResponse(_BufferSocket(raw_response))
+    response.begin()
+    try:
+        raw_body = response.read()
+    except httplib.IncompleteRead as exp:
+        # we either capped the read or the server went away,
+        # keep whatever we got.
+        raw_body = exp.partial
+
+    headers = {}
+    for header in response.msg.headers:
+        if ':' not in header:
+            continue
+        name, value = header.split(':', 1)
+        headers[name.strip()] = value.strip()
+
+    return response.status, response.reason, headers, raw_body
+
+
+def probe(host, port=None, path="/", ssl=False, headers=None, url=None,
+          external=None, log_prefix='', timeout=10, blob_store=None,
+          body_policy=None):
+    """
+    Connect to host once and collect the TCP connect, TLS certificate
+    and HTTP GET results over that one connection.
+
+    :param host: host name, optionally with a port (host:port)
+    :param port: port to use if host does not specify one
+    :param path: HTTP path
+    :param ssl: whether to do a TLS handshake before sending the request
+    :param headers: HTTP request headers
+    :param url: the full URL, used as key in external
+    :param external: dict to store the result in when threading
+    :param log_prefix:
+    :param timeout: socket timeout in seconds
+    :param blob_store: optional blob store for bodies and certificates
+    :param body_policy: body capture policy, see http_helper.BodyCapture
+    :return: dict with "tcp_connect", "http" and (for ssl) "tls" results
+    """
+    netloc = host
+    if len(host.split(":")) == 2:
+        host, port = host.split(":")
+    if port is None:
+        port = 443 if ssl else 80
+    port = int(port)
+
+    if url is None:
+        url = "%s://%s%s" % ("https" if ssl else "http", netloc, path)
+
+    if headers is None:
+        headers = {}
+    if "User-Agent" not in headers:
+        headers["User-Agent"] = random.choice(user_agent_pool)
+
+    logging.debug("%sProbing %s." % (log_prefix, url))
+
+    tcp_result = {"host": host, "port": port}
+    tls_result = None
+    request = {"host": host,
+               "port": port,
+               "path": path,
+               "ssl": ssl,
+               "method": "GET",
+               "headers": headers}
+    response = {}
+    raw_body = None
+
+    address = host
+    try:
+        address = socket.gethostbyname(host)
+        tcp_result["ip"] = address
+    except Exception as err:
+        tcp_result["ip_err"] = str(err)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    conn = None
+    start_time = datetime.now()
+    try:
+        sock.connect((address, port))
+        elapsed = int((datetime.now() - start_time).total_seconds() * 1000)
+        tcp_result["success"] = "true"
+    except Exception as err:
+        elapsed = int((datetime.now() - start_time).total_seconds() * 1000)
+        tcp_result["failure"] = str(err)
+        response["failure"] = str(err)
+    tcp_result["time"] = str(elapsed)
+
+    if "failure" not in tcp_result:
+        conn = sock
+        if ssl:
+            try:
+                conn = tls.TLSConnection(sock, host, timeout)
+                conn.do_handshake()
+                tls_result = tls.cert_chain_result(conn, blob_store)
+            except Exception as err:
+                tls_result = {"tls_error": str(err)}
+            if "tls_error" in tls_result:
+                response["failure"] = tls_result["tls_error"]
+
+    if "failure" not in response:
+        lines = ["GET %s HTTP/1.1" % path, "Host: %s" % netloc]
+        for name, value in headers.items():
+            lines.append("%s: %s" % (name, value))
+        lines.append("Accept-Encoding: identity")
+        lines.append("Connection: close")
+        capture = BodyCapture(body_policy)
+        limit = MAX_RESPONSE_SIZE
+        if capture.abort_on_cap and capture.max_size is not None:
+            # there is no point in reading past the cap, one extra
+            # byte tells us that the body was cut off
+            limit = min(limit, capture.max_size + 1 + HEADER_ALLOWANCE)
+        try:
+            conn.sendall("\r\n".join(lines) + "\r\n\r\n")
+            raw_response = _read_response(conn, timeout, limit)
+            status, reason, response_headers, raw_body = \
+                _parse_response(raw_response)
+            response["status"] = status
+            response["reason"] = reason
+            response["headers"] = response_headers
+            capture.write(raw_body)
+            raw_body = capture.getvalue()
+            http.store_body(response, raw_body, blob_store,
+                            body_charset(response_headers),
+                            body_content_type(response_headers),
+                            capture.truncated)
+            capture.annotate(response)
+        except Exception as err:
+            response["failure"] = str(err)
+
+    if conn is not None:
+        conn.close()
+    else:
+        sock.close()
+
+    # follow redirects (if any) the usual way
+    first_response = {"response": response, "request": request}
+    if raw_body is not None:
+        first_response["_body"] = raw_body
+    http_result = http.get_request(netloc, path, headers, ssl, url=url,
+                                   log_prefix=log_prefix,
+                                   first_response=first_response,
+                                   blob_store=blob_store,
+                                   body_policy=body_policy)
+
+    result = {"tcp_connect": tcp_result,
+              "http": http_result}
+    if ssl:
+        if tls_result is None:
+            tls_result = {"tls_error": tcp_result["failure"]}
+        result["tls"] = tls_result
+
+    # the external result is used when threading to store
+    # the results in the list container provided.
+    if external is not None and type(external) is dict:
+        external[url] = result
+
+    return result
+
+
+def probe_batch(input_list, results={}, delay_time=0.5, max_threads=100,
+                blob_store=None, body_policy=None, monitor=None,
+                deadline=None, controller=None):
+    """
+    This is a parallel version of the combined probe.
+
+    :param input_list: list of dictionaries in the same format
+                       http.get_requests_batch() takes, i.e.
+                       { "host": "www.google.com", "path": "/",
+                         "headers": {}, "ssl": False,
+                         "url": "http://www.google.com/" }
+    :param delay_time: delay before starting each thread at the
+                       initial concurrency, shorter as it grows
+    :param max_threads: maximum number of concurrent threads
+    :param blob_store: optional blob store for bodies and certificates
+    :param body_policy: body capture policy, see http_helper.BodyCapture
+    :param monitor: centinel.connectivity.ConnectivityMonitor shared
+                    with the other batches of the run, if any
+    :param deadline: centinel.deadline.Deadline of the run, targets
+                     left when it passes are skipped
+    :param controller: centinel.concurrency.ConcurrencyController that
+                       sets the number of targets in flight, one capped
+                       at max_threads is used if None
+    :return: results in dict format, keyed by URL
+    """
+    if monitor is None:
+        monitor = ConnectivityMonitor()
+    if deadline is None:
+        deadline = Deadline()
+    if controller is None:
+        controller = ConcurrencyController(maximum=max_threads)
+    # the connect tells us about the network, later failures are
+    # about the target
+    error_of = lambda result: result["tcp_connect"].get("failure")
+    watched_probe = controller.watch(monitor.watch(probe, error_of), error_of)
+    threads = []
+    thread_wait_timeout = 200
+    ind = 1
+    total_item_count = len(input_list)
+    # randomly select one user agent for one input list
+    user_agent = random.choice(user_agent_pool)
+    for row in input_list:
+        if "host" not in row:
+            continue
+        host = row["host"]
+        path = row.get("path", "/")
+        ssl = row.get("ssl", False)
+        headers = {}
+        if type(row.get("headers")) is dict:
+            headers = row["headers"]
+        if "User-Agent" not in headers:
+            headers["User-Agent"] = user_agent
+        url = row.get("url")
+
+        reason = skip_reason(monitor, deadline)
+        if (reason is None and
+                not controller.acquire(deadline.cap(thread_wait_timeout))):
+            if not deadline.expired():
+                results["error"] = "Threads took too long to finish."
+                break
+            reason = OUT_OF_TIME
+        if reason is not None:
+            results[url] = skipped(reason, full_url=url)
+            ind += 1
+            continue
+
+        # add just a little bit of delay before starting the thread
+        # to avoid overwhelming the connection.
+        time.sleep(controller.pace(delay_time))
+
+        log_prefix = "%d/%d: " % (ind, total_item_count)
+        thread = threading.Thread(target=watched_probe,
+                                  args=(host, None, path, ssl, headers,
+                                        url, results, log_prefix, 10,
+                                        blob_store, body_policy))
+        ind += 1
+        thread.setDaemon(1)
+        thread.start()
+        threads.append(thread)
+
+    join_all(threads, thread_wait_timeout, deadline)
+
+    monitor.finish(results)
+    return results
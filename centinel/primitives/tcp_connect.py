@@ -10,6 +10,11 @@ import socket
 import time
 import threading
 
+from centinel.concurrency import ConcurrencyController
+from centinel.connectivity import (ConnectivityMonitor, OUT_OF_TIME,
+                                   skip_reason, skipped)
+from centinel.deadline import Deadline, join_all
+
 def tcp_connect(host, port, external=None, log_prefix=''):
     result = {
         "host" : host,
@@ -49,39 +54,56 @@ def tcp_connect(host, port, external=None, log_prefix=''):
 
     return result
 
-def tcp_connect_batch(input_list, results={}, delay_time=0.1, max_threads=100):
+def tcp_connect_batch(input_list, results={}, delay_time=0.1, max_threads=100,
+                      monitor=None, deadline=None, controller=None):
     """
     This is a parallel version of the TCP connect primitive.
 
     :param input_list: the input is a list of host/port pairs
-    :param delay_time: delay before starting each thread
+    :param delay_time: delay before starting each thread at the
+                       initial concurrency, shorter as it grows
     :param max_threads: maximum number of concurrent threads
+    :param monitor: centinel.connectivity.ConnectivityMonitor shared
+                    with the other batches of the run, if any
+    :param deadline: centinel.deadline.Deadline of the run, targets
+                     left when it passes are skipped
+    :param controller: centinel.concurrency.ConcurrencyController that
+                       sets the number of targets in flight, one capped
+                       at max_threads is used if None
     :return:
     """
+    if monitor is None:
+        monitor = ConnectivityMonitor()
+    if deadline is None:
+        deadline = Deadline()
+    if controller is None:
+        controller = ConcurrencyController(maximum=max_threads)
+    error_of = lambda result: result.get("failure")
+    connect = controller.watch(monitor.watch(tcp_connect, error_of), error_of)
     threads = []
-    thread_error = False
     thread_wait_timeout = 200
     ind = 1
     total_item_count = len(input_list)
     for host,port in input_list:
-        wait_time = 0
-        while threading.active_count() > max_threads:
-            time.sleep(1)
-            wait_time += 1
-            if wait_time > thread_wait_timeout:
-                thread_error = True
+        reason = skip_reason(monitor, deadline)
+        if (reason is None and
+                not controller.acquire(deadline.cap(thread_wait_timeout))):
+            if not deadline.expired():
+                results["error"] = "Threads took too long to finish."
                 break
-
-        if thread_error:
-            results["error"] = "Threads took too long to finish."
-            break
+            reason = OUT_OF_TIME
+        if reason is not None:
+            results[host + ":" + str(port)] = skipped(reason, host=host,
+                                                      port=port)
+            ind += 1
+            continue
 
         # add just a little bit of delay before starting the thread
         # to avoid overwhelming the connection.
-        time.sleep(delay_time)
+        time.sleep(controller.pace(delay_time))
 
         log_prefix = "%d/%d: " % (ind, total_item_count)
-        thread = threading.Thread(target=tcp_connect,
+        thread = threading.Thread(target=connect,
                                   args=(host, port,
                                         results, log_prefix))
         ind += 1
@@ -89,7 +111,7 @@ def tcp_connect_batch(input_list, results={}, delay_time=0.1, max_threads=100):
         thread.start()
         threads.append(thread)
 
-    for thread in threads:
-        thread.join(thread_wait_timeout)
+    join_all(threads, thread_wait_timeout, deadline)
 
+    monitor.finish(results)
     return results
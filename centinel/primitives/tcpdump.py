@@ -18,7 +18,11 @@ from centinel import command
 class Tcpdump():
     """Class to interface between tcpdump and Python"""
 
-    def __init__(self, filename=None, pcap_args=None):
+    def __init__(self, filename=None, pcap_args=None, config=None):
+        """
+        :param config: the configuration to take the tcpdump options
+                       from, the global centinel.conf if None
+        """
         if filename is None:
             temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False)
             temp_file.close()
@@ -31,8 +35,10 @@ class Tcpdump():
             # use the centinel configured tcpdump options if available
             # (if not specified by the user, this will be -i any, so
             # the same as below
-            if 'tcpdump_params' in centinel.conf['experiments']:
-                pcap_args = centinel.conf['experiments']['tcpdump_params']
+            if config is None:
+                config = centinel.conf
+            if 'tcpdump_params' in config['experiments']:
+                pcap_args = config['experiments']['tcpdump_params']
             # for backwards compatability, ensure that we give some
             # pcap args for what to capture
             else:
@@ -1,98 +1,521 @@
-# Dependencies: install M2Crypto with sudo apt-get install
-# python-m2crypto
+# Optional dependency: pyOpenSSL (sudo apt-get install python-openssl)
+# to record the whole certificate chain.
 
+import collections
+import errno
 import logging
+import os
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import select
 
 try:
-    import M2Crypto
-    m2crypto_imported = True
+    from OpenSSL import SSL as OpenSSL_SSL
+    from OpenSSL import crypto as OpenSSL_crypto
+    pyopenssl_imported = True
+    OpenSSL_want_read = OpenSSL_SSL.WantReadError
+    OpenSSL_want_write = OpenSSL_SSL.WantWriteError
 except ImportError:
-    logging.warning("M2Crypto could not be imported. "
-                    "TLS fingerprinting will be disabled.")
-    m2crypto_imported = False
+    logging.info("pyOpenSSL could not be imported. "
+                 "Certificate chains will only include the leaf.")
+    pyopenssl_imported = False
 
+    # nothing raises these without pyOpenSSL
+    class OpenSSL_want_read(Exception):
+        pass
+
+    class OpenSSL_want_write(Exception):
+        pass
+
+import hashlib
+import socket
 import ssl
-import threading
 import time
 
+from centinel.concurrency import ConcurrencyController
+from centinel.connectivity import (ConnectivityMonitor, OUT_OF_TIME,
+                                   SKIPPED, skip_reason, skipped)
+from centinel.deadline import Deadline
+
+
+class TLSWantRead(Exception):
+    pass
+
+
+class TLSWantWrite(Exception):
+    pass
 
-def get_fingerprint(host, port=443, external=None, log_prefix=''):
-    tls_error = None
-    fingerprint_error = None
-    cert = None
 
+class TLSConnection:
+    """
+    Client side of a TLS connection on top of an already connected
+    socket. The protocol version is negotiated in a single handshake
+    (SSLv23 method, i.e. the highest version both ends support).
+
+    pyOpenSSL is used when available since it exposes the whole
+    certificate chain sent by the server. Otherwise we fall back to
+    the ssl module, which only gives us the leaf certificate.
+
+    On non-blocking sockets, do_handshake(), recv() and sendall()
+    raise TLSWantRead or TLSWantWrite when they have to wait for the
+    socket. Blocking callers pass a timeout instead, the calls then
+    wait for the socket themselves. Note that a socket with a timeout
+    is non-blocking underneath, pyOpenSSL raises its want errors on it
+    just the same.
+    """
+
+    def __init__(self, sock, host, timeout=None):
+        """
+        :param timeout: for blocking use, seconds each call may wait
+                        for the socket. None leaves the waiting to the
+                        caller (e.g. an event loop).
+        """
+        self.sock = sock
+        self.host = host
+        self.timeout = timeout
+        if type(host) == unicode:
+            host = host.encode('idna')
+
+        if pyopenssl_imported:
+            context = OpenSSL_SSL.Context(OpenSSL_SSL.SSLv23_METHOD)
+            context.set_verify(OpenSSL_SSL.VERIFY_NONE,
+                               lambda *args: True)
+            self.conn = OpenSSL_SSL.Connection(context, sock)
+            self.conn.set_tlsext_host_name(host)
+            self.conn.set_connect_state()
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.verify_mode = ssl.CERT_NONE
+            self.conn = context.wrap_socket(sock, server_hostname=host,
+                                            do_handshake_on_connect=False)
+
+    def _call(self, function, *args):
+        """
+        Call function on the connection, translating the backend's want
+        errors. With a timeout, wait for the socket and retry (with the
+        same arguments, as OpenSSL requires) until it is done.
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while True:
+            try:
+                try:
+                    return function(*args)
+                except OpenSSL_want_read:
+                    raise TLSWantRead()
+                except OpenSSL_want_write:
+                    raise TLSWantWrite()
+                except ssl.SSLWantReadError:
+                    raise TLSWantRead()
+                except ssl.SSLWantWriteError:
+                    raise TLSWantWrite()
+            except (TLSWantRead, TLSWantWrite) as exp:
+                if deadline is None:
+                    raise
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                if isinstance(exp, TLSWantRead):
+                    select.select([self.sock], [], [], remaining)
+                else:
+                    select.select([], [self.sock], [], remaining)
+
+    def do_handshake(self):
+        self._call(self.conn.do_handshake)
+
+    def version(self):
+        try:
+            if pyopenssl_imported:
+                return self.conn.get_protocol_version_name()
+            return self.conn.version()
+        except Exception:
+            return None
+
+    def peer_chain(self):
+        """
+        Returns the certificates sent by the server in DER format,
+        leaf first.
+        """
+        if pyopenssl_imported:
+            chain = self.conn.get_peer_cert_chain() or []
+            return [OpenSSL_crypto.dump_certificate(OpenSSL_crypto.FILETYPE_ASN1,
+                                                    cert) for cert in chain]
+        der = self.conn.getpeercert(binary_form=True)
+        if der is None:
+            return []
+        return [der]
+
+    def sendall(self, data):
+        if pyopenssl_imported:
+            send = self.conn.send
+        else:
+            # SSLSocket.send() returns 0 instead of raising the want
+            # errors on non-blocking sockets
+            send = self.conn.write
+        sent = 0
+        while sent < len(data):
+            # a retried write has to be given the same buffer
+            chunk = data[sent:sent + 16384]
+            sent += self._call(send, chunk)
+
+    def recv(self, size):
+        """
+        Returns an empty string when the server closes the
+        connection, cleanly or not.
+        """
+        if pyopenssl_imported:
+            try:
+                return self._call(self.conn.recv, size)
+            except (OpenSSL_SSL.ZeroReturnError, OpenSSL_SSL.SysCallError):
+                return ''
+        try:
+            return self._call(self.conn.recv, size)
+        except ssl.SSLZeroReturnError:
+            return ''
+        except ssl.SSLError as exp:
+            # servers often close the connection without close_notify
+            if exp.errno == ssl.SSL_ERROR_EOF or 'eof' in str(exp).lower():
+                return ''
+            raise
+
+    def close(self):
+        try:
+            if pyopenssl_imported:
+                self.conn.shutdown()
+        except Exception:
+            pass
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+def der_fingerprint(der):
+    """
+    SHA-1 fingerprint of a DER encoded certificate as a lower case hex
+    string.
+    """
+    return hashlib.sha1(der).hexdigest()
+
+
+def der_to_pem(der):
+    return ssl.DER_cert_to_PEM_cert(der)
+
+
+def cert_chain_result(tls_conn, blob_store=None):
+    """
+    Builds the TLS result for a completed handshake: the leaf
+    certificate, its fingerprint, the full chain and the negotiated
+    version. If a blob store is given, certificates are stored there
+    in DER format and referenced by hash ("cert_blob", "chain_blobs").
+    """
+    chain = tls_conn.peer_chain()
+    if len(chain) == 0:
+        return {"tls_error": "server did not send a certificate"}
+    result = {"fingerprint": der_fingerprint(chain[0])}
+    if blob_store is not None:
+        result["cert_blob"] = blob_store.put(chain[0])
+        result["chain_blobs"] = [blob_store.put(der) for der in chain]
+    else:
+        result["cert"] = der_to_pem(chain[0])
+        result["chain"] = [der_to_pem(der) for der in chain]
+    version = tls_conn.version()
+    if version is not None:
+        result["version"] = version
+    return result
+
+
+def get_fingerprint(host, port=443, external=None, log_prefix='',
+                    timeout=10, blob_store=None):
+    """
+    Get the certificate (chain) of host:port and its SHA-1 fingerprint
+    using a single handshake.
+
+    :return: (fingerprint, cert) on success, (None, error) on failure.
+             cert is the blob hash of the certificate if a blob store
+             is given.
+    """
     logging.debug("%sGetting TLS certificate "
                   "for %s:%d." % (log_prefix, host, port))
 
+    sock = None
+    tls_conn = None
     try:
-        cert = ssl.get_server_certificate((host, port),
-                                          ssl_version=ssl.PROTOCOL_TLSv1)
-    # if this fails, there's a possibility that SSLv3 handshake was
-    # attempted and rejected by the server. Use TLSv1 instead.
-    except ssl.SSLError:
-        # exception could also happen here
-        try:
-            # this uses the highest version SSL or TLS that both 
-            # endpoints support
-            cert = ssl.get_server_certificate((host, port),
-                                              ssl_version=ssl.PROTOCOL_SSLv23)
-        except Exception as exp:
-            tls_error = str(exp)
+        sock = socket.create_connection((host, port), timeout)
+        tls_conn = TLSConnection(sock, host, timeout)
+        tls_conn.do_handshake()
+        result = cert_chain_result(tls_conn, blob_store)
+    except Exception as exp:
+        result = {"tls_error": str(exp)}
+
+    if tls_conn is not None:
+        tls_conn.close()
+    elif sock is not None:
+        sock.close()
+
+    # the external result is used when threading to store
+    # the results in the list container provided.
+    if external is not None and type(external) is dict:
+        external["%s:%s" % (host, port)] = result
+
+    if "tls_error" in result:
+        return None, result["tls_error"]
+    if "cert_blob" in result:
+        return result["fingerprint"], result["cert_blob"]
+    return result["fingerprint"], result["cert"]
+
+
+def _resolve(target):
+    host, port, log_prefix = target
+    try:
+        return target, socket.gethostbyname(host), None
     except Exception as exp:
-        tls_error = str(exp)
+        return target, None, str(exp)
+
+
+class _Handshake:
+    """State of one in-flight handshake in the TLS engine."""
+
+    def __init__(self, host, port, log_prefix, address, deadline):
+        self.host = host
+        self.port = port
+        self.log_prefix = log_prefix
+        self.key = "%s:%s" % (host, port)
+        self.deadline = deadline
+        self.started = time.time()
+        self.tls_conn = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((address, port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def step(self, blob_store=None):
+        """
+        Advance the connection. Returns "read" or "write" when it has
+        to wait for the socket, or the result dict once done.
+        """
+        if self.tls_conn is None:
+            # the non-blocking connect has finished
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                raise socket.error(err, os.strerror(err))
+            self.tls_conn = TLSConnection(self.sock, self.host)
+        try:
+            self.tls_conn.do_handshake()
+        except TLSWantRead:
+            return "read"
+        except TLSWantWrite:
+            return "write"
+        return cert_chain_result(self.tls_conn, blob_store)
+
+    def close(self):
+        if self.tls_conn is not None:
+            self.tls_conn.close()
+        else:
+            self.sock.close()
+
 
-    # this comes out as unicode, but m2crypto breaks if it gets
-    # something other than a string, so convert to ascii
-    if type(cert) == unicode:
-        cert = cert.encode('ascii', 'ignore')
+class TLSEngine:
+    """
+    Event loop that performs many TLS handshakes concurrently on
+    non-blocking sockets, so we don't need a thread per host. Host
+    names are resolved ahead of time by a small pool of threads.
+    """
+
+    def __init__(self, results, max_concurrent=1000, timeout=10,
+                 resolver_threads=20, blob_store=None, monitor=None,
+                 deadline=None, controller=None):
+        self.results = results
+        if monitor is None:
+            monitor = ConnectivityMonitor()
+        self.monitor = monitor
+        if deadline is None:
+            deadline = Deadline()
+        self.deadline = deadline
+        if controller is None:
+            controller = ConcurrencyController(maximum=max_concurrent)
+        self.controller = controller
+        self.blob_store = blob_store
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.resolver_threads = resolver_threads
+        self.active = {}
+        # targets that could not be started for lack of file descriptors
+        self.retry = collections.deque()
+        if hasattr(select, "poll"):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+        self.waiting_for = {}
+
+    def _watch(self, handshake, event):
+        fd = handshake.fileno()
+        if self.poller is not None:
+            mask = select.POLLIN if event == "read" else select.POLLOUT
+            if fd in self.waiting_for:
+                self.poller.modify(fd, mask)
+            else:
+                self.poller.register(fd, mask)
+        self.waiting_for[fd] = event
 
-    if tls_error is None and m2crypto_imported:
+    def _finish(self, handshake, result):
+        fd = handshake.fileno()
+        if fd in self.waiting_for:
+            if self.poller is not None:
+                self.poller.unregister(fd)
+            del self.waiting_for[fd]
+        del self.active[fd]
+        handshake.close()
+        if "tls_error" in result:
+            logging.debug("%sTLS handshake with %s "
+                          "failed: %s" % (handshake.log_prefix,
+                                          handshake.key,
+                                          result["tls_error"]))
+        self.results[handshake.key] = result
+        # only failures to connect tell us about the network
+        error = None
+        if handshake.tls_conn is None:
+            error = result.get("tls_error")
+        self.monitor.record(error)
+        self.controller.record(handshake.started, error)
+
+    def _step(self, handshake):
         try:
-            x509 = M2Crypto.X509.load_cert_string(cert,
-                                                  M2Crypto.X509.FORMAT_PEM)
-            fingerprint = x509.get_fingerprint('sha1')
+            outcome = handshake.step(self.blob_store)
         except Exception as exp:
-            fingerprint_error = str(exp)
+            self._finish(handshake, {"tls_error": str(exp)})
+            return
+        if type(outcome) is dict:
+            self._finish(handshake, outcome)
+        else:
+            self._watch(handshake, outcome)
 
-    if not m2crypto_imported:
-        fingerprint_error = "M2Crypto could not be imported."
+    def _start(self, target, address, error):
+        host, port, log_prefix = target
+        if error is not None:
+            self.results["%s:%s" % (host, port)] = {"tls_error": error}
+            return
+        reason = skip_reason(self.monitor, self.deadline)
+        if reason is not None:
+            self.results["%s:%s" % (host, port)] = skipped(reason)
+            return
+        logging.debug("%sGetting TLS certificate "
+                      "for %s:%d." % (log_prefix, host, port))
+        try:
+            handshake = _Handshake(host, port, log_prefix, address,
+                                   time.time() + self.deadline.cap(self.timeout))
+        except socket.error as exp:
+            if (exp.errno in (errno.EMFILE, errno.ENFILE) and
+                    len(self.active) > 0):
+                # we are out of sockets, not the host: try again once
+                # some of the handshakes in flight are done
+                logging.warning("Out of file descriptors with %d handshakes "
+                                "in flight, lowering the limit" %
+                                len(self.active))
+                self.controller.back_off(len(self.active))
+                self.retry.append((target, address, error))
+                return
+            self.results["%s:%s" % (host, port)] = {"tls_error": str(exp)}
+            return
+        except Exception as exp:
+            self.results["%s:%s" % (host, port)] = {"tls_error": str(exp)}
+            return
+        self.active[handshake.fileno()] = handshake
+        # wait for the connect to finish
+        self._watch(handshake, "write")
 
-    # the external result is used when threading to store
-    # the results in the list container provided.
-    row = "%s:%s" % (host, port)
-
-    # handle return value based on exception types
-    if tls_error is None and fingerprint_error is None:
-        if external is not None and type(external) is dict:
-            external[row] = {"cert": cert,
-                             "fingerprint": fingerprint.lower()}
-        return fingerprint.lower(), cert
-    elif tls_error is None and fingerprint_error is not None:
-        if external is not None and type(external) is dict:
-            external[row] = {"cert": cert,
-                             "fingerprint_error": fingerprint_error}
-        return fingerprint_error, cert
-    else:
-        if external is not None and type(external) is dict:
-            external[row] = {"tls_error": tls_error,
-                             "fingerprint_error": fingerprint_error}
-        return fingerprint_error, tls_error
+    def _poll(self, wait):
+        if len(self.waiting_for) == 0:
+            time.sleep(wait)
+            return []
+        if self.poller is not None:
+            return [fd for fd, _ in self.poller.poll(wait * 1000)]
+        readers = [fd for fd, event in self.waiting_for.items()
+                   if event == "read"]
+        writers = [fd for fd, event in self.waiting_for.items()
+                   if event == "write"]
+        readable, writable, _ = select.select(readers, writers, [], wait)
+        return readable + writable
+
+    def run(self, targets):
+        """
+        :param targets: list of (host, port, log_prefix) tuples
+        """
+        pool = ThreadPool(self.resolver_threads)
+        resolved = pool.imap_unordered(_resolve, targets)
+        pending = len(targets)
+        try:
+            while pending > 0 or self.retry or len(self.active) > 0:
+                if self.monitor.aborted or self.deadline.expired():
+                    # don't wait for the resolvers or the handshakes
+                    # in flight either
+                    reason = SKIPPED
+                    if self.deadline.expired():
+                        reason = OUT_OF_TIME
+                    for host, port, log_prefix in targets:
+                        key = "%s:%s" % (host, port)
+                        if key not in self.results:
+                            self.results[key] = skipped(reason)
+                    break
+                # start new handshakes for the hosts that are resolved
+                while ((pending > 0 or self.retry) and
+                       len(self.active) < int(self.controller.limit)):
+                    if self.retry:
+                        target, address, error = self.retry.popleft()
+                    else:
+                        try:
+                            target, address, error = resolved.next(timeout=0)
+                        except TimeoutError:
+                            break
+                        pending -= 1
+                    self._start(target, address, error)
+
+                for fd in self._poll(0.05):
+                    if fd in self.active:
+                        self._step(self.active[fd])
+
+                now = time.time()
+                for handshake in self.active.values():
+                    if now > handshake.deadline:
+                        self._finish(handshake, {"tls_error": "timed out"})
+        finally:
+            pool.terminate()
+            for handshake in self.active.values():
+                handshake.close()
+        self.monitor.finish(self.results)
+        return self.results
 
 
 def get_fingerprint_batch(input_list, results={}, default_port=443,
-                          delay_time=0.5, max_threads=100):
+                          delay_time=0.5, max_threads=100,
+                          max_concurrent=1000, timeout=10, blob_store=None,
+                          monitor=None, deadline=None, controller=None):
     """
-    This is a parallel version of the TLS fingerprint primitive.
+    This is a parallel version of the TLS fingerprint primitive. All
+    handshakes are driven by a single event loop (see TLSEngine).
 
     :param input_list: the input is a list of host:ports.
     :param default_port: default port to use when no port specified
-    :param delay_time: delay before starting each thread
-    :param max_threads: maximum number of concurrent threads
+    :param delay_time: unused, kept for backwards compatibility
+    :param max_threads: maximum number of threads resolving host names
+    :param max_concurrent: maximum number of concurrent handshakes
+    :param timeout: time in seconds allowed for each connection
+    :param blob_store: optional blob store for the certificates
+    :param monitor: centinel.connectivity.ConnectivityMonitor shared
+                    with the other batches of the run, if any
+    :param deadline: centinel.deadline.Deadline of the run, targets
+                     left when it passes are skipped
+    :param controller: centinel.concurrency.ConcurrencyController that
+                       sets the number of concurrent handshakes, one
+                       capped at max_concurrent is used if None
     :return:
     """
-    threads = []
-    thread_error = False
-    thread_wait_timeout = 200
+    targets = []
     ind = 1
     total_item_count = len(input_list)
     for row in input_list:
@@ -104,33 +527,13 @@ def get_fingerprint_batch(input_list, results={}, default_port=443,
         else:
             continue
 
-        port = int(port)
-        wait_time = 0
-        while threading.active_count() > max_threads:
-            time.sleep(1)
-            wait_time += 1
-            if wait_time > thread_wait_timeout:
-                thread_error = True
-                break
-
-        if thread_error:
-            results["error"] = "Threads took too long to finish."
-            break
-
-        # add just a little bit of delay before starting the thread
-        # to avoid overwhelming the connection.
-        time.sleep(delay_time)
-
         log_prefix = "%d/%d: " % (ind, total_item_count)
-        thread = threading.Thread(target=get_fingerprint,
-                                  args=(host, port,
-                                        results, log_prefix))
+        targets.append((host, int(port), log_prefix))
         ind += 1
-        thread.setDaemon(1)
-        thread.start()
-        threads.append(thread)
-
-    for thread in threads:
-        thread.join(thread_wait_timeout)
 
-    return results
+    engine = TLSEngine(results, max_concurrent=max_concurrent,
+                       timeout=timeout,
+                       resolver_threads=min(max_threads, 20),
+                       blob_store=blob_store, monitor=monitor,
+                       deadline=deadline, controller=controller)
+    return engine.run(targets)
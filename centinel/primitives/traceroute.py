@@ -15,6 +15,9 @@ from sys import platform
 import trparse
 
 from centinel import command
+from centinel.concurrency import ConcurrencyController
+from centinel.connectivity import OUT_OF_TIME, skipped
+from centinel.deadline import Deadline, join_all
 
 
 def traceroute(domain, method="udp", cmd_arguments=None,
@@ -144,7 +147,8 @@ def traceroute(domain, method="udp", cmd_arguments=None,
 
 
 def traceroute_batch(input_list, results={}, method="udp", cmd_arguments=None,
-                     delay_time=0.1, max_threads=100):
+                     delay_time=0.1, max_threads=100, deadline=None,
+                     controller=None):
     """
     This is a parallel version of the traceroute primitive.
 
@@ -152,34 +156,41 @@ def traceroute_batch(input_list, results={}, method="udp", cmd_arguments=None,
     :param method: the packet type used for traceroute, UDP by default
     :param cmd_arguments: the list of arguments that need to be passed
                         to traceroute.
-    :param delay_time: delay before starting each thread
+    :param delay_time: delay before starting each thread at the
+                       initial concurrency, shorter as it grows
     :param max_threads: maximum number of concurrent threads
+    :param deadline: centinel.deadline.Deadline of the run, targets
+                     left when it passes are skipped
+    :param controller: centinel.concurrency.ConcurrencyController that
+                       sets the number of targets in flight, one capped
+                       at max_threads is used if None
     :return:
     """
+    if deadline is None:
+        deadline = Deadline()
+    if controller is None:
+        controller = ConcurrencyController(maximum=max_threads)
+    trace = controller.watch(traceroute, lambda result: result.get("error"))
     threads = []
-    thread_error = False
     thread_wait_timeout = 200
     ind = 1
     total_item_count = len(input_list)
     for domain in input_list:
-        wait_time = 0
-        while threading.active_count() > max_threads:
-            time.sleep(1)
-            wait_time += 1
-            if wait_time > thread_wait_timeout:
-                thread_error = True
+        if (deadline.expired() or
+                not controller.acquire(deadline.cap(thread_wait_timeout))):
+            if not deadline.expired():
+                results["error"] = "Threads took too long to finish."
                 break
-
-        if thread_error:
-            results["error"] = "Threads took too long to finish."
-            break
+            results[domain] = skipped(OUT_OF_TIME, domain=domain)
+            ind += 1
+            continue
 
         # add just a little bit of delay before starting the thread
         # to avoid overwhelming the connection.
-        time.sleep(delay_time)
+        time.sleep(controller.pace(delay_time))
 
         log_prefix = "%d/%d: " % (ind, total_item_count)
-        thread = threading.Thread(target=traceroute,
+        thread = threading.Thread(target=trace,
                                   args=(domain, method, cmd_arguments,
                                         results, log_prefix))
         ind += 1
@@ -187,8 +198,7 @@ def traceroute_batch(input_list, results={}, method="udp", cmd_arguments=None,
         thread.start()
         threads.append(thread)
 
-    for thread in threads:
-        thread.join(thread_wait_timeout)
+    join_all(threads, thread_wait_timeout, deadline)
 
     return results
 
@@ -0,0 +1,47 @@
+import multiprocessing
+
+import pytest
+
+from centinel import concurrency
+from centinel.experiments import baseline
+
+
+def failing_shard(shard):
+    raise ValueError("shard %d failed" % shard)
+
+
+class TestBaseline:
+
+    def test_sharded_error(self, monkeypatch):
+        """
+        test that an error in a shard comes out of measure_sharded()
+        as it is, and that the worker processes are gone afterwards.
+        """
+        monkeypatch.setattr(baseline, "_measure_shard", failing_shard)
+        monkeypatch.setattr(baseline.planner, "shard_plan",
+                            lambda plan, processes: [1, 2])
+        exp = baseline.BaselineExperiment({})
+        exp.processes = 2
+        with pytest.raises(ValueError) as error:
+            exp.measure_sharded({}, {})
+        assert "failed" in str(error.value)
+        assert multiprocessing.active_children() == []
+        assert baseline._sharded_experiment is None
+
+    def test_concurrency_ceilings(self, monkeypatch):
+        """
+        test that the ceilings come from the config (set on the class by
+        the client), can be overridden by the schedule, and end up in
+        the recorded stats.
+        """
+        exp = baseline.BaselineExperiment({})
+        assert exp.max_threads == concurrency.MAX_THREADS
+        monkeypatch.setattr(baseline.BaselineExperiment, "max_threads", 800)
+        monkeypatch.setattr(baseline.BaselineExperiment, "params",
+                            {"max_handshakes": 3000})
+        exp = baseline.BaselineExperiment({})
+        assert (exp.max_threads, exp.max_handshakes) == (800, 3000)
+
+        controller = concurrency.ConcurrencyController(maximum=exp.max_threads)
+        exp.record_concurrency("http", controller)
+        assert exp.concurrency["http"][0]["maximum"] == 800
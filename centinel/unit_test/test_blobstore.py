@@ -0,0 +1,103 @@
+import errno
+import hashlib
+import os
+import tarfile
+import threading
+
+import pytest
+
+from centinel import blobstore
+from centinel.blobstore import BlobStore
+
+
+class TestBlobStore:
+
+    @pytest.fixture
+    def store(self, tmpdir):
+        return BlobStore(str(tmpdir.join("blobs")))
+
+    def test_put_returns_sha256(self, store):
+        """
+        test that put() references data by its SHA-256 hex digest
+        and the data can be read back.
+        """
+        data = "<html>blocked</html>"
+        digest = store.put(data)
+        assert digest == hashlib.sha256(data).hexdigest()
+        assert store.get(digest) == data
+        assert digest in store
+
+    def test_duplicates_stored_once(self, store):
+        """
+        test that the same payload is only stored once.
+        """
+        for i in range(10):
+            store.put("same block page")
+        store.put("another page")
+        assert len(store) == 2
+        stats = store.stats()
+        assert stats["bytes_in"] == 10 * len("same block page") + len("another page")
+        assert stats["bytes_stored"] == len("same block page") + len("another page")
+
+    def test_concurrent_put(self, store, monkeypatch):
+        """
+        test that a put() of a blob another thread is still writing
+        only returns once the blob can be read.
+        """
+        rename = os.rename
+        renaming = threading.Event()
+        release = threading.Event()
+
+        def slow_rename(source, destination):
+            renaming.set()
+            release.wait()
+            rename(source, destination)
+        monkeypatch.setattr(blobstore.os, "rename", slow_rename)
+
+        data = "same block page"
+        first = threading.Thread(target=store.put, args=(data,))
+        first.start()
+        renaming.wait()
+        digests = []
+        second = threading.Thread(target=lambda: digests.append(
+            store.get(store.put(data))))
+        second.start()
+        second.join(0.2)
+        assert second.is_alive()
+        release.set()
+        first.join()
+        second.join()
+        assert digests == [data]
+        assert store.stats()["bytes_stored"] == len(data)
+
+    def test_failed_put(self, store, monkeypatch):
+        """
+        test that a blob that could not be written is forgotten and
+        leaves nothing behind, so that it is not archived.
+        """
+        def no_space(source, destination):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        monkeypatch.setattr(blobstore.os, "rename", no_space)
+        with pytest.raises(OSError):
+            store.put("a")
+        digest = hashlib.sha256("a").hexdigest()
+        assert digest not in store
+        assert [name for name in os.listdir(store.directory)
+                if not os.path.isdir(os.path.join(store.directory, name))] == []
+
+        monkeypatch.undo()
+        assert store.put("a") == digest
+        assert store.get(digest) == "a"
+
+    def test_archive(self, store, tmpdir):
+        """
+        test that the archive contains one member per blob, named
+        after its digest.
+        """
+        digests = set([store.put("a"), store.put("b"), store.put("a")])
+        archive_path = str(tmpdir.join("blobs.tar.bz2"))
+        store.archive(archive_path)
+        with tarfile.open(archive_path) as tar_file:
+            assert set(tar_file.getnames()) == digests
+        store.delete()
+        assert not os.path.exists(store.directory)
@@ -0,0 +1,56 @@
+import json
+import time
+
+import pytest
+
+from ..checkpoint import Checkpoint
+from ..connectivity import skipped
+
+
+class TestCheckpoint:
+
+    @pytest.fixture
+    def path(self, tmpdir):
+        return str(tmpdir.join("_checkpoint-baseline-baseline.json"))
+
+    def test_resume(self, path):
+        """
+        test that results tracked by one run are available to the
+        next run of the same experiment.
+        """
+        checkpoint = Checkpoint(path, window=3600)
+        results = {}
+        checkpoint.track("dns", results)
+        results["a.example"] = ["result a"]
+        checkpoint.flush()
+        # shows up in a later flush as well
+        results["b.example"] = ["result b"]
+        results["error"] = "Threads took too long to finish."
+        # measured by the next run
+        results["c.example"] = [skipped(domain="c.example")]
+        checkpoint.blob_dir = "/tmp/_blobs"
+        checkpoint.flush()
+
+        resumed = Checkpoint(path, window=3600)
+        assert resumed.has_results()
+        assert resumed.blob_dir == "/tmp/_blobs"
+        assert resumed.completed("dns") == {"a.example": ["result a"],
+                                            "b.example": ["result b"]}
+        assert resumed.completed("http") == {}
+
+    def test_window(self, path):
+        """
+        test that results older than the window are not reused.
+        """
+        checkpoint = Checkpoint(path)
+        checkpoint.update("tls", {"a.example:443": {"fingerprint": "a"}})
+        checkpoint.flush()
+
+        with open(path) as file_p:
+            state = json.load(file_p)
+        state["phases"]["tls"]["a.example:443"][0] = time.time() - 7200
+        with open(path, "w") as file_p:
+            json.dump(state, file_p)
+
+        assert Checkpoint(path, window=3600).completed("tls") == {}
+        assert len(Checkpoint(path).completed("tls")) == 1
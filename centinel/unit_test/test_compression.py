@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from .. import compression
+
+DATA = json.dumps([{"url": "http://site%d.example/" % i, "status": 200,
+                    "body": "<html>%s</html>" % ("x" * (i % 300))}
+                   for i in range(20000)])
+
+
+class TestCompression:
+
+    @pytest.mark.parametrize("codec", compression.available())
+    def test_round_trip(self, codec):
+        """
+        test that data compressed with each codec is read back by the
+        format-detecting reader.
+        """
+        compressed = compression.compress(DATA, codec)
+        assert compression.detect(compressed).name == codec
+        assert compression.decompress(compressed) == DATA
+
+    @pytest.mark.parametrize("codec", compression.available())
+    def test_threads(self, codec, tmpdir):
+        """
+        test that compressing with several threads writes files the
+        reader can handle.
+        """
+        path = str(tmpdir.join("result.json"))
+        with compression.open_writer(path, codec, level=1, threads=4) as writer:
+            for i in range(0, len(DATA), 4096):
+                writer.write(DATA[i:i + 4096])
+        assert compression.read_file(path) == DATA
+
+    def test_unavailable_codec(self):
+        """
+        test that unknown codecs fall back to the default one.
+        """
+        assert compression.get_codec("rar").name == compression.DEFAULT_CODEC
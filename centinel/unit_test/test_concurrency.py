@@ -0,0 +1,132 @@
+import threading
+import time
+
+from centinel import concurrency
+from centinel.concurrency import ConcurrencyController, MAX_THREADS
+from centinel.connectivity import ConnectivityMonitor
+from centinel.primitives import tcp_connect
+
+
+class TestConcurrencyController:
+
+    def test_increase(self):
+        """
+        test that the limit grows by one per success until the first
+        timeout, then by one per round of successes.
+        """
+        controller = ConcurrencyController(initial=4, maximum=10)
+        for i in range(3):
+            assert controller.acquire(0)
+            controller.release(time.time())
+        assert controller.limit == 7
+        assert controller.in_flight == 0
+        for i in range(5):
+            controller.record(time.time())
+        assert controller.limit == 10
+
+        controller.record(time.time(), "timed out")
+        assert controller.limit == 5
+        assert not controller.slow_start
+        for i in range(5):
+            controller.record(time.time())
+        assert 5.9 < controller.limit < 6.1
+
+    def test_ceiling(self, monkeypatch):
+        """
+        test that the limit can grow past the old fixed thread count up
+        to the default ceiling, and that the ceiling is recorded.
+        """
+        monkeypatch.setattr(concurrency, "descriptor_limit", lambda: None)
+        controller = ConcurrencyController()
+        for i in range(MAX_THREADS):
+            controller.record(time.time())
+        assert MAX_THREADS > 100
+        assert controller.limit == MAX_THREADS
+        assert controller.stats()["maximum"] == MAX_THREADS
+
+    def test_descriptor_limit(self, monkeypatch):
+        """
+        test that the ceiling is capped by the number of file
+        descriptors, and that running out of them lowers it to what
+        fit.
+        """
+        monkeypatch.setattr(concurrency, "descriptor_limit", lambda: 50)
+        controller = ConcurrencyController(maximum=1000)
+        assert controller.maximum == 50
+
+        controller.limit = 40
+        controller.back_off(30)
+        assert controller.limit == 30
+        assert controller.maximum == 30
+        for i in range(100):
+            controller.record(time.time())
+        assert controller.limit == 30
+        assert controller.stats()["maximum"] == 30
+
+    def test_decrease(self):
+        """
+        test that timeouts halve the limit once per congestion event,
+        and that failures about the target don't.
+        """
+        controller = ConcurrencyController(initial=16, maximum=16)
+        started = time.time()
+        time.sleep(0.01)
+        controller.record(time.time(), "Connection refused")
+        assert controller.limit == 16
+        controller.record(time.time(), "timed out")
+        assert controller.limit == 8
+        # dispatched before the limit was cut
+        controller.record(started, "timed out")
+        controller.record(started, "timed out")
+        assert controller.limit == 8
+        time.sleep(0.01)
+        controller.record(time.time(), "timed out")
+        assert controller.limit == 4
+        for i in range(10):
+            controller.record(time.time(), "timed out")
+        assert controller.limit == 1
+        assert controller.stats() == {"initial": 16, "final": 1,
+                                      "lowest": 1, "highest": 16,
+                                      "maximum": 16, "decreases": 4}
+
+    def test_latency(self):
+        """
+        test that the limit stops growing when responses slow down.
+        """
+        controller = ConcurrencyController(initial=2, maximum=100)
+        for i in range(5):
+            controller.record(time.time() - 0.1)
+        limit = controller.limit
+        for i in range(5):
+            controller.record(time.time() - 1)
+        assert not controller.healthy()
+        assert controller.limit == limit
+
+    def test_acquire(self):
+        """
+        test that dispatch waits for a slot and gives up after the
+        timeout.
+        """
+        controller = ConcurrencyController(initial=1, maximum=1)
+        assert controller.acquire(0)
+        start = time.time()
+        assert not controller.acquire(0.2)
+        assert time.time() - start >= 0.2
+        release = threading.Timer(0.1, controller.release, [time.time()])
+        release.start()
+        assert controller.acquire(5)
+        release.join()
+
+    def test_batch(self):
+        """
+        test that batches hand each target's outcome to the controller.
+        """
+        controller = ConcurrencyController(initial=2, maximum=5)
+        results = {}
+        tcp_connect.tcp_connect_batch([("a.example", 80), ("b.example", 80)],
+                                      results=results, delay_time=0,
+                                      monitor=ConnectivityMonitor(),
+                                      controller=controller)
+        assert "a.example:80" in results and "b.example:80" in results
+        assert controller.in_flight == 0
+        assert controller.stats()["highest"] >= 2
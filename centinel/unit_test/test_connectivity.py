@@ -0,0 +1,75 @@
+import socket
+
+from centinel import connectivity
+from centinel.connectivity import ConnectivityMonitor
+from centinel.primitives import tcp_connect
+
+
+class TestConnectivity:
+
+    def test_network_failures(self):
+        """
+        test that only network-level failures in a row trip the
+        monitor.
+        """
+        monitor = ConnectivityMonitor(threshold=3)
+        monitor.record("timed out")
+        monitor.record("[Errno 101] Network is unreachable")
+        monitor.record(None)
+        monitor.record("[Errno 111] Connection refused")
+        monitor.record("timed out")
+        assert not monitor.tripped()
+        monitor.record("timed out")
+        monitor.record("timed out")
+        assert monitor.tripped()
+
+    def test_canaries(self):
+        """
+        test that the canaries come from the config if it has any, and
+        that the centinel server is one of them.
+        """
+        canaries = connectivity.canaries(None, "https://server.example:8082")
+        assert canaries == connectivity.CANARIES + [("server.example", 8082)]
+        assert all(port == 443 for host, port in connectivity.CANARIES)
+        canaries = connectivity.canaries(["example.com", "10.0.0.1:8443"],
+                                         "http://server.example")
+        assert canaries == [("example.com", 443), ("10.0.0.1", 8443),
+                            ("server.example", 80)]
+
+    def test_resume(self):
+        """
+        test that dispatch goes on if a canary answers.
+        """
+        canary = socket.socket()
+        canary.bind(("127.0.0.1", 0))
+        canary.listen(1)
+        monitor = ConnectivityMonitor(threshold=1,
+                                      canaries=[canary.getsockname()])
+        monitor.record("timed out")
+        assert monitor.proceed()
+        assert not monitor.tripped()
+        canary.close()
+
+    def test_abort(self):
+        """
+        test that the remaining targets are skipped once no canary
+        answers.
+        """
+        canary = socket.socket()
+        canary.bind(("127.0.0.1", 0))
+        address = canary.getsockname()
+        canary.close()
+        monitor = ConnectivityMonitor(threshold=1, canaries=[address],
+                                      max_pause=0)
+        monitor.record("timed out")
+        assert not monitor.proceed()
+        assert monitor.aborted
+
+        results = {}
+        tcp_connect.tcp_connect_batch([("a.example", 80), ("b.example", 443)],
+                                      results=results, monitor=monitor)
+        assert results["a.example:80"] == {"host": "a.example", "port": 80,
+                                           "skipped": connectivity.SKIPPED}
+        assert connectivity.is_skipped(results["b.example:443"])
+        assert connectivity.count_skipped(results) == 2
+        assert "error" in results
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from centinel.content_cache import ContentCache, content_hash
+
+
+class TestContentCache:
+
+    @pytest.fixture
+    def cache(self, tmpdir):
+        return ContentCache(str(tmpdir.join("cache")))
+
+    def test_materialize_links(self, cache, tmpdir):
+        """
+        test that cached files are linked into each home.
+        """
+        data = "http://example.com\n"
+        digest = content_hash(data)
+        assert not cache.materialize(digest, str(tmpdir.join("missing")))
+        assert cache.add(digest, data)
+
+        homes = [tmpdir.mkdir("home%d" % i) for i in range(3)]
+        for home in homes:
+            assert cache.materialize(digest, str(home.join("input.txt")))
+        for home in homes:
+            assert home.join("input.txt").read() == data
+        # one copy in the cache, linked from every home
+        assert os.stat(str(homes[0].join("input.txt"))).st_nlink == 4
+
+    def test_replace_keeps_cache(self, cache, tmpdir):
+        """
+        test that a new version replaces the link instead of writing
+        through it.
+        """
+        old, new = "version 1", "version 2"
+        cache.add(content_hash(old), old)
+        cache.add(content_hash(new), new)
+        path = str(tmpdir.join("exp.py"))
+        cache.materialize(content_hash(old), path)
+        cache.materialize(content_hash(new), path)
+        assert open(path).read() == new
+        assert open(os.path.join(cache.directory, content_hash(old))).read() == old
+
+    def test_bad_hash(self, cache):
+        """
+        test that contents that don't match their hash are not cached.
+        """
+        assert not cache.add(content_hash("something else"), "data")
+        assert content_hash("something else") not in cache
+
+    def test_prune(self, cache, tmpdir):
+        """
+        test that only files no home links to are pruned.
+        """
+        used, unused = "used", "unused"
+        cache.add(content_hash(used), used)
+        cache.add(content_hash(unused), unused)
+        cache.materialize(content_hash(used), str(tmpdir.join("home_file")))
+        assert cache.prune() == 1
+        assert content_hash(used) in cache
+        assert content_hash(unused) not in cache
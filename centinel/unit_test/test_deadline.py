@@ -0,0 +1,49 @@
+import threading
+import time
+
+from centinel import connectivity
+from centinel.connectivity import ConnectivityMonitor
+from centinel.deadline import Deadline, join_all
+from centinel.primitives import tcp_connect
+
+
+class TestDeadline:
+
+    def test_cap(self):
+        """
+        test that timeouts are capped by the time left.
+        """
+        assert Deadline().remaining() is None
+        assert Deadline().cap(200) == 200
+        assert not Deadline().expired()
+        assert Deadline(10).cap(200) <= 10
+        assert Deadline(0).expired()
+        assert Deadline(0).cap(200) == 0
+
+    def test_join_all(self):
+        """
+        test that threads are waited for once, not once per thread.
+        """
+        stop = threading.Event()
+        threads = [threading.Thread(target=stop.wait) for i in range(5)]
+        for thread in threads:
+            thread.setDaemon(1)
+            thread.start()
+        start = time.time()
+        assert join_all(threads, 0.5) == 5
+        assert join_all(threads, 10, Deadline(0.2)) == 5
+        assert time.time() - start < 2
+        stop.set()
+        assert join_all(threads, 10) == 0
+
+    def test_out_of_time(self):
+        """
+        test that batches skip the targets left once the deadline has
+        passed.
+        """
+        results = {}
+        tcp_connect.tcp_connect_batch([("a.example", 80)], results=results,
+                                      monitor=ConnectivityMonitor(),
+                                      deadline=Deadline(0))
+        assert results["a.example:80"]["skipped"] == connectivity.OUT_OF_TIME
+        assert results["error"] == "Skipped 1 targets (out of time)."
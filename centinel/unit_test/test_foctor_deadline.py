@@ -0,0 +1,133 @@
+import errno
+import os
+import threading
+import time
+
+import pytest
+
+from centinel.primitives.foctor_core.foctor_deadline import (TimeoutError,
+                                                            check_deadline,
+                                                            timeout,
+                                                            wait_for_driver)
+
+
+@timeout(0.5, on_timeout=lambda error: "Timed-out")
+def spin():
+    while True:
+        check_deadline()
+        time.sleep(0.05)
+
+
+class FakeDriver:
+    """Records commands, and whether two of them ever overlapped"""
+
+    def __init__(self):
+        self.busy = False
+        self.overlapped = False
+        self.commands = []
+
+    def command(self, name, duration):
+        if self.busy:
+            self.overlapped = True
+        self.busy = True
+        time.sleep(duration)
+        self.commands.append(name)
+        self.busy = False
+
+
+@timeout(0.2, on_timeout=lambda error: "Timed-out")
+def stuck_command(driver, duration):
+    driver.command("stuck", duration)
+    return "No Error"
+
+
+@timeout(2, on_timeout=lambda error: "Timed-out")
+def next_command(driver):
+    driver.command("next", 0)
+    return "No Error"
+
+
+class TestDeadline:
+
+    def test_parallel_timeouts(self):
+        """
+        test that timeouts in several threads at once all fire.
+        """
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(spin()))
+                   for i in range(4)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == ["Timed-out"] * 4
+        assert time.time() - start < 2
+
+    def test_nested_deadline(self):
+        """
+        test that an inner timeout does not outlive the outer one.
+        """
+        @timeout(10, on_timeout=str)
+        def inner():
+            time.sleep(5)
+
+        @timeout(0.5, on_timeout=str)
+        def outer():
+            return inner()
+
+        start = time.time()
+        assert outer() == os.strerror(errno.ETIME)
+        assert time.time() - start < 2
+
+    def test_raises(self):
+        """
+        test that errors and timeouts reach the caller.
+        """
+        @timeout(0.2)
+        def slow():
+            time.sleep(1)
+
+        @timeout(1)
+        def fails():
+            raise KeyError("x")
+
+        with pytest.raises(TimeoutError):
+            slow()
+        with pytest.raises(KeyError):
+            fails()
+
+    def test_abandoned_call(self):
+        """
+        test that a call that timed out gets to finish before the next
+        timed call on the same driver starts.
+        """
+        driver = FakeDriver()
+        assert stuck_command(driver, 0.6) == "Timed-out"
+        assert next_command(driver=driver) == "No Error"
+        assert driver.commands == ["stuck", "next"]
+        assert not driver.overlapped
+        assert wait_for_driver(driver, 0)
+
+        # other drivers don't wait
+        other = FakeDriver()
+        assert stuck_command(driver, 0.6) == "Timed-out"
+        start = time.time()
+        assert next_command(other) == "No Error"
+        assert time.time() - start < 0.3
+
+    def test_abandoned_call_stuck(self):
+        """
+        test that a call on a driver that is still stuck in a call that
+        timed out times out too, without touching the driver.
+        """
+        driver = FakeDriver()
+        assert stuck_command(driver, 3) == "Timed-out"
+        assert not wait_for_driver(driver, 0.1)
+        start = time.time()
+        assert next_command(driver) == "Timed-out"
+        assert 1.5 < time.time() - start < 2.8
+        assert driver.commands == []
+        assert wait_for_driver(driver)
+        assert driver.commands == ["stuck"]
+        assert not driver.overlapped
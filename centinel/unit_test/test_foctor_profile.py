@@ -0,0 +1,77 @@
+import errno
+import os
+import shutil
+
+from centinel.primitives.foctor_core import foctor_profile
+
+
+class TestProfileTemplate:
+
+    def test_link_tree(self, tmpdir):
+        """
+        test that clones hard link the files of the template.
+        """
+        source = tmpdir.mkdir("template")
+        source.mkdir("extensions").join("install.rdf").write("<rdf/>")
+        destination = str(tmpdir.mkdir("clone"))
+        foctor_profile.link_tree(str(source), destination)
+        cloned = os.path.join(destination, "extensions", "install.rdf")
+        assert open(cloned).read() == "<rdf/>"
+        assert os.stat(cloned).st_ino == \
+            os.stat(str(source.join("extensions", "install.rdf"))).st_ino
+
+    def test_template_other_file_system(self, tmpdir, monkeypatch):
+        """
+        test that a template built on another file system is copied
+        next to its final place and renamed there, not copied into it.
+        """
+        build_dir = tmpdir.mkdir("build")
+        cache_dir = str(tmpdir.mkdir("cache"))
+
+        class FakeProfile:
+            def __init__(self):
+                self.profile_dir = str(build_dir.mkdir("profile"))
+
+            def add_extension(self, extension):
+                name = os.path.basename(extension)
+                open(os.path.join(self.profile_dir, name), "w").write(name)
+        monkeypatch.setattr(foctor_profile.webdriver, "FirefoxProfile",
+                            FakeProfile)
+        monkeypatch.setattr(foctor_profile, "WEBDRIVER_EXTENSION",
+                            str(tmpdir.join("webdriver.xpi")))
+        tmpdir.join("webdriver.xpi").write("webdriver")
+        extension = tmpdir.join("addon.xpi")
+        extension.write("addon")
+
+        rename = os.rename
+        copied_to = []
+
+        def cross_device(source, destination):
+            if source.startswith(str(build_dir)):
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(source, destination)
+        copytree = shutil.copytree
+
+        def recording_copytree(source, destination, **kwargs):
+            copied_to.append(destination)
+            copytree(source, destination, **kwargs)
+        monkeypatch.setattr(foctor_profile.os, "rename", cross_device)
+        monkeypatch.setattr(foctor_profile.shutil, "copytree",
+                            recording_copytree)
+
+        path = foctor_profile.template_path([str(extension)], cache_dir)
+        assert sorted(os.listdir(path)) == ["addon.xpi", "webdriver.xpi"]
+        assert path not in copied_to
+        assert os.listdir(cache_dir) == [os.path.basename(path)]
+        assert not os.path.exists(str(build_dir.join("profile")))
+
+    def test_template_key(self, tmpdir):
+        """
+        test that the template is rebuilt when an extension changes.
+        """
+        extension = tmpdir.join("addon.xpi")
+        extension.write("v1")
+        key = foctor_profile.template_key([str(extension)])
+        assert foctor_profile.template_key([str(extension)]) == key
+        extension.write("version 2")
+        assert foctor_profile.template_key([str(extension)]) != key
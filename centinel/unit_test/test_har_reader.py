@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import json
+from StringIO import StringIO
+
+import pytest
+
+from centinel.primitives import har_reader
+
+
+def make_entry(status, body, encoding=None):
+    content = {"size": len(body), "mimeType": "text/html", "text": body}
+    if encoding is not None:
+        content["encoding"] = encoding
+    return {"request": {"method": "GET",
+                        "headers": [{"name": "Host", "value": "example.com"}]},
+            "response": {"status": status, "statusText": "OK",
+                         "headers": [{"name": "Server", "value": "nginx"}],
+                         "redirectURL": "",
+                         "content": content}}
+
+
+def make_har(entries):
+    return json.dumps({"log": {"version": "1.2",
+                               "creator": {"name": "Firebug"},
+                               "pages": [{"title": "\"entries\": []"}],
+                               "entries": entries,
+                               "comment": 12345}})
+
+
+class TestHarReader:
+
+    def test_iter_entries(self, monkeypatch):
+        """
+        test that entries are decoded one by one, also when they are
+        larger than a read from the file.
+        """
+        monkeypatch.setattr(har_reader, "CHUNK_SIZE", 16)
+        entries = [make_entry(200 + i, "x" * (i * 100)) for i in range(20)]
+        har = StringIO(make_har(entries))
+        assert list(har_reader.iter_entries(har)) == entries
+
+    def test_read_entries(self, tmpdir):
+        """
+        test that the kept fields are extracted from each entry.
+        """
+        path = str(tmpdir.join("example.com+1.har"))
+        with open(path, "w") as file_p:
+            file_p.write(make_har([make_entry(200, u"<html>é</html>")]))
+        results = har_reader.read_entries(path)
+        assert len(results) == 1
+        assert results[0]["request"] == {"method": "GET",
+                                         "headers": {"Host": "example.com"}}
+        response = results[0]["response"]
+        assert response["status"] == 200
+        assert response["headers"] == {"Server": "nginx"}
+        assert response["body"]["text"] == u"<html>é</html>"
+        assert response["body"]["body_sha256"] == hashlib.sha256(
+            u"<html>é</html>".encode("utf-8")).hexdigest()
+
+    @pytest.mark.parametrize("encoding", [None, "base64"])
+    def test_body_cap(self, encoding):
+        """
+        test that bodies are cut to max_size but hashed in full.
+        """
+        body = "a" * 1000
+        text = base64.b64encode(body) if encoding else body
+        content = make_entry(200, text, encoding)["response"]["content"]
+        har_reader.capture_content(content, {"max_size": 10})
+        kept = base64.b64decode(content["text"]) if encoding else content["text"]
+        assert kept == "a" * 10
+        assert content["body_length"] == 1000
+        assert content["body_truncated"] is True
+        assert content["body_sha256"] == hashlib.sha256(body).hexdigest()
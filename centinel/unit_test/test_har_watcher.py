@@ -0,0 +1,52 @@
+import os
+import threading
+
+import pytest
+
+from centinel.primitives.har_watcher import HarWatcher
+
+
+def write_later(path, delay=0.2):
+    def write():
+        with open(path, "w") as file_p:
+            file_p.write('{"log": {"entries": []}}')
+    timer = threading.Timer(delay, write)
+    timer.start()
+    return timer
+
+
+class TestHarWatcher:
+
+    @pytest.fixture
+    def har_dir(self, tmpdir):
+        return str(tmpdir)
+
+    def test_new_file(self, har_dir):
+        """
+        test that a HAR file written after the watcher started is
+        handed out for its host, and files from before are ignored.
+        """
+        old = os.path.join(har_dir, "www.example.com+old.har")
+        open(old, "w").close()
+        with HarWatcher(har_dir) as watcher:
+            new = os.path.join(har_dir, "www.example.com+new.har")
+            write_later(new)
+            assert watcher.wait("www.example.com", 10) == new
+
+    def test_other_host_discarded(self, har_dir):
+        """
+        test that HAR files of other hosts are removed and cut the
+        wait short.
+        """
+        with HarWatcher(har_dir) as watcher:
+            other = os.path.join(har_dir, "www.other.com+1.har")
+            write_later(other)
+            assert watcher.wait("www.example.com", 30) is None
+            assert not os.path.exists(other)
+
+    def test_timeout(self, har_dir):
+        """
+        test that waiting gives up when no HAR file shows up.
+        """
+        with HarWatcher(har_dir) as watcher:
+            assert watcher.wait("www.example.com", 0.5) is None
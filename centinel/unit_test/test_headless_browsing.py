@@ -1,5 +1,5 @@
 import pytest
-from centinel.primitives.headless_browser import HeadlessBrowser
+from centinel.primitives.headless_browser import BrowserPool, HeadlessBrowser
 import os
 import sys
 from subprocess import call
@@ -115,3 +115,61 @@ class TestHeadlessbrowser:
         urls.close()
 
     
+
+
+class FakeWorker:
+    """Stands in for a BrowserWorker, without firefox"""
+
+    def __init__(self, browser, started):
+        self.browser = browser
+        self.pages = 0
+        self.stopped = False
+        started.append(self)
+
+    def fetch(self, url, results):
+        self.pages += 1
+        if url == "broken.example":
+            raise Exception("page crashed")
+        results[url] = {"fast": self.browser.fast,
+                        "body_policy": self.browser.body_policy}
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeWorkerPool(BrowserPool):
+
+    def __init__(self, *args, **kwargs):
+        BrowserPool.__init__(self, *args, **kwargs)
+        self.started = []
+
+    def _start_worker(self, index):
+        return FakeWorker(self.browser, self.started)
+
+
+class TestBrowserPool:
+
+    def test_run(self):
+        """
+        test that a pool built the way HeadlessBrowser builds it crawls
+        every url with the browser's settings, and that workers are
+        recycled and restarted after failures.
+        """
+        hb = HeadlessBrowser(workers=2, pages_per_worker=2,
+                             body_policy={"max_size": 1024}, fast=True)
+        pool = FakeWorkerPool(hb, hb.workers, hb.pages_per_worker, None)
+        urls = ["a.example", "b.example", "broken.example", "c.example",
+                "d.example"]
+        results = {}
+        pool.run(urls, results)
+
+        assert sorted(results.keys()) == sorted(urls)
+        assert results["broken.example"] == {"error": "page crashed"}
+        for url in urls:
+            if url != "broken.example":
+                assert results[url] == {"fast": True,
+                                        "body_policy": {"max_size": 1024}}
+        # the two first workers, plus at least one recycled or
+        # restarted one
+        assert len(pool.started) > 2
+        assert all(worker.stopped for worker in pool.started)
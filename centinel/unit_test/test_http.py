@@ -1,6 +1,9 @@
 import pytest
+import base64
+import hashlib
 import os
 from  ..primitives import http
+from ..blobstore import BlobStore
 
 class TestHTTPMethods:
 
@@ -78,4 +81,151 @@ class TestHTTPMethods:
         #assert result is not None
         #assert 'error' in result
         #assert result['error'] is "Threads took too long to finish."
-        #fd.close()
\ No newline at end of file
+        #fd.close()
+
+class TestMetaRedirect:
+
+    documents = [
+        # (document, expected redirect URL)
+        ('<html><head><meta http-equiv="refresh" content="0; url=http://blocked.example/">'
+         '</head><body></body></html>', "http://blocked.example/"),
+        ("<HTML><HEAD><META HTTP-EQUIV='Refresh' CONTENT='5;URL=/warning.html'></HEAD></HTML>",
+         "/warning.html"),
+        ('<html><head><meta content="3; url=http://a.example/" http-equiv=refresh /></head></html>',
+         "http://a.example/"),
+        ('<html><head><meta http-equiv="refresh" content="30"></head></html>', None),
+        ('<html><head><meta http-equiv="content-type" content="text/html; charset=utf-8">'
+         '</head><body>hello</body></html>', None),
+        ('<html><head><!-- <meta http-equiv="refresh" content="0; url=http://c.example/"> -->'
+         '</head><body></body></html>', None),
+        ('<html><head><title>t</title></head><body>' + 'x' * 100000 +
+         '<meta http-equiv="refresh" content="0; url=http://late.example/"></body></html>',
+         "http://late.example/"),
+        ('<html><head><meta http-equiv="refresh" content="0; url=http://b.example/>'
+         '</head></html>', None),
+        ('', None),
+    ]
+
+    def test_meta_redirect(self):
+        """
+        test that meta_redirect finds the URL of refresh meta tags.
+        """
+        for document, expected in self.documents:
+            assert http.meta_redirect(document) == expected
+
+    def test_scanner_matches_soup(self):
+        """
+        test that the regular expression scanner agrees with
+        BeautifulSoup whenever it does not defer to it.
+        """
+        for document, expected in self.documents:
+            scanned = http._scan_meta_refresh(document)
+            if scanned is http._AMBIGUOUS:
+                continue
+            assert scanned == http._soup_meta_refresh(document)
+
+
+class TestBodyCapture:
+
+    def test_capture_keeps_prefix_and_hashes_all(self):
+        """
+        test that only max_size bytes are kept while the length and
+        hash cover the whole body.
+        """
+        body = "a" * 5000 + "b" * 5000
+        capture = http.BodyCapture({"max_size": 1024})
+        for i in range(0, len(body), 1000):
+            assert capture.write(body[i:i + 1000])
+        assert capture.getvalue() == "a" * 1024
+        assert capture.truncated
+
+        response = {}
+        capture.annotate(response)
+        assert response["body_length"] == len(body)
+        assert response["body_sha256"] == hashlib.sha256(body).hexdigest()
+        assert response["body_truncated"]
+        assert "body_aborted" not in response
+
+    def test_capture_abort_on_cap(self):
+        """
+        test that the capture asks for the transfer to be stopped once
+        the cap is passed.
+        """
+        capture = http.BodyCapture({"max_size": 10, "abort_on_cap": True})
+        assert capture.write("x" * 10)
+        assert not capture.aborted
+        assert not capture.write("y")
+        assert capture.aborted
+        assert capture.getvalue() == "x" * 10
+
+
+class TestStoreBody:
+
+    def test_utf8_body_stored_as_is(self):
+        """
+        test that UTF-8 bodies are stored without being re-encoded.
+        """
+        body = u"caf\xe9 <b>\u2713</b>".encode("utf-8")
+        response = {}
+        http.store_body(response, body, charset="utf-8")
+        assert response["body"] == body
+        assert response["body_charset"] == "utf-8"
+        assert "body.b64" not in response
+
+    def test_truncated_character_dropped(self):
+        """
+        test that a multi-byte character cut off at the end of a
+        capped body does not turn the whole body into base64.
+        """
+        body = u"abc\u2713".encode("utf-8")[:-1]
+        response = {}
+        http.store_body(response, body, truncated=True)
+        assert response["body"] == "abc"
+
+    def test_binary_body(self, tmpdir):
+        """
+        test that binary bodies go to the blob store if there is one
+        and are base64 encoded otherwise.
+        """
+        body = "\x89PNG\r\n\x1a\n\xff\xfe"
+        response = {}
+        http.store_body(response, body, content_type="image/png")
+        assert response["body.b64"] == base64.b64encode(body)
+
+        store = BlobStore(str(tmpdir.join("blobs")))
+        response = {}
+        http.store_body(response, body, store)
+        assert "body.b64" not in response
+        assert store.get(response["body_blob"]) == body
+
+    def test_declared_charset(self):
+        """
+        test that text in another charset is decoded with the declared
+        charset and stored inline, not base64 encoded.
+        """
+        text = u"\u041f\u0440\u0438\u0432\u0435\u0442, \u043c\u0438\u0440"
+        response = {}
+        http.store_body(response, text.encode("windows-1251"),
+                        charset="windows-1251", content_type="text/html")
+        assert response["body"] == text.encode("utf-8")
+        assert response["body_charset"] == "windows-1251"
+        assert "body.b64" not in response
+
+        # a GBK body cut off in the middle of a character
+        text = u"\u4f60\u597d\u4e16\u754c"
+        response = {}
+        http.store_body(response, text.encode("gbk")[:-1], charset="gbk",
+                        content_type="text/html", truncated=True)
+        assert response["body"] == text[:-1].encode("utf-8")
+
+    def test_default_charset(self):
+        """
+        test that text without a declared charset that is not UTF-8 is
+        decoded as iso-8859-1, like before bodies were kept raw.
+        """
+        body = u"caf\xe9".encode("latin-1")
+        response = {}
+        http.store_body(response, body, content_type="text/html")
+        assert response["body"] == u"caf\xe9".encode("utf-8")
+        assert response["body_charset"] == "iso-8859-1"
+        assert "body.b64" not in response
@@ -0,0 +1,67 @@
+import socket
+
+import pytest
+
+from centinel.experiment import Experiment, TunnelDown
+from centinel.vpn.openvpn import OpenVPN
+
+
+class TestOpenVPN:
+
+    def test_management_state(self):
+        """
+        test that state changes from the management interface are
+        followed.
+        """
+        vpn = OpenVPN()
+        vpn.management_callback(">INFO:OpenVPN Management Interface Version 1")
+        vpn.management_callback("SUCCESS: real-time state notification set to ON")
+        vpn.management_callback("1466000000,CONNECTING,,,")
+        assert vpn.state == "CONNECTING"
+        assert not vpn.started
+
+        vpn.management_callback(">STATE:1466000005,CONNECTED,SUCCESS,10.8.0.6,1.2.3.4")
+        vpn.management_callback(">BYTECOUNT:1200,3400")
+        assert vpn.started and not vpn.is_down()
+        assert (vpn.bytes_in, vpn.bytes_out) == (1200, 3400)
+
+        vpn.management_callback(">STATE:1466000010,RECONNECTING,ping-restart,,")
+        assert vpn.is_down()
+        assert not vpn.wait_connected(0)
+        vpn.management_callback(">STATE:1466000015,CONNECTED,SUCCESS,10.8.0.6,1.2.3.4")
+        assert not vpn.is_down()
+
+    def test_management_connection(self):
+        """
+        test that OpenVPN gets its commands when it connects, and that
+        the tunnel is down once the connection closes.
+        """
+        vpn = OpenVPN(timeout=5)
+        vpn.management_thread.start()
+        openvpn_side = socket.create_connection(vpn.management_socket.getsockname())
+        commands = ""
+        while commands.count("\n") < 3:
+            commands += openvpn_side.recv(1024)
+        assert commands.splitlines() == ["state on", "bytecount 5", "state"]
+
+        openvpn_side.sendall(">STATE:1466000005,CONNECTED,SUCCESS,10.8.0.6,1.2.3.4\n")
+        assert vpn.wait_connected(5)
+        openvpn_side.close()
+        vpn.management_thread.join(5)
+        assert vpn.is_down()
+
+    def test_check_tunnel(self):
+        """
+        test that experiments stop when the tunnel does not come back.
+        """
+        vpn = OpenVPN(management=False)
+        exp = Experiment()
+        exp.check_tunnel()
+        exp.tunnel = vpn
+        vpn.output_callback("Initialization Sequence Completed", None)
+        exp.check_tunnel()
+        vpn.output_callback("SIGUSR1[soft,ping-restart] received, "
+                            "process restarting", None)
+        vpn.output_callback("Restart pause, 5 second(s)", None)
+        with pytest.raises(TunnelDown):
+            exp.check_tunnel(grace=0.1)
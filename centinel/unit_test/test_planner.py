@@ -0,0 +1,107 @@
+import os
+
+from ..planner import (build_plan, dedup_stats, fan_out, load_plan,
+                       merge_plans, prioritize, priorities, shard_plan)
+
+COUNTRY = ["# date: 03-17-2015",
+           "url,category",
+           "http://a.example/,NEWS",
+           "https://b.example/,MISC",
+           "http://a.example:8080/x,NEWS"]
+WORLD = ["url,category",
+         "https://b.example/,MISC",
+         "http://c.example/,PORN"]
+
+
+class TestPlanner:
+
+    def test_build_plan(self):
+        """
+        test that targets are listed once, in input order.
+        """
+        plan = build_plan("country.csv", COUNTRY)
+        assert [row["url"] for row in plan["http"]] == \
+            ["http://a.example/", "https://b.example/",
+             "http://a.example:8080/x"]
+        assert plan["tcp_connect"] == [("a.example", 80), ("b.example", 443),
+                                       ("a.example", 8080)]
+        assert plan["tls"] == ["a.example:443", "b.example:443"]
+        assert plan["dns"] == ["a.example", "b.example"]
+        assert plan["file_metadata"] == {"date": "03-17-2015"}
+        assert plan["url_metadata"]["https://b.example/"] == ["MISC"]
+
+    def test_plan_cache(self, tmpdir):
+        """
+        test that a cached plan is used while the input file does not
+        change and is replaced once it does.
+        """
+        cache_dir = str(tmpdir.join("plans"))
+        plan = load_plan("country.csv", COUNTRY, cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        assert load_plan("country.csv", COUNTRY, cache_dir=cache_dir) == plan
+
+        changed = load_plan("country.csv", COUNTRY + ["http://d.example/"],
+                            cache_dir=cache_dir)
+        assert changed["dns"] == ["a.example", "b.example", "d.example"]
+        assert len(os.listdir(cache_dir)) == 1
+
+    def test_merge_and_fan_out(self):
+        """
+        test that targets listed in several input files are only
+        measured once, and each file gets back the results of the
+        targets it lists.
+        """
+        country = build_plan("country.csv", COUNTRY)
+        world = build_plan("world.csv", WORLD)
+        combined = merge_plans([country, world])
+        assert combined["dns"] == ["a.example", "b.example", "c.example"]
+
+        stats = dedup_stats([country, world], combined)
+        assert stats["requested"]["http"] == 5
+        assert stats["measured"]["http"] == 4
+
+        measurements = {"dns": dict((name, {"name": name})
+                                    for name in combined["dns"]),
+                        "traceroute.udp": {"c.example": {},
+                                           "error": "timed out"}}
+        result = {}
+        fan_out(world, measurements, result)
+        assert sorted(result["dns"].keys()) == ["b.example", "c.example"]
+        assert result["traceroute.udp"] == {"c.example": {},
+                                            "error": "timed out"}
+
+    def test_shard_plan(self):
+        """
+        test that shards cover every target once and keep the targets
+        of a domain together.
+        """
+        rows = ["url"] + ["http://s%d.example/" % i for i in range(50)] + \
+            ["https://s%d.example/x" % i for i in range(50)]
+        plan = build_plan("list.csv", rows)
+        shards = shard_plan(plan, 4)
+        assert len(shards) == 4
+        for test in ["tcp_connect", "http", "tls", "dns"]:
+            targets = [target for shard in shards for target in shard[test]]
+            assert sorted(targets) == sorted(plan[test])
+        for shard in shards:
+            domains = set(shard["dns"])
+            assert set(host for host, port in shard["tcp_connect"]) == domains
+            assert set(row["host"] for row in shard["http"]) == domains
+
+    def test_prioritize(self):
+        """
+        test that targets of several input files come first, then those
+        of earlier input files.
+        """
+        country = build_plan("country.csv", COUNTRY)
+        world = build_plan("world.csv", WORLD)
+        ranks = priorities([country, world])
+        assert prioritize("dns", ["c.example", "a.example", "b.example"],
+                          ranks) == ["b.example", "a.example", "c.example"]
+        urls = [row["url"] for row in
+                prioritize("http", merge_plans([world, country])["http"], ranks)]
+        assert urls == ["https://b.example/", "http://a.example/",
+                        "http://a.example:8080/x", "http://c.example/"]
+        # unknown targets go last
+        assert prioritize("dns", ["d.example", "c.example"], ranks) == \
+            ["c.example", "d.example"]
@@ -0,0 +1,30 @@
+from centinel.primitives import probe
+from centinel.unit_test.test_tls import TLSServer, cert_fingerprint
+
+
+class TestProbe:
+
+    def test_https(self):
+        """
+        test that an https probe gets the certificate and the response
+        over one connection.
+        """
+        server = TLSServer(body="probed")
+        result = probe.probe("127.0.0.1", server.port, path="/", ssl=True,
+                             timeout=5)
+        assert result["tcp_connect"]["success"] == "true"
+        assert result["tls"]["fingerprint"] == cert_fingerprint()
+        response = result["http"]["response"]
+        assert response["status"] == 200
+        assert "failure" not in response
+        assert server.request.startswith("GET / HTTP/1.1\r\n")
+
+    def test_https_timeout(self):
+        """
+        test that a server that never answers the handshake is recorded
+        as a timeout.
+        """
+        server = TLSServer(handshake=False)
+        result = probe.probe("127.0.0.1", server.port, ssl=True, timeout=0.5)
+        assert "timed out" in result["tls"]["tls_error"]
+        assert "timed out" in result["http"]["response"]["failure"]
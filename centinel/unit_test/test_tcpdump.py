@@ -0,0 +1,21 @@
+import centinel
+from centinel.primitives.tcpdump import Tcpdump
+
+
+class TestTcpdump:
+
+    def test_config(self, monkeypatch):
+        """
+        test that the tcpdump options come from the configuration that
+        is passed in, not from the global one.
+        """
+        monkeypatch.setattr(centinel, "conf",
+                            {"experiments": {"tcpdump_params": ["-i", "tun0"]}},
+                            raising=False)
+        config = {"experiments": {"tcpdump_params": ["-i", "eth0"]}}
+        td = Tcpdump(filename="/tmp/test.pcap", config=config)
+        assert td.pcap_args == ["-i", "eth0"]
+        td = Tcpdump(filename="/tmp/test.pcap")
+        assert td.pcap_args == ["-i", "tun0"]
+        td = Tcpdump(filename="/tmp/test.pcap", config={"experiments": {}})
+        assert td.pcap_args == ["-i", "any"]
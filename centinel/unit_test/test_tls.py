@@ -0,0 +1,148 @@
+import errno
+import hashlib
+import os
+import socket
+import ssl
+import threading
+import time
+
+from centinel.concurrency import ConcurrencyController
+from centinel.connectivity import ConnectivityMonitor
+from centinel.primitives import tls
+
+# self-signed certificate and key for localhost
+CERT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "data", "tls_test.pem")
+
+
+class TLSServer:
+    """
+    Serves one connection on localhost: a TLS handshake, then an HTTP
+    response to whatever request comes in. With handshake=False it
+    accepts the connection and never says a word.
+    """
+
+    def __init__(self, handshake=True, body="hello"):
+        self.handshake = handshake
+        self.body = body
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.request = ""
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def _serve(self):
+        conn, address = self.sock.accept()
+        try:
+            if not self.handshake:
+                conn.recv(1024)
+                time.sleep(5)
+                return
+            conn = ssl.wrap_socket(conn, server_side=True,
+                                   certfile=CERT_FILE)
+            while "\r\n\r\n" not in self.request:
+                data = conn.recv(1024)
+                if not data:
+                    return
+                self.request += data
+            conn.sendall("HTTP/1.1 200 OK\r\nContent-Length: %d\r\n"
+                         "Connection: close\r\n\r\n%s" % (len(self.body),
+                                                          self.body))
+        except Exception:
+            pass
+        finally:
+            conn.close()
+            self.sock.close()
+
+
+def cert_fingerprint():
+    pem = open(CERT_FILE).read()
+    pem = pem[pem.index("-----BEGIN CERTIFICATE-----"):]
+    return hashlib.sha1(ssl.PEM_cert_to_DER_cert(pem)).hexdigest()
+
+
+class TestTLS:
+
+    def test_get_fingerprint(self):
+        """
+        test that a blocking handshake gets the certificate.
+        """
+        server = TLSServer()
+        fingerprint, cert = tls.get_fingerprint("127.0.0.1", server.port,
+                                                timeout=5)
+        assert fingerprint == cert_fingerprint()
+        assert "BEGIN CERTIFICATE" in cert
+
+    def test_handshake_timeout(self):
+        """
+        test that a blocking handshake with a silent server fails with
+        a timeout after the timeout.
+        """
+        server = TLSServer(handshake=False)
+        start = time.time()
+        fingerprint, error = tls.get_fingerprint("127.0.0.1", server.port,
+                                                 timeout=0.5)
+        assert fingerprint is None
+        assert "timed out" in error
+        assert 0.4 < time.time() - start < 4
+
+    def test_wait_for_socket(self):
+        """
+        test that with a timeout, the connection waits for the socket
+        when the TLS layer wants to read or write (what pyOpenSSL does
+        on sockets with a timeout).
+        """
+        server = TLSServer()
+        sock = socket.create_connection(("127.0.0.1", server.port), 5)
+        sock.setblocking(0)
+        conn = tls.TLSConnection(sock, "localhost", timeout=5)
+        conn.do_handshake()
+        assert tls.der_fingerprint(conn.peer_chain()[0]) == cert_fingerprint()
+        conn.sendall("GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = ""
+        while True:
+            data = conn.recv(1024)
+            if not data:
+                break
+            response += data
+        conn.close()
+        assert response.endswith("\r\n\r\nhello")
+        assert server.request.startswith("GET / HTTP/1.1\r\n")
+
+    def test_engine(self):
+        """
+        test that the event loop gets the certificate too.
+        """
+        server = TLSServer()
+        results = tls.get_fingerprint_batch(["127.0.0.1:%d" % server.port],
+                                            results={},
+                                            monitor=ConnectivityMonitor())
+        result = results["127.0.0.1:%d" % server.port]
+        assert result["fingerprint"] == cert_fingerprint()
+        assert len(result["chain"]) >= 1
+
+    def test_out_of_descriptors(self, monkeypatch):
+        """
+        test that running out of file descriptors lowers the limit and
+        retries the target instead of recording the error as its TLS
+        result.
+        """
+        servers = [TLSServer() for i in range(3)]
+        results = {}
+        engine = tls.TLSEngine(results, controller=ConcurrencyController(
+            initial=3, maximum=3))
+        handshake = tls._Handshake
+
+        def out_of_descriptors(*args):
+            if len(engine.active) >= 1:
+                raise socket.error(errno.EMFILE, "Too many open files")
+            return handshake(*args)
+        monkeypatch.setattr(tls, "_Handshake", out_of_descriptors)
+        engine.run([("127.0.0.1", server.port, "") for server in servers])
+        for server in servers:
+            result = results["127.0.0.1:%d" % server.port]
+            assert result["fingerprint"] == cert_fingerprint()
+        assert engine.controller.maximum == 1
@@ -0,0 +1,143 @@
+import socket
+import threading
+
+import centinel.client
+from centinel.vpn import cli
+
+
+class FakeConfig:
+
+    def __init__(self, filename):
+        self.params = {"endpoint": filename,
+                       "server": {"server_url": "https://server.example:8082"}}
+
+
+class FakeVPN:
+    connected_instances = []
+    started_for = []
+
+    def __init__(self, config_file=None, bypass_hosts=None, **kwargs):
+        self.config_file = config_file
+        self.bypass_hosts = bypass_hosts
+        self.started = False
+
+    def start(self):
+        self.started = True
+        FakeVPN.started_for.append(self)
+
+    def stop(self):
+        pass
+
+    def is_down(self):
+        return False
+
+
+class FakeClient:
+    ran = []
+
+    def __init__(self, config, vpn_provider, tunnel=None):
+        self.config = config
+
+    def run(self):
+        FakeClient.ran.append(self.config)
+
+
+class FakeResolver:
+    nameservers = ["192.0.2.53"]
+
+
+class Walk:
+    """
+    Stubs out everything scan_vpns() talks to and records what it did.
+    """
+
+    def __init__(self, monkeypatch, tmpdir, endpoints, external_ips):
+        for name in ("vpns", "configs"):
+            tmpdir.join(name).mkdir()
+            for endpoint in endpoints:
+                tmpdir.join(name).join(endpoint).write("")
+        self.directory = str(tmpdir)
+        self.prepared = []
+        self.finished = []
+        self.server_lookups = []
+        self._lock = threading.Lock()
+        FakeVPN.started_for = []
+        FakeClient.ran = []
+        external_ips = list(external_ips)
+
+        monkeypatch.setattr(cli, "get_external_ip",
+                            lambda: external_ips.pop(0))
+        monkeypatch.setattr(cli, "prepare_endpoint", self.prepare)
+        monkeypatch.setattr(cli, "finish_endpoint", self.finish)
+        monkeypatch.setattr(cli, "server_addresses",
+                            lambda config: ["192.0.2.1"])
+        monkeypatch.setattr(cli.openvpn, "OpenVPN", FakeVPN)
+        monkeypatch.setattr(centinel.client, "Client", FakeClient)
+        monkeypatch.setattr(cli.dns.resolver, "Resolver", FakeResolver)
+        monkeypatch.setattr(cli.time, "sleep", lambda seconds: None)
+        monkeypatch.setattr(socket, "getaddrinfo", socket.getaddrinfo)
+
+    def prepare(self, filename, *args):
+        with self._lock:
+            self.prepared.append(filename)
+        return FakeConfig(filename), filename, "US"
+
+    def finish(self, filename, config, vpn_address, country, queue=None):
+        try:
+            address = socket.getaddrinfo("server.example", 8082)[0][4][0]
+        except socket.error:
+            address = None
+        with self._lock:
+            self.finished.append(filename)
+            self.server_lookups.append(address)
+
+    def scan(self, prefetch):
+        cli.scan_vpns(self.directory, None, None, None, None, [], False, 1, 1,
+                      False, prefetch=prefetch)
+
+
+class TestScanVPNs:
+
+    def test_prefetch(self, monkeypatch, tmpdir):
+        """
+        test that endpoints are prepared in order, finished once each
+        and that the background jobs reach the server without DNS.
+        """
+        endpoints = ["10.0.0.1.ovpn", "10.0.0.2.ovpn", "10.0.0.3.ovpn"]
+        walk = Walk(monkeypatch, tmpdir, endpoints, ["198.51.100.1"] * 4)
+        walk.scan(prefetch=1)
+        assert walk.prepared == endpoints
+        assert sorted(walk.finished) == endpoints
+        assert [config["endpoint"] for config in FakeClient.ran] == endpoints
+        assert walk.server_lookups == ["192.0.2.1"] * 3
+        for vpn in FakeVPN.started_for:
+            assert vpn.bypass_hosts == ["192.0.2.1"]
+        assert cli._pinned == {}
+
+    def test_break(self, monkeypatch, tmpdir):
+        """
+        test that endpoints prepared ahead of a break are never
+        connected to or finished.
+        """
+        endpoints = ["10.0.0.%d.ovpn" % i for i in range(1, 5)]
+        # connectivity is lost before the second endpoint
+        walk = Walk(monkeypatch, tmpdir, endpoints,
+                    ["198.51.100.1", "198.51.100.1", None])
+        walk.scan(prefetch=2)
+        assert sorted(walk.prepared) == endpoints
+        assert walk.finished == endpoints[:1]
+        assert [config["endpoint"] for config in FakeClient.ran] == endpoints[:1]
+        assert len(FakeVPN.started_for) == 1
+
+    def test_sequential(self, monkeypatch, tmpdir):
+        """
+        test that without prefetching every endpoint is prepared right
+        before it is measured and finished right after.
+        """
+        endpoints = ["10.0.0.1.ovpn", "10.0.0.2.ovpn"]
+        walk = Walk(monkeypatch, tmpdir, endpoints, ["198.51.100.1"] * 3)
+        walk.scan(prefetch=0)
+        assert walk.prepared == endpoints
+        assert walk.finished == endpoints
+        for vpn in FakeVPN.started_for:
+            assert vpn.bypass_hosts is None
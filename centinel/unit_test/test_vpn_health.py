@@ -0,0 +1,98 @@
+import socket
+import struct
+import threading
+
+from centinel.vpn import health
+
+
+def write_config(tmpdir, name, lines):
+    path = tmpdir.join(name)
+    path.write("\n".join(lines) + "\n")
+    return str(path)
+
+
+class TestEndpointHealth:
+
+    def test_parse_remotes(self, tmpdir):
+        """
+        test that remotes pick up the default port and protocol.
+        """
+        path = write_config(tmpdir, "a.ovpn", ["client", "proto tcp",
+                                               "port 443",
+                                               "remote 10.0.0.1",
+                                               "remote 10.0.0.2 1194 udp",
+                                               "# remote 10.0.0.3",
+                                               "tls-auth ta.key 1"])
+        remotes, tls_auth = health.parse_remotes(path)
+        assert remotes == [("10.0.0.1", 443, "tcp"),
+                           ("10.0.0.2", 1194, "udp")]
+        assert tls_auth
+
+    def test_tls_crypt(self, tmpdir):
+        """
+        test that tls-crypt and tls-crypt-v2 count as tls-auth, so UDP
+        remotes with them are not probed (and not taken for dead).
+        """
+        for lines in (["tls-crypt tc.key"], ["<tls-crypt>", "</tls-crypt>"],
+                      ["tls-crypt-v2 client.key"],
+                      ["<tls-crypt-v2>", "</tls-crypt-v2>"]):
+            path = write_config(tmpdir, "crypt.ovpn",
+                                ["remote 127.0.0.1 9 udp"] + lines)
+            remotes, tls_auth = health.parse_remotes(path)
+            assert tls_auth
+            assert health.probe_endpoint(path, timeout=1) is None
+
+    def test_probe_tcp(self, tmpdir):
+        """
+        test that listening TCP remotes are alive and closed ones dead.
+        """
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        alive = write_config(tmpdir, "alive.ovpn",
+                             ["remote 127.0.0.1 %d tcp" % port])
+        assert health.probe_endpoint(alive, timeout=1) is True
+        server.close()
+        assert health.probe_endpoint(alive, timeout=1) is False
+
+    def test_probe_udp(self, tmpdir):
+        """
+        test that UDP remotes are alive if they answer the handshake,
+        and can't be probed with tls-auth.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        port = server.getsockname()[1]
+
+        def answer():
+            packet, address = server.recvfrom(2048)
+            assert ord(packet[0]) >> 3 == 7
+            server.sendto(struct.pack("!B8s", health.HARD_RESET_SERVER_V2 << 3,
+                                      "s" * 8), address)
+        thread = threading.Thread(target=answer)
+        thread.start()
+
+        path = write_config(tmpdir, "udp.ovpn", ["remote 127.0.0.1 %d" % port])
+        assert health.probe_endpoint(path, timeout=2) is True
+        thread.join()
+        assert health.probe_endpoint(path, tls_auth=True, timeout=1) is None
+        server.close()
+
+    def test_history(self, tmpdir):
+        """
+        test that failing endpoints are ordered last and the history
+        is kept across runs.
+        """
+        path = str(tmpdir.join("health.json"))
+        history = health.HealthHistory(path)
+        history.record("a", False)
+        history.record("a", False)
+        history.record("b", False)
+        history.record("c", True)
+        history.save()
+
+        history = health.HealthHistory(path)
+        assert history.order(["a", "b", "c", "d"]) == ["c", "d", "b", "a"]
+        history.record("a", True)
+        assert history.consecutive_failures("a") == 0
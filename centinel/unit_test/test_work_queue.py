@@ -0,0 +1,64 @@
+import json
+import time
+
+from centinel.vpn.work_queue import WorkQueue
+
+
+class TestWorkQueue:
+
+    def test_claim_is_exclusive(self, tmpdir):
+        """
+        test that only one walker gets an endpoint, and that finished
+        endpoints are not handed out again.
+        """
+        first = WorkQueue(str(tmpdir), owner="vm1")
+        second = WorkQueue(str(tmpdir), owner="vm2")
+        assert first.claim("a.ovpn")
+        assert not second.claim("a.ovpn")
+        assert second.claim("b.ovpn")
+
+        first.complete("a.ovpn")
+        assert first.is_done("a.ovpn")
+        assert not second.claim("a.ovpn")
+        assert not first.claim("a.ovpn")
+        first.close()
+        second.close()
+
+    def test_release(self, tmpdir):
+        """
+        test that released endpoints can be claimed by others.
+        """
+        first = WorkQueue(str(tmpdir), owner="vm1")
+        second = WorkQueue(str(tmpdir), owner="vm2")
+        assert first.claim("a.ovpn")
+        first.close()
+        assert second.claim("a.ovpn")
+        # only the owner can drop a lease
+        first.release("a.ovpn")
+        assert not first.claim("a.ovpn")
+        second.close()
+
+    def test_expired_lease(self, tmpdir):
+        """
+        test that the endpoints of a walker that stopped renewing are
+        taken over, and renewed ones are not.
+        """
+        crashed = WorkQueue(str(tmpdir), ttl=60, owner="vm1")
+        other = WorkQueue(str(tmpdir), ttl=60, owner="vm2")
+        assert crashed.claim("a.ovpn")
+        assert crashed.claim("b.ovpn")
+        for name in ["a.ovpn", "b.ovpn"]:
+            tmpdir.join("leases", name).write(json.dumps(
+                {"owner": "vm1", "expires": time.time() - 1}))
+
+        # the walker only keeps renewing b
+        crashed._held.discard("a.ovpn")
+        crashed.renew()
+
+        assert other.claim("a.ovpn")
+        assert json.loads(tmpdir.join("leases", "a.ovpn").read())["owner"] == "vm2"
+        assert not other.claim("b.ovpn")
+        assert sorted(tmpdir.join("leases").listdir()) == \
+            [tmpdir.join("leases", "a.ovpn"), tmpdir.join("leases", "b.ovpn")]
+        crashed.close()
+        other.close()
@@ -4,19 +4,26 @@
 # places.
 
 import argparse
+import collections
 import logging
+from multiprocessing.pool import ThreadPool
 from random import shuffle
 import os
 import time
 import sys
 import signal
+import socket
 import dns.resolver
 import json
+from urlparse import urlparse
 
 import centinel.backend
 import centinel.client
 import centinel.config
+from centinel.content_cache import ContentCache
 import centinel.vpn.openvpn as openvpn
+from centinel.vpn import health
+from centinel.vpn.work_queue import WorkQueue
 import centinel.vpn.hma as hma
 import centinel.vpn.ipvanish as ipvanish
 import centinel.vpn.purevpn as purevpn
@@ -24,6 +31,10 @@ import centinel.vpn.vpngate as vpngate
 
 PID_FILE = "/tmp/centinel.lock"
 
+# host name -> addresses to use instead of asking DNS, see pin_addresses()
+_pinned = {}
+_getaddrinfo = socket.getaddrinfo
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -82,11 +93,34 @@ def parse_args():
     parser.add_argument('--vm-index', dest='vm_index', type=int, default=1,
                         help='The index of current VM, must be >= 1 and '
                              '<= vm_num')
+    parser.add_argument('--prefetch', dest='prefetch', type=int, default=2,
+                        help=("Number of upcoming endpoints to prepare "
+                              "(geolocate, register, sync) while the "
+                              "current one measures, 0 to run everything "
+                              "in sequence"))
+    parser.add_argument('--skip-probe', dest='probe', action='store_false',
+                        default=True,
+                        help=("Don't probe the endpoints before the walk "
+                              "to skip the ones that are down"))
+    parser.add_argument('--probe-timeout', dest='probe_timeout', type=int,
+                        default=5,
+                        help="Seconds to wait for an endpoint to answer a probe")
+    parser.add_argument('--work-queue', dest='work_queue', default=None,
+                        help=("Directory shared by all VMs to take endpoints "
+                              "from as they become free, instead of "
+                              "splitting them with --vm-num and --vm-index. "
+                              "Use a new directory for every round"))
+    parser.add_argument('--lease-ttl', dest='lease_ttl', type=int,
+                        default=600,
+                        help=("Seconds after which the endpoints of a VM "
+                              "that stopped responding are given to others"))
     return parser.parse_args()
 
 
 def scan_vpns(directory, auth_file, crt_file, tls_auth, key_direction,
-              exclude_list, shuffle_lists, vm_num, vm_index, reduce_vp):
+              exclude_list, shuffle_lists, vm_num, vm_index, reduce_vp,
+              prefetch=0, probe=False, probe_timeout=5, work_queue=None,
+              lease_ttl=600):
     """
     For each VPN, check if there are experiments and scan with it if
     necessary
@@ -109,6 +143,18 @@ def scan_vpns(directory, auth_file, crt_file, tls_auth, key_direction,
     :param vm_num: number of VMs that are running currently
     :param vm_index: index of current VM
     :param reduce_vp: reduce number of vantage points
+    :param prefetch: number of upcoming endpoints to prepare in the
+                     background while the current one measures, 0
+                     does everything in sequence
+    :param probe: probe all endpoints before the walk and skip the
+                  ones that don't answer, see centinel.vpn.health
+    :param probe_timeout: seconds to wait for a probe answer
+    :param work_queue: directory shared by all VMs to take endpoints
+                       from as they become free, instead of splitting
+                       them by vm_num and vm_index, see
+                       centinel.vpn.work_queue
+    :param lease_ttl: seconds after which endpoints of a VM that
+                      stopped renewing its leases are taken over
     :return:
     """
 
@@ -119,6 +165,9 @@ def scan_vpns(directory, auth_file, crt_file, tls_auth, key_direction,
     vpn_dir = return_abs_path(directory, "vpns")
     conf_dir = return_abs_path(directory, "configs")
     home_dir = return_abs_path(directory, "home")
+    # experiment and input files shared by all homes, see
+    # centinel.content_cache
+    cache_dir = return_abs_path(directory, "content_cache")
     if auth_file is not None:
         auth_file = return_abs_path(directory, auth_file)
     if crt_file is not None:
@@ -174,21 +223,51 @@ def scan_vpns(directory, auth_file, crt_file, tls_auth, key_direction,
     # sort file list to ensure the same filename sequence in each VM
     conf_list = sorted(conf_list)
 
-    # only select its own portion according to vm_num and vm_index
-    chunk_size = len(conf_list) / vm_num
-    last_chunk_additional = len(conf_list) % vm_num
-    start_pointer = 0 + (vm_index - 1) * chunk_size
-    end_pointer = start_pointer + chunk_size
-    if vm_index == vm_num:
-        end_pointer += last_chunk_additional
-    conf_list = conf_list[start_pointer:end_pointer]
+    queue = None
+    if work_queue is not None:
+        # VMs take endpoints from the shared queue as they go
+        queue = WorkQueue(return_abs_path(directory, work_queue), lease_ttl)
+        logging.info("Taking endpoints from the work queue in %s as %s" %
+                     (queue.directory, queue.owner))
+    else:
+        # only select its own portion according to vm_num and vm_index
+        chunk_size = len(conf_list) / vm_num
+        last_chunk_additional = len(conf_list) % vm_num
+        start_pointer = 0 + (vm_index - 1) * chunk_size
+        end_pointer = start_pointer + chunk_size
+        if vm_index == vm_num:
+            end_pointer += last_chunk_additional
+        conf_list = conf_list[start_pointer:end_pointer]
 
     if shuffle_lists:
         shuffle(conf_list)
 
+    history = health.HealthHistory(return_abs_path(directory,
+                                                   "endpoint_health.json"))
+    if probe:
+        logging.info("Probing %d endpoints..." % len(conf_list))
+        alive = health.probe_endpoints(vpn_dir, conf_list,
+                                       tls_auth is not None, probe_timeout)
+        for filename, result in alive.items():
+            if result is not None:
+                history.record(filename, result)
+        dead = [filename for filename in conf_list if alive[filename] is False]
+        if dead:
+            logging.info("Skipping %d endpoints that did not answer: "
+                         "%s" % (len(dead), ", ".join(dead)))
+        conf_list = [filename for filename in conf_list
+                     if alive[filename] is not False]
+    # endpoints that kept failing go last
+    conf_list = history.order(conf_list)
+    history.save()
+
     number = 1
     total = len(conf_list)
 
+    # drop file versions no home uses any more
+    if os.path.isdir(cache_dir):
+        ContentCache(cache_dir).prune()
+
     external_ip = get_external_ip()
     if external_ip is None:
         logging.error("No network connection, exiting...")
@@ -198,7 +277,40 @@ def scan_vpns(directory, auth_file, crt_file, tls_auth, key_direction,
     # getting namesevers that should be excluded
     local_nameservers = dns.resolver.Resolver().nameservers
 
-    for filename in conf_list:
+    # preparation of upcoming endpoints and the final sync of finished
+    # ones run in the background while a tunnel is up. Traffic to the
+    # server is routed around the tunnel for that (see OpenVPN).
+    prepare_pool = None
+    finish_pool = None
+    if prefetch > 0:
+        prepare_pool = ThreadPool(prefetch)
+        finish_pool = ThreadPool(1)
+    prepare_args = (conf_dir, home_dir, cache_dir, exclude_list,
+                    local_nameservers)
+
+    if queue is None:
+        endpoints = iter(conf_list)
+    else:
+        # only endpoints no other VM has taken
+        endpoints = (filename for filename in conf_list
+                     if queue.claim(filename))
+    upcoming = collections.deque()
+
+    while True:
+        # keep the next few endpoints preparing
+        while len(upcoming) < 1 + prefetch:
+            filename = next(endpoints, None)
+            if filename is None:
+                break
+            job = None
+            if prepare_pool is not None:
+                job = prepare_pool.apply_async(prepare_endpoint,
+                                               (filename,) + prepare_args)
+            upcoming.append((filename, job))
+        if not upcoming:
+            break
+        filename, job = upcoming.popleft()
+
         # Check network connection first
         time.sleep(5)
         logging.info("Checking network connectivity...")
@@ -229,86 +341,52 @@ def scan_vpns(directory, auth_file, crt_file, tls_auth, key_direction,
 
         number += 1
         vpn_config = os.path.join(vpn_dir, filename)
-        centinel_config = os.path.join(conf_dir, filename)
-
-        # before starting the VPN, check if there are any experiments
-        # to run
-        config = centinel.config.Configuration()
-        config.parse_config(centinel_config)
-
-        # assuming that each VPN config file has a name like:
-        # [ip-address].ovpn, we can extract IP address from filename
-        # and use it to geolocate and fetch experiments before connecting
-        # to VPN.
-        vpn_address, extension = os.path.splitext(filename)
-        country = None
-        try:
-            meta = centinel.backend.get_meta(config.params,
-                                             vpn_address)
-            if 'country' in meta:
-                country = meta['country']
-        except:
-            logging.exception("%s: Failed to geolocate %s" % (filename, vpn_address))
-
-        if country and exclude_list and country in exclude_list:
-            logging.info("%s: Skipping this server (%s)" % (filename, country))
-            continue
-
-        # try setting the VPN info (IP and country) to get appropriate
-        # experiemnts and input data.
-        try:
-            centinel.backend.set_vpn_info(config.params, vpn_address, country)
-        except Exception as exp:
-            logging.exception("%s: Failed to set VPN info: %s" % (filename, exp))
-
-        logging.info("%s: Synchronizing." % filename)
-        try:
-            centinel.backend.sync(config.params)
-        except Exception as exp:
-            logging.exception("%s: Failed to sync: %s" % (filename, exp))
 
-        if not experiments_available(config.params):
-            logging.info("%s: No experiments available." % filename)
+        if job is None:
+            prepared = prepare_endpoint(filename, *prepare_args)
+        else:
             try:
-                centinel.backend.set_vpn_info(config.params, vpn_address, country)
+                prepared = job.get()
             except Exception as exp:
-                logging.exception("Failed to set VPN info: %s" % exp)
+                logging.exception("%s: Failed to prepare: %s" % (filename, exp))
+                prepared = None
+        if prepared is None:
+            if queue is not None:
+                queue.complete(filename)
             continue
-
-        # add exclude_nameservers to scheduler
-        sched_path = os.path.join(home_dir, filename, "experiments", "scheduler.info")
-        if os.path.exists(sched_path):
-            with open(sched_path, 'r+') as f:
-                sched_info = json.load(f)
-                for task in sched_info:
-                    if "python_exps" in sched_info[task] and "baseline" in sched_info[task]["python_exps"]:
-                        if "params" in sched_info[task]["python_exps"]["baseline"]:
-                            sched_info[task]["python_exps"]["baseline"]["params"]["exclude_nameservers"] = \
-                                local_nameservers
-                        else:
-                            sched_info[task]["python_exps"]["baseline"]["params"] = \
-                                {"exclude_nameservers": local_nameservers}
-
-                # write back to same file
-                f.seek(0)
-                json.dump(sched_info, f, indent=2)
-                f.truncate()
+        config, vpn_address, country = prepared
 
         logging.info("%s: Starting VPN." % filename)
 
+        bypass_hosts = None
+        if prepare_pool is not None:
+            bypass_hosts = server_addresses(config.params)
+            # the background jobs must not look the server up either,
+            # the lookup would go through the tunnel
+            server_host = urlparse(config.params['server']['server_url']).hostname
+            pin_addresses(server_host, bypass_hosts)
         vpn = openvpn.OpenVPN(timeout=60, auth_file=auth_file, config_file=vpn_config,
-                              crt_file=crt_file, tls_auth=tls_auth, key_direction=key_direction)
+                              crt_file=crt_file, tls_auth=tls_auth, key_direction=key_direction,
+                              bypass_hosts=bypass_hosts)
 
         vpn.start()
+        history.record(filename, vpn.started)
+        history.save()
         if not vpn.started:
             logging.error("%s: Failed to start VPN!" % filename)
             vpn.stop()
             time.sleep(5)
+            if queue is not None:
+                queue.complete(filename)
             continue
 
         logging.info("%s: Running Centinel." % filename)
         try:
-            client = centinel.client.Client(config.params, vpn_provider)
+            client = centinel.client.Client(config.params, vpn_provider,
+                                            tunnel=vpn)
+            # for experiments that still read the global config. The
+            # prepare and finish jobs in the background get theirs
+            # passed in and never read it.
             centinel.conf = config.params
             # do not use client logging config
             # client.setup_logging()
@@ -316,22 +394,174 @@ def scan_vpns(directory, auth_file, crt_file, tls_auth, key_direction,
         except Exception as exp:
             logging.exception("%s: Error running Centinel: %s" % (filename, exp))
 
+        if vpn.is_down():
+            logging.warning("%s: VPN tunnel dropped during the "
+                            "measurements." % filename)
+            history.record(filename, False)
+            history.save()
+
         logging.info("%s: Stopping VPN." % filename)
         vpn.stop()
         time.sleep(5)
 
-        logging.info("%s: Synchronizing." % filename)
-        try:
-            centinel.backend.sync(config.params)
-        except Exception as exp:
-            logging.exception("%s: Failed to sync: %s" % (filename, exp))
+        if finish_pool is None:
+            finish_endpoint(filename, config, vpn_address, country, queue)
+        else:
+            finish_pool.apply_async(finish_endpoint, (filename, config,
+                                                      vpn_address, country,
+                                                      queue))
+
+    if prepare_pool is not None:
+        # endpoints prepared ahead of a break are not connected to
+        prepare_pool.close()
+        finish_pool.close()
+        logging.info("Waiting for the remaining syncs to finish...")
+        finish_pool.join()
+        prepare_pool.join()
+        _pinned.clear()
+    if queue is not None:
+        # endpoints claimed ahead of a break go back to the queue
+        queue.close()
+
+
+def prepare_endpoint(filename, conf_dir, home_dir, cache_dir, exclude_list,
+                     local_nameservers):
+    """
+    Everything that needs to happen before connecting to an endpoint:
+    geolocate it, tell the server about it, sync experiments and input
+    files and check that there is something to run.
 
-        # try setting the VPN info (IP and country) to the correct address
-        # after sync is over.
+    :return: (config, vpn address, country), or None if the endpoint
+             should be skipped
+    """
+    centinel_config = os.path.join(conf_dir, filename)
+
+    # before starting the VPN, check if there are any experiments
+    # to run
+    config = centinel.config.Configuration()
+    config.parse_config(centinel_config)
+    # configs created before the cache existed don't have it
+    config.params['dirs'].setdefault('content_cache', cache_dir)
+
+    # assuming that each VPN config file has a name like:
+    # [ip-address].ovpn, we can extract IP address from filename
+    # and use it to geolocate and fetch experiments before connecting
+    # to VPN.
+    vpn_address, extension = os.path.splitext(filename)
+    country = None
+    try:
+        meta = centinel.backend.get_meta(config.params,
+                                         vpn_address)
+        if 'country' in meta:
+            country = meta['country']
+    except:
+        logging.exception("%s: Failed to geolocate %s" % (filename, vpn_address))
+
+    if country and exclude_list and country in exclude_list:
+        logging.info("%s: Skipping this server (%s)" % (filename, country))
+        return None
+
+    # try setting the VPN info (IP and country) to get appropriate
+    # experiemnts and input data.
+    try:
+        centinel.backend.set_vpn_info(config.params, vpn_address, country)
+    except Exception as exp:
+        logging.exception("%s: Failed to set VPN info: %s" % (filename, exp))
+
+    logging.info("%s: Synchronizing." % filename)
+    try:
+        centinel.backend.sync(config.params)
+    except Exception as exp:
+        logging.exception("%s: Failed to sync: %s" % (filename, exp))
+
+    if not experiments_available(config.params):
+        logging.info("%s: No experiments available." % filename)
         try:
             centinel.backend.set_vpn_info(config.params, vpn_address, country)
         except Exception as exp:
             logging.exception("Failed to set VPN info: %s" % exp)
+        return None
+
+    # add exclude_nameservers to scheduler
+    sched_path = os.path.join(home_dir, filename, "experiments", "scheduler.info")
+    if os.path.exists(sched_path):
+        with open(sched_path, 'r+') as f:
+            sched_info = json.load(f)
+            for task in sched_info:
+                if "python_exps" in sched_info[task] and "baseline" in sched_info[task]["python_exps"]:
+                    if "params" in sched_info[task]["python_exps"]["baseline"]:
+                        sched_info[task]["python_exps"]["baseline"]["params"]["exclude_nameservers"] = \
+                            local_nameservers
+                    else:
+                        sched_info[task]["python_exps"]["baseline"]["params"] = \
+                            {"exclude_nameservers": local_nameservers}
+
+            # write back to same file
+            f.seek(0)
+            json.dump(sched_info, f, indent=2)
+            f.truncate()
+
+    return config, vpn_address, country
+
+
+def finish_endpoint(filename, config, vpn_address, country, queue=None):
+    """
+    Upload the results of an endpoint once its tunnel is down.
+
+    :param queue: the WorkQueue to mark the endpoint as done in, if any
+    """
+    logging.info("%s: Synchronizing." % filename)
+    try:
+        centinel.backend.sync(config.params)
+    except Exception as exp:
+        logging.exception("%s: Failed to sync: %s" % (filename, exp))
+
+    # try setting the VPN info (IP and country) to the correct address
+    # after sync is over.
+    try:
+        centinel.backend.set_vpn_info(config.params, vpn_address, country)
+    except Exception as exp:
+        logging.exception("Failed to set VPN info: %s" % exp)
+
+    if queue is not None:
+        queue.complete(filename)
+
+
+def server_addresses(config):
+    """
+    Returns the IP addresses of the centinel server, so that traffic
+    to it can be kept out of the tunnel.
+    """
+    host = urlparse(config['server']['server_url']).hostname
+    try:
+        return socket.gethostbyname_ex(host)[2]
+    except socket.error as exp:
+        logging.warning("Failed to resolve %s: %s" % (host, exp))
+        return []
+
+
+def _pinned_getaddrinfo(host, port, *args, **kwargs):
+    addresses = _pinned.get(host)
+    if not addresses:
+        return _getaddrinfo(host, port, *args, **kwargs)
+    result = []
+    for address in addresses:
+        result.extend(_getaddrinfo(address, port, *args, **kwargs))
+    return result
+
+
+def pin_addresses(host, addresses):
+    """
+    Make host resolve to addresses without asking DNS (for everything
+    that connects through socket.getaddrinfo, like requests). Name and
+    certificate checks still use the host name.
+
+    While a tunnel is up, the background jobs reach the centinel server
+    around it (see server_addresses()), but a DNS lookup of its name
+    would go through the tunnel and end up in the measurements.
+    """
+    _pinned[host] = list(addresses)
+    socket.getaddrinfo = _pinned_getaddrinfo
 
 
 def return_abs_path(directory, path):
@@ -414,6 +644,8 @@ def create_config_files(directory):
         res_dir = os.path.join(home_dir, "results")
         os.mkdir(res_dir)
         configuration.params['dirs']['results_dir'] = res_dir
+        configuration.params['dirs']['content_cache'] = \
+            return_abs_path(directory, "content_cache")
 
         log_file = os.path.join(home_dir, "centinel.log")
         configuration.params['log']['log_file'] = log_file
@@ -531,7 +763,10 @@ def _run():
                   crt_file=args.crt_file, tls_auth=args.tls_auth,
                   key_direction=args.key_direction, exclude_list=args.exclude_list,
                   shuffle_lists=args.shuffle_lists, vm_num=args.vm_num,
-                  vm_index=args.vm_index, reduce_vp=args.reduce_vp)
+                  vm_index=args.vm_index, reduce_vp=args.reduce_vp,
+                  prefetch=args.prefetch, probe=args.probe,
+                  probe_timeout=args.probe_timeout,
+                  work_queue=args.work_queue, lease_ttl=args.lease_ttl)
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# health.py: find dead VPN endpoints before the walker tries them.
+#
+# Connecting to a dead endpoint costs the walker the whole OpenVPN
+# start timeout, and provider lists (VPN Gate in particular) contain
+# many stale servers. Before the walk, the remote of every endpoint is
+# probed in parallel: TCP remotes with a connect, UDP remotes with the
+# first packet of an OpenVPN handshake (P_CONTROL_HARD_RESET_CLIENT_V2),
+# which a live server answers. With tls-auth, tls-crypt or
+# tls-crypt-v2, the server drops handshake packets without the right
+# HMAC (or encryption), so UDP remotes can't be probed and count as
+# alive.
+#
+# Probe and connection outcomes are kept per endpoint in a JSON file,
+# so endpoints that keep failing are tried last.
+
+import json
+import logging
+import os
+import socket
+import struct
+import time
+from multiprocessing.pool import ThreadPool
+
+# opcode P_CONTROL_HARD_RESET_CLIENT_V2 (7), key id 0
+HARD_RESET_CLIENT_V2 = 7 << 3
+# opcode P_CONTROL_HARD_RESET_SERVER_V2 (8)
+HARD_RESET_SERVER_V2 = 8
+
+DEFAULT_PORT = 1194
+
+# options (or inline blocks) that protect the control channel, see above
+TLS_AUTH_OPTIONS = ("tls-auth", "<tls-auth>", "tls-crypt", "<tls-crypt>",
+                    "tls-crypt-v2", "<tls-crypt-v2>")
+
+
+def parse_remotes(config_file):
+    """
+    Returns the (host, port, proto) of each remote in an OpenVPN
+    config file, and whether it uses tls-auth (or tls-crypt, see
+    TLS_AUTH_OPTIONS).
+    """
+    remotes = []
+    default_port = DEFAULT_PORT
+    default_proto = "udp"
+    tls_auth = False
+    with open(config_file) as file_p:
+        for line in file_p:
+            fields = line.split()
+            if not fields or fields[0].startswith(("#", ";")):
+                continue
+            option = fields[0]
+            if option == "remote" and len(fields) > 1:
+                port = int(fields[2]) if len(fields) > 2 else None
+                proto = fields[3] if len(fields) > 3 else None
+                remotes.append((fields[1], port, proto))
+            elif option in ("port", "rport") and len(fields) > 1:
+                default_port = int(fields[1])
+            elif option == "proto" and len(fields) > 1:
+                default_proto = fields[1]
+            elif option in TLS_AUTH_OPTIONS:
+                tls_auth = True
+    remotes = [(host, port or default_port, proto or default_proto)
+               for host, port, proto in remotes]
+    return remotes, tls_auth
+
+
+def probe_tcp(host, port, timeout):
+    sock = socket.create_connection((host, port), timeout)
+    sock.close()
+    return True
+
+
+def probe_udp(host, port, timeout):
+    session_id = os.urandom(8)
+    # no acks, message packet id 0
+    packet = struct.pack("!B8sBI", HARD_RESET_CLIENT_V2, session_id, 0, 0)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(packet, (host, port))
+        response = sock.recv(2048)
+    except socket.timeout:
+        return False
+    finally:
+        sock.close()
+    return len(response) > 0 and ord(response[0]) >> 3 == HARD_RESET_SERVER_V2
+
+
+def probe_endpoint(config_file, tls_auth=False, timeout=5):
+    """
+    Probe the remotes of an endpoint.
+
+    :param tls_auth: whether a tls-auth key is passed to OpenVPN
+    :return: True if a remote answered, False if none did, None if
+             the endpoint can't be probed
+    """
+    try:
+        remotes, config_tls_auth = parse_remotes(config_file)
+    except (IOError, ValueError) as exp:
+        logging.warning("Failed to read %s: %s" % (config_file, exp))
+        return None
+    tls_auth = tls_auth or config_tls_auth
+
+    result = None
+    for host, port, proto in remotes:
+        try:
+            if proto.startswith("tcp"):
+                alive = probe_tcp(host, port, timeout)
+            elif tls_auth:
+                continue
+            else:
+                alive = probe_udp(host, port, timeout)
+        except (socket.error, socket.timeout) as exp:
+            logging.debug("%s:%s/%s failed: %s" % (host, port, proto, exp))
+            alive = False
+        if alive:
+            return True
+        result = False
+    return result
+
+
+def probe_endpoints(vpn_dir, filenames, tls_auth=False, timeout=5,
+                    workers=32):
+    """
+    Probe all endpoints in parallel.
+
+    :return: dict of file name to probe result, see probe_endpoint()
+    """
+    if not filenames:
+        return {}
+    pool = ThreadPool(min(workers, len(filenames)))
+    try:
+        results = pool.map(lambda filename: probe_endpoint(
+            os.path.join(vpn_dir, filename), tls_auth, timeout), filenames)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(filenames, results))
+
+
+class HealthHistory:
+    """Probe and connection outcomes per endpoint, kept in a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as file_p:
+                    self.records = json.load(file_p)
+            except ValueError:
+                logging.warning("Ignoring unreadable endpoint health "
+                                "file %s" % path)
+
+    def record(self, filename, ok):
+        """
+        Record the outcome of a probe or connection attempt.
+        """
+        record = self.records.setdefault(filename, {"successes": 0,
+                                                    "failures": 0,
+                                                    "consecutive_failures": 0})
+        if ok:
+            record["successes"] += 1
+            record["consecutive_failures"] = 0
+            record["last_success"] = time.time()
+        else:
+            record["failures"] += 1
+            record["consecutive_failures"] += 1
+            record["last_failure"] = time.time()
+
+    def consecutive_failures(self, filename):
+        return self.records.get(filename, {}).get("consecutive_failures", 0)
+
+    def order(self, filenames):
+        """
+        Returns filenames with the endpoints that failed most often in
+        a row last (otherwise keeping their order).
+        """
+        return sorted(filenames, key=self.consecutive_failures)
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file_p:
+            json.dump(self.records, file_p, indent=2, separators=(',', ': '))
+        os.rename(temp_path, self.path)
@@ -1,21 +1,41 @@
 #!/usr/bin/python
 # openvpn.py: library to handle starting and stopping openvpn instances
+#
+# OpenVPN is started with its management interface connecting back to
+# a local socket (--management-client), which reports state changes
+# and byte counters as they happen. The management interface tells us
+# when the tunnel is up and when it drops (OpenVPN reconnecting or
+# exiting), so the measurements running through it can stop instead of
+# timing out on every remaining target. Its stdout is still scraped
+# as a fallback for OpenVPN versions without the management interface.
 
 import logging
 import os
 import signal
+import socket
 import subprocess
 import threading
 import time
 
+# seconds between byte counter updates from the management interface
+BYTECOUNT_INTERVAL = 5
+
 
 class OpenVPN:
     connected_instances = []
 
     def __init__(self, config_file=None, auth_file=None, crt_file=None,
-                 tls_auth=None, key_direction=None, timeout=60):
+                 tls_auth=None, key_direction=None, timeout=60,
+                 bypass_hosts=None, management=True):
+        """
+        :param bypass_hosts: IP addresses that are reached over the
+                             regular gateway instead of the tunnel
+        :param management: follow the tunnel state over the management
+                           interface
+        """
         self.started = False
         self.stopped = False
+        self.stopping = False
         self.error = False
         self.notifications = ""
         self.auth_file = auth_file
@@ -23,10 +43,29 @@ class OpenVPN:
         self.tls_auth = tls_auth
         self.key_dir = key_direction
         self.config_file = config_file
+        self.bypass_hosts = bypass_hosts
         self.thread = threading.Thread(target=self._invoke_openvpn)
         self.thread.setDaemon(1)
         self.timeout = timeout
 
+        # state as reported by the management interface
+        self.state = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # set while the tunnel is up
+        self.connected = threading.Event()
+        # set whenever started, error or stopped change
+        self._update = threading.Event()
+        self.management_socket = None
+        self.management_thread = None
+        if management:
+            self.management_socket = socket.socket(socket.AF_INET,
+                                                   socket.SOCK_STREAM)
+            self.management_socket.bind(("127.0.0.1", 0))
+            self.management_socket.listen(1)
+            self.management_thread = threading.Thread(target=self._read_management)
+            self.management_thread.setDaemon(1)
+
     def _invoke_openvpn(self):
         cmd = ['sudo', 'openvpn', '--script-security', '2']
         # --config must be the first parameter, since otherwise
@@ -40,6 +79,15 @@ class OpenVPN:
             cmd.extend(['--tls-auth', self.tls_auth, self.key_dir])
         if self.auth_file is not None:
             cmd.extend(['--auth-user-pass', self.auth_file])
+        if self.bypass_hosts is not None:
+            for host in self.bypass_hosts:
+                cmd.extend(['--route', host, '255.255.255.255',
+                            'net_gateway'])
+        if self.management_socket is not None:
+            # OpenVPN connects to us, so there is no port to race for
+            host, port = self.management_socket.getsockname()
+            cmd.extend(['--management', host, str(port),
+                        '--management-client'])
 
         self.process = subprocess.Popen(cmd,
                                         stdin=subprocess.PIPE,
@@ -53,6 +101,8 @@ class OpenVPN:
             if not line:
                 break
             self.output_callback(line, self.process.terminate)
+        self._set_down("OpenVPN exited")
+        self._update.set()
 
     def output_callback(self, line, kill_switch):
         """Set status of openvpn according to what we process"""
@@ -60,10 +110,86 @@ class OpenVPN:
 
         if "Initialization Sequence Completed" in line:
             self.started = True
+            self.connected.set()
         if "ERROR:" in line or "Cannot resolve host address:" in line:
             self.error = True
         if "process exiting" in line:
             self.stopped = True
+        if "Restart pause" in line or "process exiting" in line:
+            self._set_down(line)
+        self._update.set()
+
+    def _read_management(self):
+        self.management_socket.settimeout(self.timeout)
+        try:
+            connection, address = self.management_socket.accept()
+        except socket.error as exp:
+            logging.debug("OpenVPN management interface did not "
+                          "connect: %s" % exp)
+            return
+        finally:
+            self.management_socket.close()
+        connection.settimeout(None)
+        try:
+            # real-time state changes and byte counts, and the state
+            # so far in case we missed some
+            connection.sendall("state on\nbytecount %d\nstate\n" %
+                               BYTECOUNT_INTERVAL)
+            file_p = connection.makefile()
+            for line in iter(file_p.readline, ""):
+                self.management_callback(line.strip())
+        except socket.error as exp:
+            logging.debug("OpenVPN management connection failed: %s" % exp)
+        finally:
+            connection.close()
+        # OpenVPN is gone if the management connection is
+        self._set_down("OpenVPN management connection closed")
+        self._update.set()
+
+    def management_callback(self, line):
+        """Update the tunnel state from a management interface line"""
+        if line.startswith(">STATE:"):
+            self._set_state(line[len(">STATE:"):].split(",")[1])
+        elif line.startswith(">BYTECOUNT:"):
+            counts = line[len(">BYTECOUNT:"):].split(",")
+            self.bytes_in, self.bytes_out = int(counts[0]), int(counts[1])
+        elif not line.startswith((">", "SUCCESS:", "ERROR:", "END")):
+            # reply to the state command: time,state,...
+            fields = line.split(",")
+            if len(fields) > 1 and fields[0].isdigit():
+                self._set_state(fields[1])
+
+    def _set_state(self, state):
+        self.state = state
+        if state == "CONNECTED":
+            if self.started and not self.connected.is_set():
+                logging.info("OpenVPN tunnel is back up")
+            self.started = True
+            self.connected.set()
+        elif state in ("RECONNECTING", "EXITING"):
+            self._set_down("OpenVPN state %s" % state)
+        self._update.set()
+
+    def _set_down(self, reason):
+        if self.connected.is_set():
+            self.connected.clear()
+            if not self.stopping:
+                logging.warning("OpenVPN tunnel dropped (%s) after %d bytes "
+                                "in, %d out" % (reason, self.bytes_in,
+                                                self.bytes_out))
+
+    def is_down(self):
+        """
+        True if the tunnel was up and has dropped since.
+        """
+        return self.started and not self.connected.is_set()
+
+    def wait_connected(self, timeout):
+        """
+        Wait up to timeout seconds for the tunnel to be up. Returns
+        whether it is.
+        """
+        return self.connected.wait(timeout)
 
     def start(self, timeout=None):
         """
@@ -74,12 +200,16 @@ class OpenVPN:
         """
         if not timeout:
             timeout = self.timeout
+        if self.management_thread is not None:
+            self.management_thread.start()
         self.thread.start()
-        start_time = time.time()
-        while start_time + timeout > time.time():
-            self.thread.join(1)
-            if self.error or self.started:
+        deadline = time.time() + timeout
+        while not (self.error or self.started):
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.thread.is_alive():
                 break
+            self._update.wait(remaining)
+            self._update.clear()
         if self.started:
             logging.info("OpenVPN connected")
             # append instance to connected list
@@ -97,10 +227,12 @@ class OpenVPN:
         """
         if not timeout:
             timeout = self.timeout
+        self.stopping = True
         os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
         self.thread.join(timeout)
         if self.stopped:
-            logging.info("OpenVPN stopped")
+            logging.info("OpenVPN stopped (%d bytes in, %d out)" %
+                         (self.bytes_in, self.bytes_out))
             if self in OpenVPN.connected_instances:
                 OpenVPN.connected_instances.remove(self)
         else:
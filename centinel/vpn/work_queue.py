@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# work_queue.py: hand out VPN endpoints to walker VMs as they become
+# free, instead of giving each VM a fixed chunk of the list.
+#
+# The VMs share a directory. To work on an endpoint, a VM creates
+# leases/<endpoint> with O_EXCL, which only one VM can do. Once the
+# endpoint is finished, the VM writes done/<endpoint> and removes the
+# lease. While a VM holds leases, a background thread renews them.
+# A lease that has not been renewed for ttl seconds belongs to a VM
+# that crashed or hung, and another VM takes the endpoint over. This
+# needs the clocks of the VMs to roughly agree (NTP).
+#
+# A queue directory covers one round over the endpoints. Use a new
+# (or emptied) directory for the next round.
+
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+
+class WorkQueue:
+    """Lease-based queue of endpoints in a shared directory"""
+
+    def __init__(self, directory, ttl=600, owner=None):
+        """
+        :param directory: the shared queue directory
+        :param ttl: seconds after which a lease that was not renewed
+                    expires
+        :param owner: name of this walker, host name and pid by
+                      default
+        """
+        self.directory = directory
+        self.ttl = ttl
+        if owner is None:
+            owner = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.owner = owner
+        self.lease_dir = os.path.join(directory, "leases")
+        self.done_dir = os.path.join(directory, "done")
+        for path in [self.lease_dir, self.done_dir]:
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as exp:
+                    if exp.errno != errno.EEXIST:
+                        raise
+        self._lock = threading.Lock()
+        self._held = set()
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def _lease_path(self, name):
+        return os.path.join(self.lease_dir, name)
+
+    def _lease_data(self):
+        return json.dumps({"owner": self.owner,
+                           "expires": time.time() + self.ttl})
+
+    def _read_lease(self, path):
+        try:
+            with open(path) as file_p:
+                return json.load(file_p)
+        except (IOError, OSError, ValueError):
+            # gone, or still being written
+            return None
+
+    def _create(self, path):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError as exp:
+            if exp.errno == errno.EEXIST:
+                return False
+            raise
+        with os.fdopen(fd, "w") as file_p:
+            file_p.write(self._lease_data())
+        return True
+
+    def _take_over(self, path):
+        """
+        Take over an expired lease. Only one walker can move the old
+        lease out of the way, and that one creates the new lease.
+        """
+        stale_path = "%s.stale-%s" % (path, self.owner)
+        try:
+            os.rename(path, stale_path)
+        except OSError:
+            return False
+        lease = self._read_lease(stale_path)
+        if lease is not None and lease["expires"] > time.time():
+            # renewed since we looked, put it back unless someone
+            # else has created a lease in the meantime
+            try:
+                os.link(stale_path, path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        if lease is not None:
+            logging.warning("Taking over %s from %s, its lease expired" %
+                            (os.path.basename(path), lease["owner"]))
+        return self._create(path)
+
+    def is_done(self, name):
+        return os.path.exists(os.path.join(self.done_dir, name))
+
+    def claim(self, name):
+        """
+        Try to get the lease for an endpoint. Returns False if it is
+        done or another walker is working on it.
+        """
+        if self.is_done(name):
+            return False
+        path = self._lease_path(name)
+        if not self._create(path):
+            lease = self._read_lease(path)
+            if lease is None or lease["expires"] > time.time():
+                return False
+            if not self._take_over(path):
+                return False
+        # it may have been finished between the check and the lease
+        if self.is_done(name):
+            self.release(name)
+            return False
+        with self._lock:
+            self._held.add(name)
+        self._start_renewer()
+        return True
+
+    def complete(self, name):
+        """
+        Mark an endpoint as done for this round and drop its lease.
+        """
+        with open(os.path.join(self.done_dir, name), "w") as file_p:
+            file_p.write(self.owner + "\n")
+        self.release(name)
+
+    def release(self, name):
+        """
+        Drop the lease of an endpoint without finishing it, so that
+        other walkers can take it.
+        """
+        with self._lock:
+            self._held.discard(name)
+        path = self._lease_path(name)
+        lease = self._read_lease(path)
+        if lease is not None and lease["owner"] == self.owner:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def renew(self):
+        with self._lock:
+            held = list(self._held)
+        for name in held:
+            path = self._lease_path(name)
+            lease = self._read_lease(path)
+            if lease is None or lease["owner"] != self.owner:
+                logging.warning("Lost the lease of %s" % name)
+                with self._lock:
+                    self._held.discard(name)
+                continue
+            temp_path = "%s.renew-%s" % (path, self.owner)
+            with open(temp_path, "w") as file_p:
+                file_p.write(self._lease_data())
+            os.rename(temp_path, path)
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3.0):
+            try:
+                self.renew()
+            except Exception as exp:
+                logging.exception("Failed to renew leases: %s" % exp)
+
+    def _start_renewer(self):
+        with self._lock:
+            if self._renewer is not None:
+                return
+            self._renewer = threading.Thread(target=self._renew_loop)
+            self._renewer.setDaemon(True)
+            self._renewer.start()
+
+    def close(self):
+        """
+        Release all leases that are still held and stop renewing.
+        """
+        with self._lock:
+            held = list(self._held)
+        for name in held:
+            self.release(name)
+        self._stop.set()